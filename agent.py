@@ -27,9 +27,9 @@ from metadata import get_metadata
 
 from collector import Collector
 from aggregator import MetricsAggregator
-from serialize import Serializer
+from serialize import Serializer, GatewaySerializer
 from forwarder import Forwarder
-from api import APIServer
+from api import APIServer, AggregationGateway
 
 # Globals
 PID_NAME = 'datadog-unix-agent'
@@ -38,12 +38,15 @@ log = logging.getLogger('agent')
 
 
 class AgentRunner(Thread):
-    def __init__(self, collector, serializer, config):
+    def __init__(self, collector, serializer, config, gateway=None, aggregator=None):
         super(AgentRunner, self).__init__()
         self._collector = collector
         self._serializer = serializer
         self._config = config
         self._event = Event()
+        # In gateway mode, the states posted by other agents are merged into our aggregator
+        self._gateway = gateway
+        self._aggregator = aggregator
 
     def collection(self):
         # update the metadata periodically?
@@ -52,7 +55,15 @@ class AgentRunner(Thread):
 
         while not self._event.is_set():
             self._collector.run_checks()
-            self._serializer.serialize_and_push()
+            if self._gateway is not None:
+                try:
+                    self._gateway.merge_into(self._aggregator)
+                except Exception:
+                    log.exception("Error merging the metrics reported through the gateway")
+            try:
+                self._serializer.serialize_and_push()
+            except Exception:
+                log.exception("Error flushing the metrics")
             time.sleep(self._config.get('min_collection_interval'))
 
     def stop(self):
@@ -163,6 +174,17 @@ class Agent(Daemon):
         )
         forwarder.start()
 
+        gateway_config = config.get('gateway')
+        gateway_forwarder = None
+        if gateway_config.get('url'):
+            logging.info("Reporting to the aggregation gateway at %s", gateway_config['url'])
+            gateway_forwarder = Forwarder(
+                api_key,
+                gateway_config['url'],
+                proxies=proxies,
+            )
+            gateway_forwarder.start()
+
         # aggregator
         aggregator = MetricsAggregator(
             hostname,
@@ -172,13 +194,33 @@ class Agent(Daemon):
             recent_point_threshold=config.get('recent_point_threshold'),
             histogram_aggregates=config.get('histogram_aggregates'),
             histogram_percentiles=config.get('histogram_percentiles'),
+            histogram_sketch_accuracy=config.get('histogram_sketch_accuracy'),
+            set_hll_threshold=config.get('set_hll_threshold'),
+            set_hll_patterns=config.get('set_hll_patterns'),
+            set_hll_precision=config.get('set_hll_precision'),
         )
 
         # serializer
-        serializer = Serializer(
-            aggregator,
-            forwarder,
-        )
+        gateway = None
+        if gateway_forwarder is not None:
+            serializer = GatewaySerializer(
+                aggregator,
+                forwarder,
+                gateway_forwarder,
+            )
+        elif gateway_config.get('enabled'):
+            logging.info("Running as an aggregation gateway")
+            gateway = AggregationGateway(api_key, gateway_config.get('queue_size'))
+            serializer = Serializer(
+                aggregator,
+                forwarder,
+                compress=True,
+            )
+        else:
+            serializer = Serializer(
+                aggregator,
+                forwarder,
+            )
 
         # instantiate collector
         collector = Collector(config, aggregator)
@@ -186,16 +228,18 @@ class Agent(Daemon):
         collector.instantiate_checks()
 
         # instantiate AgentRunner
-        runner = AgentRunner(collector, serializer, config)
+        runner = AgentRunner(collector, serializer, config, gateway=gateway, aggregator=aggregator)
 
         # instantiate API
-        api = APIServer(8888, aggregator.stats)
+        api = APIServer(8888, aggregator.stats, gateway=gateway)
 
         def signal_handler(signal, frame):
             log.info("SIGINT received: stopping the agent")
             log.info("Stopping the forwarder")
             runner.stop()
             forwarder.stop()
+            if gateway_forwarder is not None:
+                gateway_forwarder.stop()
             api.stop()
             log.info("See you !")
             sys.exit(0)
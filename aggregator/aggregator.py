@@ -4,19 +4,28 @@
 # Copyright 2018 Datadog, Inc.
 
 # stdlib
+import fnmatch
 import logging
+import re
+import threading
 from time import time
 from collections import defaultdict, Hashable
 
 # project
 from .types import (
     Counter,
+    Distribution,
     Histogram,
     MetricResolver,
     BucketMetricResolver,
+    Set,
 )
 
 from config.default import DEFAULT_RECENT_POINT_THRESHOLD
+from .clock import Clock
+from .context_cache import ContextCache
+from .context_registry import ContextRegistry
+from .timing_wheel import TimingWheel
 from .formatters import api_formatter
 from .types import MetricTypes
 from. stats import AggregatorStats
@@ -25,6 +34,22 @@ from. stats import AggregatorStats
 log = logging.getLogger(__name__)
 
 UNKNOWN_SOURCE = 'unknown'
+DEFAULT_CONTEXT_CACHE_SIZE = 4096
+
+
+def compile_name_patterns(patterns):
+    """
+    Compiles a list, or a comma separated string, of shell-style metric
+    name patterns into a single regex. Returns None without patterns.
+    """
+    if not patterns:
+        return None
+    if isinstance(patterns, basestring):
+        patterns = patterns.split(',')
+    patterns = [pattern.strip() for pattern in patterns if pattern.strip()]
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
 
 
 class Aggregator(object):
@@ -34,12 +59,16 @@ class Aggregator(object):
     # Types of metrics that allow strings
     ALLOW_STRINGS = ['s', ]
     # Types that are not implemented and ignored
-    IGNORE_TYPES = ['d', ]
+    IGNORE_TYPES = []
+    # Whether the contexts are expired by the registry, from their last seen time
+    EXPIRES_CONTEXTS = False
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, histogram_sketch_accuracy=None,
+                 set_hll_threshold=None, set_hll_patterns=None, set_hll_precision=None,
+                 clock=None):
         # TODO(jaime): add support for event, service_check sources
         self.events = []
         self.service_checks = []
@@ -63,12 +92,30 @@ class Aggregator(object):
         self.metric_config = {
             Histogram: {
                 'aggregates': histogram_aggregates,
-                'percentiles': histogram_percentiles
+                'percentiles': histogram_percentiles,
+                'sketch_accuracy': histogram_sketch_accuracy,
             }
         }
+        # Distributions are reported like histograms, from a sketch
+        self.metric_config[Distribution] = self.metric_config[Histogram]
+        self.metric_config[Set] = {
+            'hll_threshold': int(set_hll_threshold) if set_hll_threshold else None,
+            'hll_patterns': compile_name_patterns(set_hll_patterns),
+            'hll_precision': set_hll_precision,
+        }
 
         self.utf8_decoding = utf8_decoding
 
+        # Read once per batch of packets rather than for every metric
+        self.clock = clock or Clock()
+
+        # Integer IDs, and interned names/tags/hostnames, of the contexts
+        self.context_registry = ContextRegistry(self.clock, track_last_seen=self.EXPIRES_CONTEXTS)
+
+        # Serializes the submissions, and the few steps of a flush that swap
+        # state out of their way: the flushed state is formatted unlocked.
+        self._lock = threading.Lock()
+
     def deduplicate_tags(self, tags):
         return sorted(set(tags))
 
@@ -81,53 +128,47 @@ class Aggregator(object):
         """
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
-        """
-        parsed_packets = []
-        name_and_metadata = packet.split(':', 1)
 
-        if len(name_and_metadata) != 2:
+        Each line is scanned once: the values are only searched for when
+        colons appear outside of the tags, and decimal numbers are parsed
+        without going through a failed `int` conversion first.
+        """
+        name, separator, values = packet.partition(':')
+        if not separator:
             raise Exception(u'Unparseable metric packet: %s' % packet)
 
-        name = name_and_metadata[0]
-        broken_split = name_and_metadata[1].split(':')
-        data = []
-        partial_datum = None
-        for token in broken_split:
-            # We need to fix the tag groups that got broken by the : split
-            if partial_datum is None:
-                partial_datum = token
-            elif "|" not in token:
-                partial_datum += ":" + token
-            else:
-                data.append(partial_datum)
-                partial_datum = token
-        data.append(partial_datum)
+        data = (values,)
+        if ':' in values and not self._has_single_value(values):
+            data = self._split_values(values)
 
+        parsed_packets = []
         for datum in data:
             value_and_metadata = datum.split('|')
 
             if len(value_and_metadata) < 2:
                 raise Exception(u'Unparseable metric packet: %s' % packet)
 
-            # Submit the metric
             raw_value = value_and_metadata[0]
             metric_type = value_and_metadata[1]
 
             if metric_type in self.ALLOW_STRINGS:
                 value = raw_value
-            elif len(metric_type) > 0 and metric_type[0] in self.IGNORE_TYPES:
+            elif metric_type and metric_type[0] in self.IGNORE_TYPES:
                 continue
             else:
-                # Try to cast as an int first to avoid precision issues, then as a
-                # float.
+                # Decimals are parsed as floats right away, anything else as an
+                # int first to avoid precision issues, then as a float.
                 try:
-                    value = int(raw_value)
-                except ValueError:
-                    try:
+                    if '.' in raw_value:
                         value = float(raw_value)
-                    except ValueError:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception(u'Metric value must be a number: %s, %s' % (name, raw_value))
+                    else:
+                        try:
+                            value = int(raw_value)
+                        except ValueError:
+                            value = float(raw_value)
+                except ValueError:
+                    # Otherwise, raise an error saying it must be a number
+                    raise Exception(u'Metric value must be a number: %s, %s' % (name, raw_value))
 
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
@@ -149,6 +190,37 @@ class Aggregator(object):
 
         return parsed_packets
 
+    @staticmethod
+    def _has_single_value(values):
+        """
+        Fast path of the value search: colons that only appear in a trailing
+        tag section can't start another value.
+        """
+        if ':' not in values:
+            return True
+        tags_start = values.find('|#')
+        return tags_start != -1 and values.find(':', 0, tags_start) == -1 \
+            and values.find('|', tags_start + 2) == -1
+
+    @staticmethod
+    def _split_values(values):
+        """
+        Split the `<value>|<metric_type>...` groups of a multi-value packet.
+        Colons also appear in tags, a new group only starts at a colon
+        followed by a `|` before the next colon.
+        """
+        data = []
+        start = 0
+        colon = values.find(':')
+        while colon != -1:
+            next_colon = values.find(':', colon + 1)
+            if values.find('|', colon + 1, len(values) if next_colon == -1 else next_colon) != -1:
+                data.append(values[start:colon])
+                start = colon + 1
+            colon = next_colon
+        data.append(values[start:])
+        return data
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -242,7 +314,33 @@ class Aggregator(object):
         if self.utf8_decoding:
             packets = unicode(packets, 'utf-8', errors='replace')
 
-        for packet in packets.splitlines():
+        with self._lock:
+            self.clock.refresh()
+            self._submit_lines(packets.splitlines())
+
+    def submit_packet_batch(self, packets):
+        """
+        Submit a newline separated batch of datagrams drained from a socket in
+        one go. Unlike `submit_packets`, a malformed line is logged and only
+        discards itself, the rest of the batch is still processed.
+        """
+        if self.utf8_decoding:
+            packets = unicode(packets, 'utf-8', errors='replace')
+
+        with self._lock:
+            self.clock.refresh()
+            # A failing line has already been consumed from the iterator, so
+            # resuming with the same iterator carries on with the next one.
+            lines = iter(packets.splitlines())
+            while True:
+                try:
+                    self._submit_lines(lines)
+                    return
+                except Exception:
+                    log.exception(u'Error processing packet')
+
+    def _submit_lines(self, lines):
+        for packet in lines:
             if not packet.strip():
                 continue
 
@@ -255,12 +353,15 @@ class Aggregator(object):
                 self.service_check(**service_check)
                 self.service_check_count += 1
             else:
-                parsed_packets = self.parse_metric_packet(packet)
-                self.count += 1
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags,
-                                       hostname=hostname, sample_rate=sample_rate)
+                self._submit_metric_packet(packet)
+
+    def _submit_metric_packet(self, packet):
+        parsed_packets = self.parse_metric_packet(packet)
+        self.count += 1
+        for name, value, mtype, tags, sample_rate in parsed_packets:
+            hostname, tags = self._extract_magic_tags(tags)
+            self.submit_metric(name, value, mtype, tags=tags,
+                               hostname=hostname, sample_rate=sample_rate)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host) override metric hostname attributes"""
@@ -336,24 +437,28 @@ class Aggregator(object):
         raise NotImplementedError()
 
     def flush_events(self):
-        events = self.events
-        self.events = []
+        with self._lock:
+            events = self.events
+            self.events = []
+            event_count = self.event_count
+            self.event_count = 0
 
-        self.stats.set_last_flush_counts(ecount=self.event_count)
-        self.total_count += self.event_count
-        self.event_count = 0
+        self.stats.set_last_flush_counts(ecount=event_count)
+        self.total_count += event_count
 
         log.debug("Received %d events since last flush" % len(events))
 
         return events
 
     def flush_service_checks(self):
-        service_checks = self.service_checks
-        self.service_checks = []
+        with self._lock:
+            service_checks = self.service_checks
+            self.service_checks = []
+            service_check_count = self.service_check_count
+            self.service_check_count = 0
 
-        self.stats.set_last_flush_counts(sccount=self.service_check_count)
-        self.total_count += self.service_check_count
-        self.service_check_count = 0
+        self.stats.set_last_flush_counts(sccount=service_check_count)
+        self.total_count += service_check_count
 
         log.debug("Received {0} service check runs since last flush".format(len(service_checks)))
 
@@ -362,6 +467,51 @@ class Aggregator(object):
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def _export_metrics(self, metric_by_context):
+        """
+        Returns the state of the metrics of `metric_by_context` as a list of
+        `(name, tags, hostname, type, state)`, all plain, picklable data.
+        """
+        type_by_class = {}
+        states = []
+        for metric in metric_by_context.itervalues():
+            metric_class = metric.__class__
+            if metric_class not in type_by_class:
+                type_by_class[metric_class] = self.metric_type_to_class.get_type_from_class(metric_class)
+            states.append((metric.name, metric.tags, metric.hostname,
+                           type_by_class[metric_class], metric.get_state()))
+        return states
+
+    def _merge_metrics(self, metric_by_context, states):
+        """
+        Merge the metric states returned by `_export_metrics` on a peer
+        aggregator into `metric_by_context`, creating the missing metrics.
+
+        The metrics that can't be merged, e.g. a sketched histogram into an
+        exact one, are logged and skipped.
+        """
+        for name, tags, hostname, mtype, state in states:
+            metric_class = self.metric_type_to_class[mtype]
+            if metric_class is None:
+                log.warning("Can't merge metric %s of type %s, not supported by this aggregator", name, mtype)
+                continue
+            context = self.context_registry.context_id(name, tags or tuple(), hostname)
+            created = context not in metric_by_context
+            if created:
+                name, tags, hostname = self.context_registry.get(context)
+                metric_by_context[context] = \
+                    metric_class(self.formatter, name, tags or None,
+                                 hostname, self.metric_config.get(metric_class))
+            try:
+                metric_by_context[context].merge_state(state)
+            except ValueError as e:
+                log.warning("Can't merge metric %s: %s", name, e)
+                if created:
+                    del metric_by_context[context]
+                    if not self.EXPIRES_CONTEXTS:
+                        # Only the metrics hold the contexts of this aggregator
+                        self.context_registry.release(context)
+
 
 class MetricsBucketAggregator(Aggregator):
     """
@@ -371,13 +521,16 @@ class MetricsBucketAggregator(Aggregator):
     incoming metrics and thus no implicit check-run assumptions can be made.
 
     Metric types supported by this aggregator: Gauge(BucketGauge), Counter,
-                                               Histogram, Set
+                                               Histogram, Distribution, Set
     """
+    EXPIRES_CONTEXTS = True
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=None,
+                 histogram_sketch_accuracy=None, set_hll_threshold=None,
+                 set_hll_patterns=None, set_hll_precision=None, clock=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -386,38 +539,55 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_sketch_accuracy,
+            set_hll_threshold,
+            set_hll_patterns,
+            set_hll_precision,
+            clock
         )
         self.metric_by_bucket = {}
-        self.last_sample_time_by_context = {}
+        # Last sample time of the counters, which report zeros until they expire
+        self.last_sample_time_by_context = TimingWheel()
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = 0
         self.metric_type_to_class = BucketMetricResolver()
+        # Contexts resolved from the raw packets, to skip parsing the tags of
+        # the series seen over and over again. Disabled with a size of 0.
+        if context_cache_size is None:
+            context_cache_size = DEFAULT_CONTEXT_CACHE_SIZE
+        self.context_cache = None
+        if context_cache_size:
+            self.context_cache = ContextCache(int(context_cache_size))
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       timestamp=None, sample_rate=1):
+        with self._lock:
+            self.clock.refresh()
+            self._sample(self._context(name, tags, hostname), mtype, value, sample_rate, timestamp)
+
+    def _context(self, name, tags, hostname):
+        """ Returns the ID of the context of a metric. """
         # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also
-        # change create_empty_metrics, which counts on this order
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
         if tags is None:
-            context = (name, tuple(), hostname)
-        else:
-            tags = tuple(self.deduplicate_tags(tags))
-            context = (name, tags, hostname)
+            return self.context_registry.context_id(name, tuple(), hostname)
+        return self.context_registry.context_id(name, tuple(self.deduplicate_tags(tags)), hostname)
 
-        cur_time = time()
+    def _sample(self, context, mtype, value, sample_rate, timestamp):
+        cur_time = self.clock.now
         # Check to make sure that the timestamp that is passed in (if any) is
         # not older than recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " %
+                      (self.context_registry.get(context)[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             timestamp = timestamp or cur_time
@@ -434,74 +604,232 @@ class MetricsBucketAggregator(Aggregator):
 
             if context not in metric_by_context:
                 metric_class = self.metric_type_to_class[mtype]
+                name, tags, hostname = self.context_registry.get(context)
                 metric_by_context[context] = \
-                    metric_class(self.formatter, name, tags,
+                    metric_class(self.formatter, name, tags or None,
                                  hostname, self.metric_config.get(metric_class))
 
-            metric_by_context[context].sample(value, sample_rate, timestamp)
+            metric_by_context[context].sample(value, sample_rate, timestamp, cur_time)
+
+    def _submit_metric_packet(self, packet):
+        """
+        Packets of a series already seen are only different by their value:
+        their context is looked up in the cache, keyed on the packet without
+        its value, and the value is the only thing left to parse.
+        """
+        cache = self.context_cache
+        key = None
+        if cache is not None:
+            colon = packet.find(':')
+            value_end = packet.find('|', colon + 1)
+            # A colon in the value would make it a different packet
+            if colon != -1 and value_end != -1 and packet.find(':', colon + 1, value_end) == -1:
+                key = packet[:colon + 1] + packet[value_end:]
+                entry = cache.get(key)
+                if entry is not None:
+                    context, mtype, sample_rate = entry
+                    raw_value = packet[colon + 1:value_end]
+                    if mtype in self.ALLOW_STRINGS:
+                        value = raw_value
+                    else:
+                        value = self._parse_value(packet[:colon], raw_value)
+                    self.count += 1
+                    self._sample(context, mtype, value, sample_rate, None)
+                    return
+
+        parsed_packets = self.parse_metric_packet(packet)
+        self.count += 1
+        for name, value, mtype, tags, sample_rate in parsed_packets:
+            hostname, tags = self._extract_magic_tags(tags)
+            context = self._context(name, tags, hostname)
+            self._sample(context, mtype, value, sample_rate, None)
+
+        # Only packets holding a single value can be resolved from the cache
+        if key is not None and len(parsed_packets) == 1 and self._has_single_value(packet[value_end:]):
+            cache.set(key, (context, mtype, sample_rate))
+
+    @staticmethod
+    def _parse_value(name, raw_value):
+        """ Same value parsing as `parse_metric_packet`. """
+        try:
+            if '.' in raw_value:
+                return float(raw_value)
+            try:
+                return int(raw_value)
+            except ValueError:
+                return float(raw_value)
+        except ValueError:
+            raise Exception(u'Metric value must be a number: %s, %s' % (name, raw_value))
+
+    def context_cache_metrics(self):
+        """ Returns the context cache telemetry as (name, value) gauges. """
+        if self.context_cache is None:
+            return []
+        metrics = [('datadog.dogstatsd.context_cache.size', len(self.context_cache))]
+        hit_rate = self.context_cache.pop_hit_rate()
+        if hit_rate is not None:
+            metrics.append(('datadog.dogstatsd.context_cache.hit_rate', hit_rate))
+        return metrics
+
+    def export_buckets(self):
+        """
+        Detach every bucket from the aggregator and return them, along with
+        the packet count, as plain data that `merge_buckets` can fold into a
+        peer aggregator (e.g. one living in another process).
+        """
+        with self._lock:
+            metric_by_bucket = self._detach_buckets(None)
+            count = self.count
+            self.count = 0
+
+        buckets = []
+        for bucket_start_timestamp, metric_by_context in metric_by_bucket.iteritems():
+            for context in metric_by_context:
+                self.context_registry.touch(context, bucket_start_timestamp)
+            buckets.append((bucket_start_timestamp, self._export_metrics(metric_by_context)))
+
+        # The exported contexts live on in the peer aggregator
+        with self._lock:
+            self._expire_contexts(self.clock.refresh() - self.expiry_seconds)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+        return {'buckets': buckets, 'count': count}
+
+    def merge_buckets(self, exported):
+        """ Merge buckets returned by `export_buckets` on a peer aggregator. """
+        with self._lock:
+            self._merge_buckets(exported)
+
+    def _merge_buckets(self, exported):
+        for bucket_start_timestamp, metrics in exported['buckets']:
+            if bucket_start_timestamp not in self.metric_by_bucket:
+                self.metric_by_bucket[bucket_start_timestamp] = {}
+            self._merge_metrics(self.metric_by_bucket[bucket_start_timestamp], metrics)
+
+        self.count += exported['count']
+
+    def create_empty_metrics(self, metric_by_context, expiry_timestamp, flush_timestamp, metrics):
+        """
+        Report a zero for the counters that were not sampled in the flushed
+        bucket `metric_by_context`.
+
+        The expired counters are taken out of the timing wheel first, without
+        visiting the others: besides them, only the counters left to report
+        are visited.
+        """
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
-            else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2])
-                metrics += metric.flush(flush_timestamp, self.interval)
+        expired = self.last_sample_time_by_context.expire(expiry_timestamp)
+        if log.isEnabledFor(logging.DEBUG):
+            for context in expired:
+                log.debug("%s hasn't been submitted in %ss. Expiring.",
+                          self.context_registry.get(context), self.expiry_seconds)
+
+        formatter = self.formatter
+        get_context = self.context_registry.get
+        value = 0 / self.interval
+        for context in self.last_sample_time_by_context:
+            if isinstance(metric_by_context.get(context), Counter):
+                # Reported with the bucket
+                continue
+            name, tags, hostname = get_context(context)
+            metrics.append(formatter(
+                metric=name,
+                value=value,
+                timestamp=flush_timestamp,
+                tags=tags,
+                hostname=hostname,
+                metric_type=MetricTypes.RATE,
+                interval=self.interval,
+            ))
+
+    def _context_in_use(self, context):
+        """ Whether a context is waiting in a bucket or reporting counter zeros. """
+        if context in self.last_sample_time_by_context:
+            return True
+        for metric_by_context in self.metric_by_bucket.itervalues():
+            if context in metric_by_context:
+                return True
+        return False
+
+    def _expire_contexts(self, expiry_timestamp):
+        """ Release the contexts that expired, unless they are still in use. """
+        released = self.context_registry.expire(expiry_timestamp, in_use=self._context_in_use)
+        if released and self.context_cache is not None:
+            # The cache may still resolve packets to the released IDs
+            self.context_cache.clear()
+
+    def _detach_buckets(self, flush_cutoff_time):
+        """
+        Swap the buckets that started before `flush_cutoff_time` (all of them
+        if None) out of the aggregator, and return them. Called with the lock
+        held: the submissions carry on in a new dict, into which only the few
+        buckets still open are moved back.
+        """
+        detached = self.metric_by_bucket
+        self.metric_by_bucket = {}
+        if flush_cutoff_time is not None:
+            for bucket_start_timestamp in detached.keys():
+                if bucket_start_timestamp >= flush_cutoff_time:
+                    self.metric_by_bucket[bucket_start_timestamp] = detached.pop(bucket_start_timestamp)
+        self.current_bucket = None
+        self.current_mbc = {}
+        return detached
 
     def flush(self):
-        cur_time = time()
-        flush_cutoff_time = self.calculate_bucket_start(cur_time)
+        """
+        Flush the buckets that are over. Only swapping them out and releasing
+        the expired contexts hold the lock: the submissions are not blocked
+        while the metrics are formatted.
+        """
+        with self._lock:
+            cur_time = self.clock.refresh()
+            flush_cutoff_time = self.calculate_bucket_start(cur_time)
+            has_buckets = bool(self.metric_by_bucket)
+            metric_by_bucket = self._detach_buckets(flush_cutoff_time)
+            count = self.count
+            self.count = 0
+            num_discarded_old_points = self.num_discarded_old_points
+            self.num_discarded_old_points = 0
         expiry_timestamp = cur_time - self.expiry_seconds
 
         metrics = []
 
-        if self.metric_by_bucket:
+        if has_buckets:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
-                        if metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
+            #  re-create non-expired metrics.
+            for bucket_start_timestamp in sorted(metric_by_bucket):
+                metric_by_context = metric_by_bucket[bucket_start_timestamp]
+                for context, metric in metric_by_context.iteritems():
+                    if metric.last_sample_time < expiry_timestamp:
+                        # This should never happen
+                        log.warning("%s hasn't been submitted in %ss. Expiring." %
+                                    (self.context_registry.get(context), self.expiry_seconds))
+                        self.last_sample_time_by_context.pop(context, None)
+                    else:
+                        # The bucket timestamp is shared by all its contexts
+                        self.context_registry.touch(context, bucket_start_timestamp)
+                        metrics += metric.flush(bucket_start_timestamp, self.interval)
+                        if isinstance(metric, Counter):
+                            self.last_sample_time_by_context[context] = metric.last_sample_time
+                # We need to account for Metrics that have not expired and were not flushed for this bucket
+                self.create_empty_metrics(metric_by_context, expiry_timestamp, bucket_start_timestamp, metrics)
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+                self.create_empty_metrics({}, expiry_timestamp, flush_cutoff_time-self.interval, metrics)
+
+        with self._lock:
+            self._expire_contexts(expiry_timestamp)
 
         # Log a warning regarding metrics with old timestamps being submitted
-        if self.num_discarded_old_points > 0:
-            log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
-            self.num_discarded_old_points = 0
+        if num_discarded_old_points > 0:
+            log.warn('%s points were discarded as a result of having an old timestamp' % num_discarded_old_points)
 
         # Save some stats.
-        log.debug("received %s payloads since last flush" % self.count)
-        self.stats.set_last_flush_counts(mcount=self.count)
-        self.total_count += self.count
-        self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
+        log.debug("received %s payloads since last flush" % count)
+        self.stats.set_last_flush_counts(mcount=count)
+        self.total_count += count
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
@@ -513,13 +841,16 @@ class MetricsAggregator(Aggregator):
     This is the default aggregator used by the agent collector.
 
     Metric types supported by this aggregator: Gauge, Count, MonotonicCount,
-                                               Counter, Histogram, Set, Rate
+                                               Counter, Histogram, Distribution,
+                                               Set, Rate
     """
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, histogram_sketch_accuracy=None,
+                 set_hll_threshold=None, set_hll_patterns=None, set_hll_precision=None,
+                 clock=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -528,11 +859,17 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_sketch_accuracy,
+            set_hll_threshold,
+            set_hll_patterns,
+            set_hll_precision,
+            clock
         )
         self.sources = defaultdict(set)
         self.metrics = {}
         self.metric_type_to_class = MetricResolver()
+        self.last_export_time = 0
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       timestamp=None, sample_rate=1, source=None):
@@ -546,26 +883,26 @@ class MetricsAggregator(Aggregator):
             source = UNKNOWN_SOURCE
 
         if tags is None:
-            context = (name, tuple(), hostname)
+            context = self.context_registry.context_id(name, tuple(), hostname)
         else:
-            tags = tuple(self.deduplicate_tags(tags))
-            context = (name, tags, hostname)
+            context = self.context_registry.context_id(name, tuple(self.deduplicate_tags(tags)), hostname)
 
         if context not in self.metrics:
             metric_class = self.metric_type_to_class[mtype]
+            name, tags, hostname = self.context_registry.get(context)
             self.metrics[context] = \
-                metric_class(self.formatter, name, tags,
+                metric_class(self.formatter, name, tags or None,
                              hostname, self.metric_config.get(metric_class))
 
         if context not in self.sources[source]:
             self.sources[source].add(context)
 
-        cur_time = time()
+        cur_time = self.clock.refresh()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
-            self.metrics[context].sample(value, sample_rate, timestamp)
+            self.metrics[context].sample(value, sample_rate, timestamp, cur_time)
 
     def gauge(self, name, value, tags=None, hostname=None, timestamp=None, source=None):
         self.submit_metric(name, value, 'g', tags, hostname, timestamp, source)
@@ -592,8 +929,48 @@ class MetricsAggregator(Aggregator):
     def set(self, name, value, tags=None, hostname=None, source=None):
         self.submit_metric(name, value, 's', tags, hostname, source)
 
+    def export_metrics(self):
+        """
+        Return the state of the metrics sampled since the last export, along
+        with the packet count, as plain data that `merge_metrics` can fold
+        into a peer aggregator. The metrics are then reset as a flush would,
+        so that their state is only handed over once.
+        """
+        timestamp = self.clock.refresh()
+        expiry_timestamp = timestamp - self.expiry_seconds
+
+        sampled = {}
+        for context, metric in self.metrics.items():
+            if metric.last_sample_time < expiry_timestamp:
+                self._expire_metric(context)
+            elif metric.last_sample_time >= self.last_export_time:
+                sampled[context] = metric
+        metrics = self._export_metrics(sampled)
+        for metric in sampled.itervalues():
+            metric.flush(timestamp, self.interval)
+
+        count = self.count
+        self.count = 0
+        self.stats.set_last_flush_counts(mcount=count)
+        self.total_count += count
+        self.last_export_time = timestamp
+        return {'metrics': metrics, 'count': count}
+
+    def merge_metrics(self, exported):
+        """ Merge the metrics returned by `export_metrics` on a peer aggregator. """
+        self._merge_metrics(self.metrics, exported['metrics'])
+        self.count += exported['count']
+
+    def _expire_metric(self, context):
+        log.debug("%s hasn't been submitted in %ss. Expiring." %
+                  (self.context_registry.get(context), self.expiry_seconds))
+        del self.metrics[context]
+        self.context_registry.release(context)
+        for contexts in self.sources.itervalues():
+            contexts.discard(context)
+
     def flush(self):
-        timestamp = time()
+        timestamp = self.clock.refresh()
         expiry_timestamp = timestamp - self.expiry_seconds
 
         # Flush points and remove expired metrics. We mutate this dictionary
@@ -601,8 +978,7 @@ class MetricsAggregator(Aggregator):
         metrics = []
         for context, metric in self.metrics.items():
             if metric.last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                del self.metrics[context]
+                self._expire_metric(context)
             else:
                 metrics += metric.flush(timestamp, self.interval)
 
@@ -0,0 +1,25 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from time import time
+
+
+class Clock(object):
+    """
+    The coarse clock of an aggregator, shared by its submit and sample
+    paths: `now` is the time of the last `refresh`, so the system clock is
+    read once per batch of packets instead of several times per packet.
+
+    `time_func` is the time source, tests can pass their own to control it.
+    """
+
+    def __init__(self, time_func=None):
+        self.time_func = time_func or time
+        self.now = self.time_func()
+
+    def refresh(self):
+        """ Read the time source, returns the new `now`. """
+        self.now = self.time_func()
+        return self.now
@@ -0,0 +1,138 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+"""
+JSON-safe encoding of the metric states exported by the aggregators, to
+hand them over to a peer on another host.
+
+Unlike pickle, decoding a payload can't run code: every state is checked
+against the shape its metric type expects, and rejected with a ValueError
+otherwise.
+"""
+from array import array
+import base64
+
+from .types import MetricResolver
+
+HISTOGRAM_TYPES = ('h', 'ms', 'd')
+# Size of the states only made of numbers: gauges, counters, counts and monotonic counts
+NUMERIC_STATE_SIZES = {'g': 3, 'c': 2, 'ct': 2, 'ct-c': 4}
+
+
+def encode_metrics(states):
+    """ Encode the `(name, tags, hostname, type, state)` list of `_export_metrics`. """
+    return [[name, list(tags or ()), hostname, mtype, _encode_state(mtype, state)]
+            for name, tags, hostname, mtype, state in states]
+
+
+def decode_metrics(encoded):
+    """ Decode, and validate, a list returned by `encode_metrics`. """
+    if not isinstance(encoded, list):
+        raise ValueError("Metrics must be a list")
+
+    states = []
+    for metric in encoded:
+        try:
+            name, tags, hostname, mtype, state = metric
+        except (TypeError, ValueError):
+            raise ValueError("Metrics must be [name, tags, hostname, type, state] lists")
+        if not isinstance(name, basestring):
+            raise ValueError("Invalid metric name: %r" % (name,))
+        if not isinstance(tags, list) or not all(isinstance(tag, basestring) for tag in tags):
+            raise ValueError("Invalid tags for %s: %r" % (name, tags))
+        if hostname is not None and not isinstance(hostname, basestring):
+            raise ValueError("Invalid hostname for %s: %r" % (name, hostname))
+        if mtype not in MetricResolver.TYPES:
+            raise ValueError("Unknown type for %s: %r" % (name, mtype))
+        try:
+            state = _decode_state(mtype, state)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError("Invalid state for %s: %r" % (name, e))
+        states.append((name, tuple(tags), hostname, mtype, state))
+    return states
+
+
+def _encode_state(mtype, state):
+    if mtype in HISTOGRAM_TYPES:
+        count, samples, last_sample_time = state
+        if isinstance(samples, array):
+            samples = samples.tolist()
+        else:
+            relative_accuracy, sketch_count, sum_, min_, max_, zeros, positive, negative = samples
+            samples = {
+                'relative_accuracy': relative_accuracy,
+                'count': sketch_count,
+                'sum': sum_,
+                'min': min_,
+                'max': max_,
+                'zeros': zeros,
+                'positive': positive.items(),
+                'negative': negative.items(),
+            }
+        return [count, samples, last_sample_time]
+    if mtype == 's':
+        values, registers, last_sample_time = state
+        if registers is not None:
+            registers = base64.b64encode(bytes(registers))
+        return [values, registers, last_sample_time]
+    return state
+
+
+def _decode_state(mtype, state):
+    if mtype in HISTOGRAM_TYPES:
+        count, samples, last_sample_time = state
+        count = _number(count)
+        if count < 0:
+            raise ValueError("Negative count: %r" % (count,))
+        if isinstance(samples, list):
+            samples = array('d', [_number(value) for value in samples])
+            sample_count = len(samples)
+        else:
+            sample_count = _number(samples['count'])
+            # The min and max of a sketch are only unset while it's empty
+            nullable = not sample_count
+            samples = (
+                _number(samples['relative_accuracy']),
+                sample_count,
+                _number(samples['sum']),
+                _number(samples['min'], nullable),
+                _number(samples['max'], nullable),
+                _number(samples['zeros']),
+                _bins(samples['positive']),
+                _bins(samples['negative']),
+            )
+        # The count is scaled by the sample rates, but a histogram is only
+        # sampled along with its count
+        if count and not sample_count:
+            raise ValueError("A count of %s without samples" % (count,))
+        return (count, samples, _number(last_sample_time, True))
+
+    if mtype == 's':
+        values, registers, last_sample_time = state
+        if not all(isinstance(value, (basestring, int, long, float)) for value in values):
+            raise ValueError("Set values must be strings or numbers")
+        if registers is not None:
+            registers = bytearray(base64.b64decode(registers))
+        return (list(values), registers, _number(last_sample_time, True))
+
+    if mtype == '_dd-r':
+        samples, last_sample_time = state
+        return ([(_number(ts), _number(value)) for ts, value in samples], _number(last_sample_time, True))
+
+    if not isinstance(state, list) or len(state) != NUMERIC_STATE_SIZES[mtype]:
+        raise ValueError("State must be a list of %s numbers" % NUMERIC_STATE_SIZES[mtype])
+    return tuple(_number(value, True) for value in state)
+
+
+def _number(value, nullable=False):
+    if value is None and nullable:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        raise ValueError("Not a number: %r" % (value,))
+    return value
+
+
+def _bins(bins):
+    return dict((int(key), int(_number(n))) for key, n in bins)
@@ -0,0 +1,58 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+
+class ContextCache(object):
+    """
+    Bounded cache of resolved metric contexts, keyed on the raw packet they
+    were parsed from, minus the value.
+
+    It approximates a LRU with two generations of plain dicts, which keeps
+    lookups as cheap as a dict lookup: entries are looked up in the current
+    generation then in the previous one, which promotes them back. When the
+    current generation is full it becomes the previous one, dropping the
+    entries that were not used since the last rotation.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._generation_size = max(size // 2, 1)
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def get(self, key):
+        entry = self._current.get(key)
+        if entry is None:
+            entry = self._previous.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.set(key, entry)
+        self.hits += 1
+        return entry
+
+    def set(self, key, entry):
+        if len(self._current) >= self._generation_size:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = entry
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    def pop_hit_rate(self):
+        """ Returns the hit rate since the last call, None without lookups. """
+        lookups = self.hits + self.misses
+        hits = self.hits
+        self.hits = self.misses = 0
+        if not lookups:
+            return None
+        return float(hits) / lookups
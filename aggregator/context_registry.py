@@ -0,0 +1,130 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from time import time
+
+from .timing_wheel import TimingWheel
+
+
+class ContextRegistry(object):
+    """
+    Gives every unique `(name, tags, hostname)` metric context a small
+    integer ID, and interns the names, tags, tag sets and hostnames they are
+    made of: with many contexts, the same strings and tag tuples are held
+    once instead of once per context.
+
+    IDs are never reused, so an ID held after its context was released
+    can't resolve to another context.
+
+    Contexts may be registered by a thread while another one flushes: the
+    last seen times are only ever updated by the flushing thread, which
+    picks up the new contexts on `expire`. Registering and expiring still
+    have to be serialized by the caller.
+
+    Only a registry created with `track_last_seen` queues the new contexts
+    for `expire`: the other ones are released explicitly, with `release`.
+    """
+
+    def __init__(self, clock=None, track_last_seen=False):
+        # The clock of the aggregator, new contexts are seen at its time
+        self.clock = clock
+        self.track_last_seen = track_last_seen
+        self._id_by_context = {}
+        self._context_by_id = {}
+        self._last_seen = TimingWheel()
+        # (ID, registration time) of the contexts registered since the last expiry
+        self._registered = []
+        self._interned = {}
+        # Contexts released since the interned values were last pruned
+        self._released = 0
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._context_by_id)
+
+    def __contains__(self, context_id):
+        return context_id in self._context_by_id
+
+    def context_id(self, name, tags, hostname):
+        """ Returns the ID of a context, registering it if needed. `tags` is a tuple. """
+        context_id = self._id_by_context.get((name, tags, hostname))
+        if context_id is None:
+            context_id = self._register(name, tags, hostname)
+        return context_id
+
+    def get(self, context_id):
+        """ Returns the interned `(name, tags, hostname)` of a context. """
+        return self._context_by_id[context_id]
+
+    def touch(self, context_id, timestamp):
+        """ Record that the context was sampled at `timestamp`. """
+        if timestamp > self._last_seen.get(context_id, 0):
+            self._last_seen[context_id] = timestamp
+
+    def expire(self, expiry_timestamp, in_use=None):
+        """
+        Release the contexts not seen since `expiry_timestamp`, except the
+        ones for which `in_use(context_id)` is true. Returns the released IDs.
+        """
+        registered, self._registered = self._registered, []
+        for context_id, timestamp in registered:
+            if context_id in self._context_by_id:
+                self.touch(context_id, timestamp)
+
+        expired = []
+        for context_id in self._last_seen.expire(expiry_timestamp):
+            if in_use is not None and in_use(context_id):
+                # Checked again on the next expiry
+                self._last_seen[context_id] = expiry_timestamp
+            else:
+                self.release(context_id)
+                expired.append(context_id)
+        return expired
+
+    def release(self, context_id):
+        context = self._context_by_id.pop(context_id, None)
+        if context is None:
+            return
+        del self._id_by_context[context]
+        self._last_seen.pop(context_id, None)
+
+        # Rather than counting the references to every interned value, the
+        # interned values are rebuilt from the live contexts once as many
+        # contexts were released as there are left.
+        self._released += 1
+        if self._released >= len(self._context_by_id):
+            self._prune_interned()
+
+    def _register(self, name, tags, hostname):
+        context = (self._intern(name), self._intern_tags(tags), self._intern(hostname))
+        context_id = self._next_id
+        self._next_id += 1
+        self._id_by_context[context] = context_id
+        self._context_by_id[context_id] = context
+        if self.track_last_seen:
+            self._registered.append((context_id, self.clock.now if self.clock is not None else time()))
+        return context_id
+
+    def _intern(self, value):
+        return self._interned.setdefault(value, value)
+
+    def _intern_tags(self, tags):
+        interned_tags = self._interned.get(tags)
+        if interned_tags is None:
+            # A new tag set, made of interned tags
+            interned_tags = tuple([self._intern(tag) for tag in tags])
+            self._interned[interned_tags] = interned_tags
+        return interned_tags
+
+    def _prune_interned(self):
+        interned = {}
+        for name, tags, hostname in self._context_by_id.itervalues():
+            interned[name] = name
+            interned[hostname] = hostname
+            interned[tags] = tags
+            for tag in tags:
+                interned[tag] = tag
+        self._interned = interned
+        self._released = 0
@@ -0,0 +1,75 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from hashlib import md5
+from math import log
+import struct
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added to it in a fixed
+    `2^precision` bytes, whatever that number.
+
+    The standard error of the estimate is `1.04 / sqrt(2^precision)`: 1.6%
+    with the default precision of 12, for 4KB. Values are hashed with md5,
+    so the registers of sketches of the same precision can be merged
+    across processes and hosts.
+    """
+    DEFAULT_PRECISION = 12
+    MIN_PRECISION = 4
+    MAX_PRECISION = 16
+
+    def __init__(self, precision=None):
+        self.precision = int(precision or self.DEFAULT_PRECISION)
+        if not self.MIN_PRECISION <= self.precision <= self.MAX_PRECISION:
+            raise ValueError("precision must be between %s and %s, got %s"
+                             % (self.MIN_PRECISION, self.MAX_PRECISION, precision))
+        self.size = 1 << self.precision
+        self.registers = bytearray(self.size)
+        # Bits of the hash left once the register index is taken
+        self._value_bits = 64 - self.precision
+        self._value_mask = (1 << self._value_bits) - 1
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        x = struct.unpack('>Q', md5(value).digest()[:8])[0]
+
+        index = x >> self._value_bits
+        # Position of the leftmost 1 bit in what's left of the hash
+        rank = self._value_bits - (x & self._value_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def cardinality(self):
+        m = self.size
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+
+        registers = self.registers
+        estimate = alpha * m * m / sum([2.0 ** -r for r in registers])
+
+        # Small range correction: count the empty registers instead
+        if estimate <= 2.5 * m:
+            zeros = registers.count(b'\x00')
+            if zeros:
+                estimate = m * log(float(m) / zeros)
+        return int(round(estimate))
+
+    def merge(self, registers):
+        """ Merge the `registers` of a peer sketch of the same precision into this one. """
+        if len(registers) != self.size:
+            raise ValueError("Can't merge sketches of different precisions: %s and %s registers"
+                             % (self.size, len(registers)))
+        self.registers = bytearray(map(max, self.registers, registers))
@@ -0,0 +1,145 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from math import ceil, log
+
+
+class QuantileSketch(object):
+    """
+    A mergeable quantile sketch with bounded memory.
+
+    Values are counted in logarithmic bins: a positive value `v` falls in
+    the bin `k` such that `gamma^(k-1) < v <= gamma^k`, with
+    `gamma = (1 + relative_accuracy) / (1 - relative_accuracy)`, and a bin
+    is read back as `2 * gamma^k / (gamma + 1)`. Any value returned for a
+    rank is therefore within `relative_accuracy` of the exact value at that
+    rank. Negative values are binned the same way on their absolute value.
+
+    The number, sum, minimum and maximum of the values are exact.
+
+    Past `max_bins` bins, the bins of the lowest values are folded into
+    their neighbour: only the low ranks lose their accuracy guarantee. With
+    the default settings this only happens for values spanning more than
+    18 orders of magnitude.
+    """
+    DEFAULT_RELATIVE_ACCURACY = 0.01
+    DEFAULT_MAX_BINS = 2048
+    # Values closer to zero than this are counted as zeros
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=None, max_bins=None):
+        self.relative_accuracy = float(relative_accuracy or self.DEFAULT_RELATIVE_ACCURACY)
+        if not 0 < self.relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be in ]0;1[, got %s" % relative_accuracy)
+        self.max_bins = int(max_bins or self.DEFAULT_MAX_BINS)
+        self.gamma = (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+        self._multiplier = 1 / log(self.gamma)
+
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value > self.MIN_VALUE:
+            key = int(ceil(log(value) * self._multiplier))
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < -self.MIN_VALUE:
+            key = int(ceil(log(-value) * self._multiplier))
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zeros += 1
+
+        if not self.count:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += 1
+        self.sum += value
+
+        if len(self.positive) + len(self.negative) > self.max_bins:
+            self._collapse()
+
+    def value_at_rank(self, rank):
+        """
+        Returns the value at `rank` (0-based) in the sorted values, within
+        `relative_accuracy`. The lowest and highest ranks are exact.
+        """
+        if not self.count:
+            return None
+        if rank <= 0:
+            return self.min
+        if rank >= self.count - 1:
+            return self.max
+
+        # Walk the bins in value order: negatives, zeros, then positives
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-self._bin_value(key), self.min)
+        seen += self.zeros
+        if seen > rank:
+            return 0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(self._bin_value(key), self.max)
+        return self.max
+
+    def get_state(self):
+        """ Return the state of the sketch as plain, picklable data. """
+        return (self.relative_accuracy, self.count, self.sum, self.min, self.max,
+                self.zeros, self.positive, self.negative)
+
+    def merge_state(self, state):
+        """ Merge a state returned by `get_state` on a peer sketch into this one. """
+        relative_accuracy, count, sum_, min_, max_, zeros, positive, negative = state
+        if not count:
+            return
+        if relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches of different accuracies: %s and %s"
+                             % (self.relative_accuracy, relative_accuracy))
+
+        for key, n in positive.iteritems():
+            self.positive[key] = self.positive.get(key, 0) + n
+        for key, n in negative.iteritems():
+            self.negative[key] = self.negative.get(key, 0) + n
+        self.zeros += zeros
+
+        if not self.count:
+            self.min, self.max = min_, max_
+        else:
+            self.min = min(self.min, min_)
+            self.max = max(self.max, max_)
+        self.count += count
+        self.sum += sum_
+
+        if len(self.positive) + len(self.negative) > self.max_bins:
+            self._collapse()
+
+    def _bin_value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def _collapse(self):
+        excess = len(self.positive) + len(self.negative) - self.max_bins
+        # The lowest values first: the negative bins of highest magnitude,
+        # then the positive bins of lowest magnitude.
+        for bins, keys in ((self.negative, sorted(self.negative, reverse=True)),
+                           (self.positive, sorted(self.positive))):
+            folded = min(excess, len(keys) - 1)
+            if folded <= 0:
+                continue
+            into = keys[folded]
+            for key in keys[:folded]:
+                bins[into] += bins.pop(key)
+            excess -= folded
+            if not excess:
+                return
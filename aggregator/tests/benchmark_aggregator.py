@@ -7,7 +7,30 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
+import multiprocessing
+import random
+import resource
+import threading
+import time
+
 from aggregator import MetricsAggregator, MetricsBucketAggregator
+from aggregator.clock import Clock
+from aggregator.tests.test_parser import reference_parse_metric_packet
+
+
+def _peak_rss_growth(build):
+    """ Peak RSS growth, in KB, of a fresh process while `build()` runs and its result is alive. """
+    def measure(result):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        built = build()  # noqa: F841
+        result.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+    result = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(result,))
+    process.start()
+    growth = result.get()
+    process.join()
+    return growth
 
 
 class TestAggregatorPerf(object):
@@ -56,6 +79,188 @@ class TestAggregatorPerf(object):
                     ma.set('set.%s' % j, float(i))
             ma.flush()
 
+    def test_parse_metric_packet_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        packets = [
+            'counter.1:1|c',
+            'gauge.1:12.5|g|#env:prod,role:db',
+            'histogram.1:250|h|@0.5|#env:prod,url:http://example.com:8080/',
+            'timer.1:-3|ms|#env:prod,role:web,host:h1',
+            'multi.1:1|c:2|c:3|c|#env:prod',
+        ] * 1000
+
+        def timed(parse):
+            start = time.time()
+            for _ in xrange(self.FLUSH_COUNT * 10):
+                for packet in packets:
+                    parse(packet)
+            return self.FLUSH_COUNT * 10 * len(packets) / (time.time() - start)
+
+        print "split and repair parser: %.0f packets/s" % timed(reference_parse_metric_packet)
+        print "single-pass parser:      %.0f packets/s" % timed(ma.parse_metric_packet)
+
+    def test_context_cache_perf(self):
+        packets = '\n'.join(
+            'metric.%s:%s|%s|#env:prod,role:db,az:us-east-1a,service:web' % (j, i, t)
+            for i in xrange(100) for j in xrange(self.METRIC_COUNT) for t in ('c', 'g', 'h', 'ms')
+        )
+        nb_packets = packets.count('\n') + 1
+
+        def timed(ma):
+            start = time.time()
+            for _ in xrange(self.FLUSH_COUNT * 10):
+                ma.submit_packet_batch(packets)
+            return self.FLUSH_COUNT * 10 * nb_packets / (time.time() - start)
+
+        print "without context cache: %.0f packets/s" % timed(MetricsBucketAggregator('my.host', context_cache_size=0))
+        print "with context cache:    %.0f packets/s" % timed(MetricsBucketAggregator('my.host'))
+
+    def test_context_memory_perf(self):
+        """
+        Peak RSS growth of an aggregator holding 200k contexts, for each tag
+        profile.
+        """
+        profiles = [
+            # Tag sets shared by the 50 metric names
+            ('shared tag sets', ('metric.%s:1|c|#env:prod,service:web,az:us-east-1a,pod:pod-%s' % (j, i)
+                                 for i in xrange(4000) for j in xrange(50))),
+            # A tag unique to every context
+            ('unique tag sets', ('metric.%s:1|c|#env:prod,service:web,az:us-east-1a,pod:pod-%s' % (i % 50, i)
+                                 for i in xrange(200000))),
+        ]
+        for label, packets in profiles:
+            def build(packets=packets):
+                ma = MetricsBucketAggregator('my.host', interval=10)
+                for packet in packets:
+                    ma.submit_packets(packet)
+                return ma
+            print "%s: %d KB" % (label, _peak_rss_growth(build))
+
+    def test_histogram_sketch_perf(self):
+        """
+        Memory and flush time of hot timers, with exact histograms and with
+        sketches.
+        """
+        nb_contexts, nb_samples = 10, 100000
+        rnd = random.Random(42)
+        samples = [rnd.lognormvariate(3, 1) for _ in xrange(nb_samples)]
+
+        def build(sketch_accuracy):
+            ma = MetricsAggregator('my.host', histogram_sketch_accuracy=sketch_accuracy)
+            for j in xrange(nb_contexts):
+                for value in samples:
+                    # A new float for every sample, as when parsed from a packet
+                    ma.submit_metric('timer.%s' % j, value + 0.0, 'ms')
+            return ma
+
+        for label, sketch_accuracy in (('exact', None), ('sketch (1%)', 0.01)):
+            memory = _peak_rss_growth(lambda: build(sketch_accuracy))
+            ma = build(sketch_accuracy)
+            start = time.time()
+            ma.flush()
+            print "%-11s: %d KB, flush of %d x %d samples in %.1f ms" % (
+                label, memory, nb_contexts, nb_samples, (time.time() - start) * 1000)
+
+    def test_set_hll_perf(self):
+        """
+        Memory and flush time of high cardinality sets, exact and counted in
+        a HyperLogLog.
+        """
+        nb_contexts, nb_values = 20, 50000
+
+        def build(set_hll_threshold):
+            ma = MetricsAggregator('my.host', set_hll_threshold=set_hll_threshold)
+            for j in xrange(nb_contexts):
+                for i in xrange(nb_values):
+                    ma.submit_metric('users.%s' % j, 'user-%s' % i, 's')
+            return ma
+
+        for label, set_hll_threshold in (('exact', None), ('hyperloglog', 1000)):
+            memory = _peak_rss_growth(lambda: build(set_hll_threshold))
+            ma = build(set_hll_threshold)
+            start = time.time()
+            ma.flush()
+            print "%-11s: %d KB, flush of %d x %d unique values in %.1f ms" % (
+                label, memory, nb_contexts, nb_values, (time.time() - start) * 1000)
+
+    def test_counter_expiry_flush_perf(self):
+        """
+        Flush latency with 1M counter contexts, 1% of them submitted again
+        on every interval: the others report zeros until they expire.
+        """
+        nb_contexts, interval, expiry_seconds = 1000000, 10, 60
+        now = [1000]
+        ma = MetricsBucketAggregator('my.host', interval=interval, expiry_seconds=expiry_seconds,
+                                     clock=Clock(lambda: now[0]))
+        for i in xrange(nb_contexts):
+            ma.submit_metric('requests.%s' % i, 1, 'c')
+
+        for _ in xrange(expiry_seconds // interval + 2):
+            now[0] += interval
+            for i in xrange(0, nb_contexts, 100):
+                ma.submit_metric('requests.%s' % i, 1, 'c')
+            start = time.time()
+            metrics = ma.flush()
+            print "flush of %7d metrics in %.0f ms" % (len(metrics), (time.time() - start) * 1000)
+
+    def test_flush_submit_latency_perf(self):
+        """
+        Longest `submit_packet_batch` call of a thread that keeps submitting
+        while 200k contexts are flushed: the flush only holds the lock to
+        swap the buckets out and release the expired contexts.
+        """
+        nb_contexts = 200000
+        now = [1000]
+        ma = MetricsBucketAggregator('my.host', interval=10, clock=Clock(lambda: now[0]))
+        for i in xrange(nb_contexts):
+            ma.submit_metric('requests.%s' % i, 1, 'g')
+        now[0] += 10
+
+        batch = '\n'.join('requests.%s:1|g' % i for i in xrange(100))
+        latencies = []
+        flushing = threading.Event()
+
+        def submit():
+            while flushing.is_set():
+                start = time.time()
+                ma.submit_packet_batch(batch)
+                latencies.append(time.time() - start)
+
+        flushing.set()
+        thread = threading.Thread(target=submit)
+        thread.start()
+        start = time.time()
+        ma.flush()
+        flush_time = time.time() - start
+        flushing.clear()
+        thread.join()
+
+        print "flush of %d contexts in %.0f ms, %d batches submitted meanwhile, longest in %.1f ms" % (
+            nb_contexts, flush_time * 1000, len(latencies), max(latencies) * 1000)
+
+    def test_metric_memory_perf(self):
+        """
+        Bytes per context of each metric type holding a single sample, name,
+        tags and hostname left aside.
+        """
+        nb_contexts = 200000
+        ma = MetricsAggregator('my.host')
+        tags = ('env:prod', 'service:web')
+
+        for mtype in ('g', 'c', 'ct', 'ct-c', '_dd-r', 'h', 's'):
+            metric_class = ma.metric_type_to_class[mtype]
+            config = ma.metric_config.get(metric_class)
+
+            def build(metric_class=metric_class, config=config):
+                metrics = []
+                for _ in xrange(nb_contexts):
+                    metric = metric_class(ma.formatter, 'my.metric', tags, 'my.host', config)
+                    metric.sample(1, 1)
+                    metrics.append(metric)
+                return metrics
+            print "%-15s: %d bytes per context" % (
+                metric_class.__name__, _peak_rss_growth(build) * 1024 / nb_contexts)
+
     def create_event_packet(self, title, text):
         p = "_e{{{title_len},{text_len}}}:{title}|{text}".format(
             title_len=len(title),
@@ -113,6 +318,14 @@ class TestAggregatorPerf(object):
 
 if __name__ == '__main__':
     t = TestAggregatorPerf()
+    t.test_parse_metric_packet_perf()
+    t.test_context_cache_perf()
+    t.test_context_memory_perf()
+    t.test_histogram_sketch_perf()
+    t.test_set_hll_perf()
+    t.test_counter_expiry_flush_perf()
+    t.test_flush_submit_latency_perf()
+    t.test_metric_memory_perf()
     # t.test_dogstatsd_aggregation_perf()
     # t.test_checksd_aggregation_perf()
     t.test_dogstatsd_utf8_events()
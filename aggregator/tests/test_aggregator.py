@@ -5,6 +5,7 @@
 # Copyright 2018 Datadog, Inc.
 
 # stdlib
+import cPickle as pickle
 import random
 import time
 
@@ -14,6 +15,7 @@ import pytest
 # project
 from aggregator import MetricsAggregator
 from aggregator.aggregator import UNKNOWN_SOURCE
+from aggregator.clock import Clock
 from aggregator.formatters import get_formatter
 from aggregator.types import DEFAULT_HISTOGRAM_AGGREGATES
 
@@ -318,18 +320,24 @@ class TestMetricsAggregator():
         assert len(metrics) == 1
         assert metrics[0]['metric'] == 'datadog.agent.running'
 
-    def test_ignore_distribution(self):
+    def test_distribution(self):
         stats = MetricsAggregator('myhost')
-        stats.submit_packets('my.dist:5.0|d')
-        stats.submit_packets('my.other.dist:5.0|dk')
+        for i in xrange(1, 101):
+            stats.submit_packets('my.dist:%s|d' % i)
         stats.submit_packets('my.gauge:1|g')
 
-        # Assert that it's treated normally, and that the distribution is ignored
-        metrics = stats.flush()
-        assert len(metrics) == 2
-        m = metrics[0]
-        assert m['metric'] == 'my.gauge'
-        assert m['points'][0][1] == 1
+        # Assert that the distribution is aggregated like a histogram
+        metrics = self.sort_metrics(stats.flush()[:-1])
+        assert [m['metric'] for m in metrics] == [
+            'my.dist.95percentile', 'my.dist.avg', 'my.dist.count',
+            'my.dist.max', 'my.dist.median', 'my.gauge',
+        ]
+        value_by_name = dict((m['metric'], m['points'][0][1]) for m in metrics)
+        assert value_by_name['my.dist.avg'] == 50.5
+        assert value_by_name['my.dist.count'] == 100
+        assert value_by_name['my.dist.max'] == 100
+        assert abs(value_by_name['my.dist.median'] - 50) <= 0.5
+        assert abs(value_by_name['my.dist.95percentile'] - 95) <= 0.95
 
     def test_rate(self):
         stats = MetricsAggregator('myhost')
@@ -927,3 +935,53 @@ class TestMetricsAggregator():
         assert sources['stats']['bar'] == 2
         assert sources['stats']['haz'] == 1
         assert sources['stats'][UNKNOWN_SOURCE] == 1
+
+    def test_export_and_merge_metrics(self):
+        now = [1000]
+        clock = Clock(lambda: now[0])
+        workers = [MetricsAggregator('myhost', clock=clock) for _ in xrange(2)]
+        for i, worker in enumerate(workers):
+            worker.gauge('my.gauge', i)
+            worker.increment('my.counter', 2)
+            worker.submit_count('my.count', 3)
+            worker.count_from_counter('my.monotonic', 10 * i)
+            worker.count_from_counter('my.monotonic', 10 * i + 5)
+            worker.histogram('my.histogram', i)
+            worker.set('my.set', 'a')
+            worker.set('my.set', i)
+            worker.rate('my.rate', 100 * i)
+            now[0] += 10
+
+        merged = MetricsAggregator('myhost', clock=clock)
+        for worker in workers:
+            merged.merge_metrics(pickle.loads(pickle.dumps(worker.export_metrics())))
+
+        values = dict((m['metric'], m['points'][0][1]) for m in merged.flush()[:-1])
+        # the latest gauge wins, counts add up, sets are merged
+        assert values['my.gauge'] == 1
+        assert values['my.counter'] == 4
+        assert values['my.count'] == 6
+        assert values['my.monotonic'] == 10
+        assert values['my.histogram.max'] == 1
+        assert values['my.histogram.count'] == 2
+        assert values['my.set'] == 3
+        # the rate between the samples of both peers
+        assert values['my.rate'] == 10
+
+        # the state is only handed over once, counters report a zero
+        assert [(m['metric'], m['points'][0][1]) for m in workers[0].flush()[:-1]] == [('my.counter', 0)]
+
+    def test_merge_skips_unmergeable_metrics(self):
+        agent = MetricsAggregator('myhost', histogram_sketch_accuracy=0.02)
+        agent.gauge('a.first', 1)
+        agent.histogram('b.hist', 1)
+        agent.gauge('c.last', 1)
+        agent.increment('d.counter', 1)
+        agent.count = 4
+
+        # a sketched histogram can't be merged into an exact one, the other metrics still are
+        merged = MetricsAggregator('myhost')
+        merged.merge_metrics(agent.export_metrics())
+        assert merged.count == 4
+        assert sorted(m['metric'] for m in merged.flush()[:-1]) == ['a.first', 'c.last', 'd.counter']
+        assert len(merged.context_registry) == 3
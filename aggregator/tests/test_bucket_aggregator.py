@@ -6,12 +6,14 @@
 
 # stdlib
 import random
+import threading
 import time
 
 # project
 from aggregator import (
     MetricsBucketAggregator,
 )
+from aggregator.clock import Clock
 
 from aggregator.types import DEFAULT_HISTOGRAM_AGGREGATES
 
@@ -1044,3 +1046,112 @@ class TestUnitMetricsBucketAggregator():
         stats = MetricsBucketAggregator('myhost', interval=5)
         assert stats.calculate_bucket_start(13284287) == 13284285
         assert stats.calculate_bucket_start(13284280) == 13284280
+
+    def test_export_and_merge_buckets(self):
+        ag_interval = 10
+        timestamp = time.time() - 3 * ag_interval
+        bucket_timestamp = MetricsBucketAggregator('myhost', interval=ag_interval).calculate_bucket_start(timestamp)
+
+        workers = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in xrange(2)]
+        for i, worker in enumerate(workers):
+            worker.submit_metric('my.counter', 5, 'c', tags=['a:b'], timestamp=timestamp)
+            worker.submit_metric('my.gauge', i, 'g', timestamp=timestamp)
+            worker.submit_metric('my.set', 'shared', 's', timestamp=timestamp)
+            worker.submit_metric('my.set', 'worker%s' % i, 's', timestamp=timestamp)
+            for j in xrange(10):
+                worker.submit_metric('my.histogram', i * 10 + j, 'h', timestamp=timestamp)
+            worker.count += 3
+
+        merged = MetricsBucketAggregator('myhost', interval=ag_interval)
+        for worker in workers:
+            merged.merge_buckets(worker.export_buckets())
+            # exporting detaches the buckets from the worker
+            assert worker.metric_by_bucket == {}
+            assert worker.count == 0
+
+        assert merged.count == 6
+
+        metrics = self.sort_metrics(merged.flush())
+        value_by_name = dict((m['metric'], m['points'][0][1]) for m in metrics)
+        for m in metrics:
+            assert m['points'][0][0] == bucket_timestamp
+
+        assert value_by_name['my.counter'] == 10 / float(ag_interval)
+        assert [m['tags'] for m in metrics if m['metric'] == 'my.counter'] == [('a:b',)]
+        assert value_by_name['my.gauge'] in (0, 1)
+        assert value_by_name['my.set'] == 3
+        assert value_by_name['my.histogram.count'] == 20 / float(ag_interval)
+        assert value_by_name['my.histogram.max'] == 19
+        assert value_by_name['my.histogram.median'] == 9
+
+    def test_merge_distributions(self):
+        ag_interval = 10
+        timestamp = time.time() - 3 * ag_interval
+
+        single = MetricsBucketAggregator('myhost', interval=ag_interval)
+        workers = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in xrange(3)]
+        for i in xrange(3000):
+            value = (i * 7919) % 1000 + 0.5
+            single.submit_metric('my.distribution', value, 'd', timestamp=timestamp)
+            workers[i % 3].submit_metric('my.distribution', value, 'd', timestamp=timestamp)
+
+        merged = MetricsBucketAggregator('myhost', interval=ag_interval)
+        for worker in workers:
+            merged.merge_buckets(worker.export_buckets())
+
+        # the sketches merge exactly: same result as a single aggregator
+        assert self.sort_metrics(merged.flush()) == self.sort_metrics(single.flush())
+
+    def test_merge_hll_sets(self):
+        ag_interval = 10
+        timestamp = time.time() - 3 * ag_interval
+
+        workers = [MetricsBucketAggregator('myhost', interval=ag_interval, set_hll_threshold=100)
+                   for _ in xrange(2)]
+        for i in xrange(1000):
+            # a set switched to a hll, and an exact one
+            workers[0].submit_metric('my.set', 'user%s' % i, 's', timestamp=timestamp)
+            workers[1].submit_metric('my.set', 'user%s' % (i % 50), 's', timestamp=timestamp)
+
+        merged = MetricsBucketAggregator('myhost', interval=ag_interval, set_hll_threshold=100)
+        for worker in workers:
+            merged.merge_buckets(worker.export_buckets())
+
+        metrics = merged.flush()
+        value = [m['points'][0][1] for m in metrics if m['metric'] == 'my.set'][0]
+        assert abs(value - 1000) <= 50
+
+    def test_flush_while_submitting(self):
+        # The reporter thread flushes while the server thread keeps submitting
+        now = [1000]
+        stats = MetricsBucketAggregator('myhost', interval=1, clock=Clock(lambda: now[0]))
+        nb_batches = 5000
+
+        def submit():
+            for _ in xrange(nb_batches):
+                stats.submit_packet_batch('my.counter:1|c\nmy.counter:1|c|#a:b\n_e{5,4}:title|text')
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        metrics, events = [], []
+        while thread.is_alive():
+            now[0] += 1
+            metrics += stats.flush()
+            events += stats.flush_events()
+        thread.join()
+        now[0] += 2
+        metrics += stats.flush()
+        events += stats.flush_events()
+
+        # Nothing submitted during a flush is lost
+        assert sum(m['points'][0][1] for m in metrics) == 2 * nb_batches
+        assert len(events) == nb_batches
+
+    def test_merge_unsupported_type(self):
+        stats = MetricsBucketAggregator('myhost', interval=10)
+        # counts are only aggregated by the checks aggregator, they are skipped
+        stats.merge_buckets({'buckets': [(1000, [('my.count', (), 'myhost', 'ct', (1, 1000)),
+                                                 ('my.counter', (), 'myhost', 'c', (1, 1000))])],
+                             'count': 2})
+        assert [m.name for m in stats.metric_by_bucket[1000].values()] == ['my.counter']
+        assert stats.count == 2
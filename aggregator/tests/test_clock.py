@@ -0,0 +1,38 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# project
+from aggregator import MetricsBucketAggregator
+from aggregator.clock import Clock
+
+
+class FakeTime(object):
+    def __init__(self, now):
+        self.now = now
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.now
+
+
+def test_clock_read_once_per_batch():
+    fake_time = FakeTime(1000.5)
+    aggregator = MetricsBucketAggregator('my.host', interval=10, clock=Clock(fake_time))
+    fake_time.reads = 0
+
+    aggregator.submit_packet_batch('\n'.join('my.metric.%s:%s|%s' % (i, i, t)
+                                             for i in xrange(100) for t in ('c', 'g', 'h', 's', 'd')))
+    assert fake_time.reads == 1
+
+    # The clock decides the buckets and the sample times
+    fake_time.now = 1011.5
+    aggregator.submit_packets('my.metric.0:1|c')
+    assert sorted(aggregator.metric_by_bucket) == [1000, 1010]
+    assert aggregator.metric_by_bucket[1010].values()[0].last_sample_time == 1011.5
+
+    fake_time.now = 1020
+    metrics = aggregator.flush()
+    assert set(m['points'][0][0] for m in metrics) == set([1000, 1010])
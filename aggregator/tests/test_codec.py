@@ -0,0 +1,71 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+import json
+
+# testing
+import pytest
+
+# project
+from aggregator import MetricsAggregator
+from aggregator.clock import Clock
+from aggregator.codec import encode_metrics, decode_metrics
+
+
+def test_json_round_trip():
+    now = [1000]
+    kwargs = dict(clock=Clock(lambda: now[0]), set_hll_patterns=['my.hll.*'])
+    source = MetricsAggregator('myhost', **kwargs)
+    for i in xrange(100):
+        source.gauge('my.gauge', i, tags=['a:b'])
+        source.increment('my.counter', i)
+        source.submit_count('my.count', i)
+        source.count_from_counter('my.monotonic', i * 2)
+        source.histogram('my.histogram', i)
+        source.submit_metric('my.distribution', i, 'd')
+        source.set('my.set', i)
+        source.set('my.hll.set', 'user%s' % i)
+        source.rate('my.rate', i)
+        now[0] += 1
+    exported = source.export_metrics()
+
+    over_json = MetricsAggregator('myhost', **kwargs)
+    over_json.merge_metrics({
+        'metrics': decode_metrics(json.loads(json.dumps(encode_metrics(exported['metrics'])))),
+        'count': 0,
+    })
+    in_process = MetricsAggregator('myhost', **kwargs)
+    in_process.merge_metrics({'metrics': exported['metrics'], 'count': 0})
+
+    def values(aggregator):
+        return sorted((m['metric'], m['tags'], m['points'][0][1]) for m in aggregator.flush()[:-1])
+
+    expected = values(in_process)
+    assert len(expected) == 17
+    assert values(over_json) == expected
+
+
+@pytest.mark.parametrize('encoded', [
+    {},
+    [['my.metric', [], None, 'g']],
+    [[1, [], None, 'g', [1, 1000, 1000]]],
+    [['my.metric', 'a:b', None, 'g', [1, 1000, 1000]]],
+    [['my.metric', [], None, 'x', [1, 1000, 1000]]],
+    [['my.metric', [], None, 'g', [1, 1000]]],
+    [['my.metric', [], None, 'c', ['1', 1000]]],
+    [['my.metric', [], None, 'h', [1, {'count': 1}, 1000]]],
+    [['my.metric', [], None, 'h', [5, [], 1000]]],
+    [['my.metric', [], None, 'h', [-1, [1.0], 1000]]],
+    [['my.metric', [], None, 'd', [5, {'relative_accuracy': 0.01, 'count': 0, 'sum': 0, 'min': None,
+                                       'max': None, 'zeros': 0, 'positive': [], 'negative': []}, 1000]]],
+    [['my.metric', [], None, 'd', [1, {'relative_accuracy': 0.01, 'count': 1, 'sum': 1, 'min': None,
+                                       'max': None, 'zeros': 0, 'positive': [[0, 1]], 'negative': []}, 1000]]],
+    [['my.metric', [], None, 's', [[{}], None, 1000]]],
+    [['my.metric', [], None, 's', [[], 'not base64!', 1000]]],
+])
+def test_decode_invalid(encoded):
+    with pytest.raises(ValueError):
+        decode_metrics(encoded)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# project
+from aggregator import MetricsBucketAggregator
+from aggregator.context_cache import ContextCache
+
+
+def test_context_cache_generations():
+    cache = ContextCache(4)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # the current generation is full, it's rotated
+    cache.set('c', 3)
+    assert len(cache) == 3
+    # 'a' is promoted back to the current generation
+    assert cache.get('a') == 1
+    cache.set('d', 4)
+    # 'b' wasn't used since the last rotation, it's dropped
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) <= 4
+
+    assert cache.pop_hit_rate() == 3 / 4.0
+    assert cache.pop_hit_rate() is None
+
+
+PACKETS = [
+    'my.counter:1|c',
+    'my.counter:2|c',
+    'my.counter:3|c|#b:2,a:1',
+    'my.counter:4|c|#a:1,b:2',
+    'my.counter:5|c|#a:1,b:2,a:1',
+    'my.counter:6|c|@0.5|#a:1',
+    'my.counter:7|c|@0.5|#a:1',
+    'my.gauge:1.5|g|#host:other.host,env:prod',
+    'my.gauge:2.5|g|#host:other.host,env:prod',
+    'my.gauge:-3|g|#host:other.host',
+    'my.gauge:1e3|g|#host:other.host',
+    'my.gauge:12abc|g|#host:other.host',
+    'my.gauge:1:2|g|#host:other.host',
+    'my.set:abc|s|#url:http://example.com:8080/',
+    'my.set:def|s|#url:http://example.com:8080/',
+    'my.set:a:b|s|#url:http://example.com:8080/',
+    'my.multi:1|c:2|c|#a:b',
+    'my.multi:3|c:2|c|#a:b',
+    'my.distribution:1|d',
+    'my.distribution:2|d',
+    'my.histogram:1|h||#a',
+    'my.histogram:2|h||#a',
+    'my.histogram:3|h|@abc',
+    u'my.unicode:1|c|#ñ:é',
+    u'my.unicode:2|c|#ñ:é',
+]
+
+
+def exported_state(aggregator):
+    metrics = []
+    for _, bucket_metrics in aggregator.export_buckets()['buckets']:
+        for name, tags, hostname, mtype, state in bucket_metrics:
+            # leave the sample times out
+            state = state[:1] if mtype == 'g' else state[:-1]
+            if mtype == 's':
+                state = (sorted(state[0]),)
+            metrics.append((name, tags, hostname, mtype, state))
+    return sorted(metrics)
+
+
+def test_cached_contexts_are_equivalent():
+    cached = MetricsBucketAggregator('my.host')
+    uncached = MetricsBucketAggregator('my.host', context_cache_size=0)
+    assert uncached.context_cache is None
+
+    for _ in xrange(3):
+        for packet in PACKETS:
+            cached.submit_packet_batch(packet)
+            uncached.submit_packet_batch(packet)
+
+    assert cached.count == uncached.count
+    assert exported_state(cached) == exported_state(uncached)
+    assert cached.context_cache.hits > 0
+
+
+def test_context_cache_metrics():
+    aggregator = MetricsBucketAggregator('my.host')
+    aggregator.submit_packets('my.counter:1|c|#a:b\nmy.counter:2|c|#a:b\nmy.counter:3|c|#a:b')
+
+    metrics = dict(aggregator.context_cache_metrics())
+    assert metrics['datadog.dogstatsd.context_cache.size'] == 1
+    assert metrics['datadog.dogstatsd.context_cache.hit_rate'] == 2 / 3.0
+
+    assert MetricsBucketAggregator('my.host', context_cache_size=0).context_cache_metrics() == []
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# project
+from aggregator import MetricsAggregator, MetricsBucketAggregator
+from aggregator.clock import Clock
+from aggregator.context_registry import ContextRegistry
+
+
+def test_context_ids():
+    registry = ContextRegistry()
+    first = registry.context_id('my.metric', ('a:b', 'c:d'), 'my.host')
+    assert registry.context_id('my.metric', ('a:b', 'c:d'), 'my.host') == first
+    assert registry.context_id('my.metric', ('a:b',), 'my.host') != first
+    assert registry.context_id('my.metric', ('a:b', 'c:d'), 'other.host') != first
+    assert registry.get(first) == ('my.metric', ('a:b', 'c:d'), 'my.host')
+    assert first in registry
+    assert len(registry) == 3
+
+
+def test_context_parts_are_interned():
+    registry = ContextRegistry()
+    # Build equal but distinct strings, as parsed from different packets
+    first = registry.get(registry.context_id(''.join(['my', '.metric']), (''.join(['a', ':b']),), 'my.host'))
+    other = registry.get(registry.context_id(''.join(['my', '.metric']), (''.join(['a', ':b']), 'c:d'), 'my.host'))
+    same_tags = registry.get(registry.context_id('other.metric', (''.join(['a', ':b']),), 'my.host'))
+
+    assert first[0] is other[0]
+    assert first[1][0] is other[1][0]
+    assert first[1] is same_tags[1]
+
+
+def test_release_context():
+    registry = ContextRegistry()
+    first = registry.context_id('my.metric', ('a:b',), 'my.host')
+    second = registry.context_id('my.metric', ('a:b', 'c:d'), 'my.host')
+
+    registry.release(first)
+    assert first not in registry
+    assert registry.get(second) == ('my.metric', ('a:b', 'c:d'), 'my.host')
+    # IDs are never reused
+    assert registry.context_id('my.metric', ('a:b',), 'my.host') not in (first, second)
+
+    registry.release(second)
+    registry.release(second)
+    assert len(registry) == 1
+    registry.release(registry.context_id('my.metric', ('a:b',), 'my.host'))
+    assert len(registry) == 0
+    # the interned values are pruned once enough contexts were released
+    assert registry._interned == {}
+
+
+def test_expire_contexts():
+    registry = ContextRegistry(Clock(lambda: 100), track_last_seen=True)
+    old = registry.context_id('old', (), 'my.host')
+    kept = registry.context_id('kept', (), 'my.host')
+    recent = registry.context_id('recent', (), 'my.host')
+    # Contexts are registered as seen now, and `touch` only moves forward
+    registry.touch(recent, 1000)
+    registry.touch(old, 50)
+
+    assert registry.expire(500, in_use=set([kept]).__contains__) == [old]
+    assert old not in registry
+    assert kept in registry
+    assert recent in registry
+
+
+def test_bucket_aggregator_releases_expired_contexts():
+    now = [1000]
+
+    def set_time(timestamp):
+        now[0] = timestamp
+
+    aggregator = MetricsBucketAggregator('my.host', interval=1, expiry_seconds=5,
+                                         clock=Clock(lambda: now[0]))
+    aggregator.submit_packets('my.gauge:1|g|#a:b\nmy.gauge:2|g|#a:b\nmy.counter:1|c')
+    assert len(aggregator.context_registry) == 2
+
+    set_time(1002)
+    assert len(aggregator.flush()) == 2
+    assert len(aggregator.context_registry) == 2
+
+    # The counter reports zeros until it expires
+    set_time(1010)
+    aggregator.flush()
+    assert len(aggregator.context_registry) == 0
+    assert len(aggregator.context_cache) == 0
+
+    # Expired contexts are registered again
+    aggregator.submit_packets('my.gauge:3|g|#a:b')
+    set_time(1012)
+    metrics = aggregator.flush()
+    assert [(m['metric'], m['tags'], m['points'][0][1]) for m in metrics] == [('my.gauge', ('a:b',), 3)]
+
+
+def test_metrics_aggregator_releases_expired_contexts():
+    now = [1000]
+    aggregator = MetricsAggregator('my.host', expiry_seconds=5, clock=Clock(lambda: now[0]))
+    aggregator.gauge('my.gauge', 1, tags=['a:b'])
+    aggregator.submit_metric('my.counter', 1, 'c', source='foo')
+    assert len(aggregator.context_registry) == 2
+
+    now[0] = 1010
+    aggregator.flush()
+    assert len(aggregator.context_registry) == 0
+    assert aggregator.metrics == {}
+    assert aggregator.sources['foo'] == set()
+
+
+def test_metrics_aggregator_does_not_queue_registrations():
+    now = [1000]
+    aggregator = MetricsAggregator('my.host', expiry_seconds=5, clock=Clock(lambda: now[0]))
+    for i in xrange(1000):
+        aggregator.gauge('my.gauge', i, tags=['id:%s' % i])
+    now[0] = 1010
+    aggregator.flush()
+
+    # Its contexts are released one by one, never expired by the registry
+    assert len(aggregator.context_registry) == 0
+    assert aggregator.context_registry._registered == []
@@ -3,12 +3,36 @@
 # This product includes software developed at Datadog (https://www.datadoghq.com/).
 # Copyright 2018 Datadog, Inc.
 
+from array import array
+import random
+import time
+
+import pytest
+
 # project
-from aggregator import MetricsAggregator
+from aggregator import MetricsAggregator, types
 from aggregator.types import Histogram
 from config import Config
 
 
+class PartitionOnlyNumpy(object):
+    """
+    Stands in for numpy in the histograms: like `numpy.partition`, only the
+    samples at the selected ranks are where they would be once sorted.
+    """
+    @staticmethod
+    def frombuffer(samples):
+        return list(samples)
+
+    @staticmethod
+    def partition(samples, kth):
+        ordered = sorted(samples)
+        partitioned = ordered[::-1]
+        for rank in kth:
+            partitioned[rank] = ordered[rank]
+        return partitioned
+
+
 class TestHistogram():
     def test_default(self):
         stats = MetricsAggregator('myhost')
@@ -143,3 +167,90 @@ class TestHistogram():
         assert value_by_type['max'] == 19
         assert value_by_type['sum'] == 190
         assert value_by_type['95percentile'] == 18
+
+    def test_sketch(self):
+        exact = MetricsAggregator('myhost', histogram_percentiles=[0.5, 0.95, 0.99])
+        sketch = MetricsAggregator('myhost', histogram_percentiles=[0.5, 0.95, 0.99],
+                                   histogram_sketch_accuracy=0.01)
+
+        for i in xrange(1, 1001):
+            exact.submit_packets('myhistogram:{0}|ms'.format(i * 1.5))
+            sketch.submit_packets('myhistogram:{0}|ms'.format(i * 1.5))
+
+        exact_values = dict((m['metric'], m['points'][0][1]) for m in exact.flush()[:-1])
+        sketch_values = dict((m['metric'], m['points'][0][1]) for m in sketch.flush()[:-1])
+
+        assert sorted(sketch_values) == sorted(exact_values)
+        for name in ('myhistogram.max', 'myhistogram.avg', 'myhistogram.count'):
+            assert sketch_values[name] == pytest.approx(exact_values[name])
+        for name in ('myhistogram.median', 'myhistogram.50percentile',
+                     'myhistogram.95percentile', 'myhistogram.99percentile'):
+            assert abs(sketch_values[name] - exact_values[name]) <= 0.01 * exact_values[name]
+
+        # the sketch is reset after a flush
+        assert sketch.flush()[:-1] == []
+
+    def test_exact_order_statistics(self, monkeypatch):
+        # The samples are sorted without numpy
+        monkeypatch.setattr(types, 'numpy', None)
+        self._check_exact_order_statistics()
+
+    def test_exact_order_statistics_partition(self, monkeypatch):
+        # Only the selected ranks are read from the partitioned samples
+        monkeypatch.setattr(types, 'numpy', PartitionOnlyNumpy)
+        self._check_exact_order_statistics()
+
+    def test_exact_order_statistics_numpy(self, monkeypatch):
+        monkeypatch.setattr(types, 'numpy', pytest.importorskip('numpy'))
+        self._check_exact_order_statistics()
+
+    def _check_exact_order_statistics(self):
+        rnd = random.Random(42)
+        samples = [rnd.uniform(-10, 1000) for _ in xrange(1001)]
+        percentiles = [0.01, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=['min', 'max', 'median', 'avg', 'sum', 'count'],
+            histogram_percentiles=percentiles,
+        )
+        for value in samples:
+            stats.submit_metric('myhistogram', value, 'h')
+
+        value_by_type = {}
+        for m in stats.flush()[:-1]:
+            value_by_type[m['metric'][len('myhistogram')+1:]] = m['points'][0][1]
+
+        samples.sort()
+        assert value_by_type['min'] == samples[0]
+        assert value_by_type['max'] == samples[-1]
+        assert value_by_type['median'] == samples[int(round(len(samples)/2 - 1))]
+        assert value_by_type['sum'] == pytest.approx(sum(samples))
+        assert value_by_type['avg'] == pytest.approx(sum(samples) / len(samples))
+        for p in percentiles:
+            assert value_by_type['%spercentile' % int(p * 100)] == samples[int(round(p * len(samples) - 1))]
+
+    def test_flush_without_samples(self):
+        stats = MetricsAggregator('myhost')
+        stats.merge_metrics({'metrics': [('myhistogram', (), 'myhost', 'h', (5, array('d'), time.time()))],
+                             'count': 0})
+        # a count without samples has no order statistics to report
+        assert stats.flush()[:-1] == []
+
+    def test_merge_exact_into_sketch(self):
+        exact = MetricsAggregator('myhost')
+        sketch = MetricsAggregator('myhost', histogram_sketch_accuracy=0.01)
+        for i in xrange(1, 101):
+            exact.submit_metric('myhistogram', i, 'h')
+            sketch.submit_metric('myhistogram', i + 100, 'h')
+
+        # exact samples are added to a sketch, not the other way around
+        sketch.merge_metrics(exact.export_metrics())
+        values = dict((m['metric'], m['points'][0][1]) for m in sketch.flush()[:-1])
+        assert values['myhistogram.count'] == 200
+        assert values['myhistogram.max'] == 200
+        assert abs(values['myhistogram.median'] - 100) <= 1
+
+        sketch.submit_metric('myhistogram', 1, 'h')
+        # a sketch can't be turned back into exact samples, it is skipped
+        exact.merge_metrics(sketch.export_metrics())
+        assert exact.flush()[:-1] == []
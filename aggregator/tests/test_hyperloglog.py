@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import pytest
+
+# project
+from aggregator import MetricsAggregator
+from aggregator.hyperloglog import HyperLogLog
+
+
+@pytest.mark.parametrize('cardinality', [0, 1, 10, 1000, 100000])
+def test_hyperloglog_error(cardinality):
+    hll = HyperLogLog()
+    for i in xrange(cardinality):
+        hll.add('user-%s' % i)
+        # duplicates don't count
+        hll.add('user-%s' % i)
+
+    # 3 standard errors
+    assert abs(hll.cardinality() - cardinality) <= 3 * 0.0163 * cardinality
+    assert len(hll.registers) == 4096
+
+
+def test_hyperloglog_merge():
+    hlls = [HyperLogLog(), HyperLogLog()]
+    for i in xrange(20000):
+        hlls[i % 2].add(i)
+        hlls[0].add(u'é%s' % (i % 100))
+
+    merged = HyperLogLog()
+    for hll in hlls:
+        merged.merge(hll.registers)
+    assert abs(merged.cardinality() - 20100) <= 3 * 0.0163 * 20100
+
+    with pytest.raises(ValueError):
+        merged.merge(HyperLogLog(10).registers)
+
+
+def set_values(stats):
+    return dict((m['metric'], m['points'][0][1]) for m in stats.flush()[:-1])
+
+
+def test_set_hll_patterns():
+    stats = MetricsAggregator('myhost', set_hll_patterns='users.*, sessions')
+    for i in xrange(3):
+        for name in ('users.unique', 'sessions', 'sessions.other'):
+            stats.submit_packets('%s:%s|s' % (name, i))
+
+    # matching sets are counted in a hll from the start
+    modes = dict((metric.name, metric.hll is not None) for metric in stats.metrics.itervalues())
+    assert modes == {'users.unique': True, 'sessions': True, 'sessions.other': False}
+    assert set_values(stats) == {'users.unique': 3, 'sessions': 3, 'sessions.other': 3}
+
+
+def test_set_hll_threshold():
+    stats = MetricsAggregator('myhost', set_hll_threshold=100)
+    for i in xrange(5000):
+        stats.submit_packets('my.set:%s|s' % i)
+    metric = stats.metrics.values()[0]
+    assert metric.hll is not None
+    assert metric.values == set()
+    assert abs(set_values(stats)['my.set'] - 5000) <= 3 * 0.0163 * 5000
+
+    # back to an exact set after the flush
+    for i in xrange(10):
+        stats.submit_packets('my.set:%s|s' % i)
+    assert metric.hll is None
+    assert set_values(stats) == {'my.set': 10}
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+import logging
+import random
+
+# testing
+import pytest
+
+# project
+from aggregator import MetricsBucketAggregator
+from aggregator.aggregator import Aggregator
+
+log = logging.getLogger(__name__)
+
+
+def reference_parse_metric_packet(packet):
+    """
+    The split and repair metric packet parser `Aggregator.parse_metric_packet`
+    must stay equivalent to.
+    """
+    parsed_packets = []
+    name_and_metadata = packet.split(':', 1)
+
+    if len(name_and_metadata) != 2:
+        raise Exception(u'Unparseable metric packet: %s' % packet)
+
+    name = name_and_metadata[0]
+    broken_split = name_and_metadata[1].split(':')
+    data = []
+    partial_datum = None
+    for token in broken_split:
+        # We need to fix the tag groups that got broken by the : split
+        if partial_datum is None:
+            partial_datum = token
+        elif "|" not in token:
+            partial_datum += ":" + token
+        else:
+            data.append(partial_datum)
+            partial_datum = token
+    data.append(partial_datum)
+
+    for datum in data:
+        value_and_metadata = datum.split('|')
+
+        if len(value_and_metadata) < 2:
+            raise Exception(u'Unparseable metric packet: %s' % packet)
+
+        # Submit the metric
+        raw_value = value_and_metadata[0]
+        metric_type = value_and_metadata[1]
+
+        if metric_type in Aggregator.ALLOW_STRINGS:
+            value = raw_value
+        elif len(metric_type) > 0 and metric_type[0] in Aggregator.IGNORE_TYPES:
+            continue
+        else:
+            # Try to cast as an int first to avoid precision issues, then as a
+            # float.
+            try:
+                value = int(raw_value)
+            except ValueError:
+                try:
+                    value = float(raw_value)
+                except ValueError:
+                    # Otherwise, raise an error saying it must be a number
+                    raise Exception(u'Metric value must be a number: %s, %s' % (name, raw_value))
+
+        # Parse the optional values - sample rate & tags.
+        sample_rate = 1
+        tags = None
+        try:
+            for m in value_and_metadata[2:]:
+                # Parse the sample rate
+                if m[0] == '@':
+                    sample_rate = float(m[1:])
+                    # in case it's in a bad state
+                    sample_rate = 1 if sample_rate < 0 or sample_rate > 1 else sample_rate
+                elif m[0] == '#':
+                    tags = tuple(sorted(m[1:].split(',')))
+        except IndexError:
+            log.warning(u'Incorrect metric metadata: metric_name:%s, metadata:%s',
+                        name, u' '.join(value_and_metadata[2:]))
+
+        parsed_packets.append((name, value, metric_type, tags, sample_rate))
+
+    return parsed_packets
+
+
+PACKETS = [
+    'my.counter:1|c',
+    'my.counter:-1|c',
+    'my.counter:+3|c',
+    'my.gauge:1.5|g',
+    'my.gauge:-0.25|g',
+    'my.gauge:.5|g',
+    'my.gauge:1e3|g',
+    'my.gauge:1E-3|g',
+    'my.gauge:nan|g',
+    'my.gauge:inf|g',
+    'my.gauge:-Infinity|g',
+    'my.gauge:NaN|g',
+    'my.gauge: 12 |g',
+    'my.gauge:0x10|g',
+    'my.gauge:12abc|g',
+    'my.gauge:|g',
+    'my.histogram:3|h|@0.5',
+    'my.histogram:3|h|@2',
+    'my.histogram:3|h|@-1',
+    'my.timer:3|ms|@0.1|#a:b,c',
+    'my.set:abc|s',
+    'my.set:a:b|s',
+    'my.distribution:1|d',
+    'my.distribution:1|d|#a:b',
+    'my.metric:1|c|#tag1,tag2',
+    'my.metric:1|c|#tag2,tag1,tag2',
+    'my.metric:1|c|#host:myhost,env:prod',
+    'my.metric:1|c|#url:http://example.com:8080/path,env:prod',
+    'my.metric:1|c|#a::b',
+    'my.metric:1|c|#a:b:c:d',
+    'my.metric:1|c:2|g',
+    'my.metric:1|c:2|g:3|h|#a:b',
+    'my.metric:1|c|#a:b:2|g|#c:d',
+    'my.metric:1|c|@0.5|#a:b:2|g',
+    'my.metric:1|c||#a',
+    'my.metric:1|c|#a|',
+    'my.metric:1|c|x',
+    'my.metric:1|',
+    'my.metric:1',
+    'my.metric',
+    ':1|c',
+    'my.metric::1|c',
+    'my.metric:1|c:',
+    'my.metric:1|c|@abc',
+    'my.metric:1|c|#',
+    'my.metric:1|c|#,',
+    u'my.métric:1|c|#ñ:é',
+    u'my.metric:²|g',
+    u'my.metric:١٢|g',
+]
+
+
+def reference_result(packet):
+    # Compare the reprs: int and float values must not be mixed up, and nan
+    # values never compare equal
+    try:
+        return repr(reference_parse_metric_packet(packet))
+    except Exception as e:
+        return repr((e.__class__, e.args))
+
+
+def parser_result(aggregator, packet):
+    try:
+        return repr(aggregator.parse_metric_packet(packet))
+    except Exception as e:
+        return repr((e.__class__, e.args))
+
+
+@pytest.mark.parametrize('packet', PACKETS)
+def test_parser_matches_reference(packet):
+    aggregator = MetricsBucketAggregator('my.host')
+    assert parser_result(aggregator, packet) == reference_result(packet)
+
+
+def test_parser_matches_reference_fuzz():
+    aggregator = MetricsBucketAggregator('my.host')
+    rng = random.Random(42)
+    alphabet = 'ab19.-+eEn :|#@,'
+    for _ in xrange(20000):
+        packet = 'm:' + ''.join(rng.choice(alphabet) for _ in xrange(rng.randint(0, 16)))
+        assert parser_result(aggregator, packet) == reference_result(packet), packet
@@ -0,0 +1,72 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import random
+
+import pytest
+
+# project
+from aggregator.sketch import QuantileSketch
+
+
+def assert_relative_accuracy(sketch, values):
+    values = sorted(values)
+    for rank in xrange(len(values)):
+        exact = values[rank]
+        assert abs(sketch.value_at_rank(rank) - exact) <= sketch.relative_accuracy * abs(exact) + 1e-12
+
+
+def test_sketch_relative_accuracy():
+    rnd = random.Random(42)
+    values = [rnd.lognormvariate(3, 2) for _ in xrange(5000)]
+    values += [-rnd.expovariate(0.01) for _ in xrange(1000)] + [0] * 100
+
+    sketch = QuantileSketch(0.01)
+    for v in values:
+        sketch.add(v)
+
+    assert sketch.count == len(values)
+    assert sketch.sum == pytest.approx(sum(values))
+    assert sketch.min == min(values)
+    assert sketch.max == max(values)
+    assert_relative_accuracy(sketch, values)
+
+
+def test_sketch_merge():
+    rnd = random.Random(42)
+    values = [rnd.uniform(-100, 1000) for _ in xrange(2000)]
+
+    merged, other = QuantileSketch(), QuantileSketch()
+    for v in values[:500]:
+        merged.add(v)
+    for v in values[500:]:
+        other.add(v)
+    merged.merge_state(other.get_state())
+    # merging an empty sketch is a noop
+    merged.merge_state(QuantileSketch().get_state())
+
+    assert merged.count == len(values)
+    assert merged.min == min(values)
+    assert merged.max == max(values)
+    assert_relative_accuracy(merged, values)
+
+    coarse = QuantileSketch(0.05)
+    coarse.add(1)
+    with pytest.raises(ValueError):
+        merged.merge_state(coarse.get_state())
+
+
+def test_sketch_bounded_bins():
+    sketch = QuantileSketch(0.01, max_bins=100)
+    values = [1.1 ** i for i in xrange(1000)]
+    for v in values:
+        sketch.add(v)
+
+    assert len(sketch.positive) == 100
+    assert sketch.count == len(values)
+    # the lowest ranks were folded, the highest ones keep their accuracy
+    values.sort()
+    for rank in xrange(950, 1000):
+        assert abs(sketch.value_at_rank(rank) - values[rank]) <= 0.01 * values[rank]
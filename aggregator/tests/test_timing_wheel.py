@@ -0,0 +1,42 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# project
+from aggregator.timing_wheel import TimingWheel
+
+
+def test_mapping():
+    wheel = TimingWheel(resolution=10)
+    wheel['a'] = 15
+    wheel['b'] = 42
+    wheel['a'] = 18
+    assert len(wheel) == 2
+    assert 'a' in wheel
+    assert sorted(wheel) == ['a', 'b']
+    assert wheel['a'] == 18
+    assert wheel.get('c', 0) == 0
+
+    assert wheel.pop('a') == 18
+    assert wheel.pop('a', 'missing') == 'missing'
+    assert 'a' not in wheel
+    assert wheel._slots == {4: set(['b'])}
+
+
+def test_expire():
+    wheel = TimingWheel(resolution=10)
+    for key, timestamp in (('old', 5), ('older', 1), ('boundary_old', 21),
+                           ('boundary_new', 25), ('new', 40)):
+        wheel[key] = timestamp
+    # Moves to a more recent slot
+    wheel['older'] = 38
+
+    assert sorted(wheel.expire(25)) == ['boundary_old', 'old']
+    assert sorted(wheel) == ['boundary_new', 'new', 'older']
+    assert sorted(wheel._slots) == [2, 3, 4]
+
+    assert wheel.expire(25) == []
+    assert sorted(wheel.expire(100)) == ['boundary_new', 'new', 'older']
+    assert len(wheel) == 0
+    assert wheel._slots == {}
@@ -0,0 +1,84 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+
+class TimingWheel(object):
+    """
+    A mapping of keys to timestamps, that also files every key in a slot of
+    `resolution` seconds: `expire` only visits the slots older than the
+    expiry time, instead of scanning every key.
+
+    Supports the dict operations the aggregator uses on it.
+    """
+    # Coarse enough that a key seen on every flush rarely changes slot
+    DEFAULT_RESOLUTION = 30
+
+    def __init__(self, resolution=None):
+        self.resolution = resolution or self.DEFAULT_RESOLUTION
+        self._timestamps = {}
+        self._slots = {}
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def __contains__(self, key):
+        return key in self._timestamps
+
+    def __iter__(self):
+        return iter(self._timestamps)
+
+    def __getitem__(self, key):
+        return self._timestamps[key]
+
+    def get(self, key, default=None):
+        return self._timestamps.get(key, default)
+
+    def __setitem__(self, key, timestamp):
+        slot = int(timestamp // self.resolution)
+        previous = self._timestamps.get(key)
+        self._timestamps[key] = timestamp
+        if previous is not None:
+            previous_slot = int(previous // self.resolution)
+            if previous_slot == slot:
+                return
+            self._discard(key, previous_slot)
+
+        keys = self._slots.get(slot)
+        if keys is None:
+            keys = self._slots[slot] = set()
+        keys.add(key)
+
+    def pop(self, key, default=None):
+        timestamp = self._timestamps.pop(key, None)
+        if timestamp is None:
+            return default
+        self._discard(key, int(timestamp // self.resolution))
+        return timestamp
+
+    def _discard(self, key, slot):
+        keys = self._slots[slot]
+        keys.discard(key)
+        if not keys:
+            del self._slots[slot]
+
+    def expire(self, expiry_timestamp):
+        """ Remove the keys with a timestamp older than `expiry_timestamp`, returns them. """
+        expired = []
+        expiry_slot = int(expiry_timestamp // self.resolution)
+        timestamps = self._timestamps
+        for slot in [slot for slot in self._slots if slot <= expiry_slot]:
+            if slot < expiry_slot:
+                # Every key of the slot is older
+                keys = self._slots.pop(slot)
+            else:
+                slot_keys = self._slots[slot]
+                keys = [key for key in slot_keys if timestamps[key] < expiry_timestamp]
+                slot_keys.difference_update(keys)
+                if not slot_keys:
+                    del self._slots[slot]
+            for key in keys:
+                del timestamps[key]
+            expired.extend(keys)
+        return expired
@@ -4,9 +4,19 @@
 # Copyright 2018 Datadog, Inc.
 
 # stdlib
+from array import array
 import logging
 from time import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# project
+from .hyperloglog import HyperLogLog
+from .sketch import QuantileSketch
+
 
 log = logging.getLogger(__name__)
 
@@ -30,19 +40,37 @@ class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    There is a metric object per context, and per bucket in a bucket
+    aggregator: metric classes declare their attributes in `__slots__` so
+    their instances have no `__dict__`, and the configuration shared by all
+    the metrics of a type is referenced, not copied.
     """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'last_sample_time')
 
-    def sample(self, value, sample_rate, timestamp=None):
-        """ Add a point to the given metric. """
+    def sample(self, value, sample_rate, timestamp=None, now=None):
+        """
+        Add a point to the given metric. `now` is the current time, as read
+        by the aggregator clock, the system time if None.
+        """
         raise NotImplementedError()
 
     def flush(self, timestamp, interval):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def get_state(self):
+        """ Return the unflushed state of the metric as plain, picklable data. """
+        raise NotImplementedError()
+
+    def merge_state(self, state):
+        """ Merge a state returned by `get_state` on a peer metric into this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -51,13 +79,24 @@ class Gauge(Metric):
         self.tags = tags
         self.hostname = hostname
         self.last_sample_time = None
-        self.timestamp = time()
+        self.timestamp = None
 
-    def sample(self, value, sample_rate, timestamp=None):
+    def sample(self, value, sample_rate, timestamp=None, now=None):
         self.value = value
-        self.last_sample_time = time()
+        self.last_sample_time = now if now is not None else time()
         self.timestamp = timestamp
 
+    def get_state(self):
+        return (self.value, self.timestamp, self.last_sample_time)
+
+    def merge_state(self, state):
+        value, timestamp, last_sample_time = state
+        # The most recently sampled value wins
+        if value is not None and last_sample_time >= self.last_sample_time:
+            self.value = value
+            self.timestamp = timestamp
+            self.last_sample_time = last_sample_time
+
     def flush(self, timestamp, interval):
         if self.value is not None:
             res = [self.formatter(
@@ -81,6 +120,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -101,6 +141,7 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -110,9 +151,18 @@ class Count(Metric):
         self.hostname = hostname
         self.last_sample_time = None
 
-    def sample(self, value, sample_rate, timestamp=None):
+    def sample(self, value, sample_rate, timestamp=None, now=None):
         self.value = (self.value or 0) + value
-        self.last_sample_time = time()
+        self.last_sample_time = now if now is not None else time()
+
+    def get_state(self):
+        return (self.value, self.last_sample_time)
+
+    def merge_state(self, state):
+        value, last_sample_time = state
+        if value is not None:
+            self.value = (self.value or 0) + value
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
 
     def flush(self, timestamp, interval):
         if self.value is None:
@@ -131,6 +181,7 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -142,7 +193,7 @@ class MonotonicCount(Metric):
         self.count = None
         self.last_sample_time = None
 
-    def sample(self, value, sample_rate, timestamp=None):
+    def sample(self, value, sample_rate, timestamp=None, now=None):
         if self.curr_counter is None:
             self.curr_counter = value
         else:
@@ -154,7 +205,21 @@ class MonotonicCount(Metric):
         if prev is not None and curr is not None:
             self.count = (self.count or 0) + max(0, curr - prev)
 
-        self.last_sample_time = time()
+        self.last_sample_time = now if now is not None else time()
+
+    def get_state(self):
+        return (self.prev_counter, self.curr_counter, self.count, self.last_sample_time)
+
+    def merge_state(self, state):
+        prev_counter, curr_counter, count, last_sample_time = state
+        # The increases seen by the peer add up, but its counter readings
+        # are only taken over by a metric that has none of its own.
+        if count is not None:
+            self.count = (self.count or 0) + count
+        if self.prev_counter is None and self.curr_counter is None:
+            self.prev_counter = prev_counter
+            self.curr_counter = curr_counter
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
 
     def flush(self, timestamp, interval):
         if self.count is None:
@@ -177,6 +242,7 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -186,9 +252,17 @@ class Counter(Metric):
         self.hostname = hostname
         self.last_sample_time = None
 
-    def sample(self, value, sample_rate, timestamp=None):
+    def sample(self, value, sample_rate, timestamp=None, now=None):
         self.value += value * int(1 / sample_rate)
-        self.last_sample_time = time()
+        self.last_sample_time = now if now is not None else time()
+
+    def get_state(self):
+        return (self.value, self.last_sample_time)
+
+    def merge_state(self, state):
+        value, last_sample_time = state
+        self.value += value
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
 
     def flush(self, timestamp, interval):
         try:
@@ -208,57 +282,144 @@ class Counter(Metric):
 
 DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
+# Aggregates a histogram can report, in reporting order, and their type
+HISTOGRAM_AGGREGATE_TYPES = [
+    ('min', MetricTypes.GAUGE),
+    ('max', MetricTypes.GAUGE),
+    ('median', MetricTypes.GAUGE),
+    ('avg', MetricTypes.GAUGE),
+    ('sum', MetricTypes.GAUGE),
+    ('count', MetricTypes.RATE),
+]
 
 class Histogram(Metric):
-    """ A metric to track the distribution of a set of values. """
+    """
+    A metric to track the distribution of a set of values.
+
+    Samples are kept in a typed array, and the median and percentiles are
+    selected from it at flush: with a single partition when numpy is
+    available, with a sort otherwise. If a `sketch_accuracy` is configured,
+    samples are counted in a `QuantileSketch` instead, with bounded memory
+    and a flush independent of the number of samples, and the median and
+    percentiles are within `sketch_accuracy` of the exact ones.
+    """
+    __slots__ = ('count', 'samples', 'sketch_accuracy', 'config')
+    # Sketch accuracy when none is configured, samples are exact if None
+    DEFAULT_SKETCH_ACCURACY = None
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
         self.name = name
         self.count = 0
-        self.samples = []
-        self.aggregates = extra_config['aggregates'] if\
-            extra_config is not None and extra_config.get('aggregates') is not None\
-            else DEFAULT_HISTOGRAM_AGGREGATES
-        self.percentiles = extra_config['percentiles'] if\
-            extra_config is not None and extra_config.get('percentiles') is not None\
-            else DEFAULT_HISTOGRAM_PERCENTILES
+        # The aggregator's histogram config, shared by all its histograms
+        self.config = extra_config
+        self.sketch_accuracy = (extra_config is not None and extra_config.get('sketch_accuracy'))\
+            or self.DEFAULT_SKETCH_ACCURACY
+        self.samples = self._empty_samples()
         self.tags = tags
         self.hostname = hostname
         self.last_sample_time = None
 
-    def sample(self, value, sample_rate, timestamp=None):
+    @property
+    def aggregates(self):
+        if self.config is not None and self.config.get('aggregates') is not None:
+            return self.config['aggregates']
+        return DEFAULT_HISTOGRAM_AGGREGATES
+
+    @property
+    def percentiles(self):
+        if self.config is not None and self.config.get('percentiles') is not None:
+            return self.config['percentiles']
+        return DEFAULT_HISTOGRAM_PERCENTILES
+
+    def _empty_samples(self):
+        if self.sketch_accuracy:
+            return QuantileSketch(self.sketch_accuracy)
+        return array('d')
+
+    def sample(self, value, sample_rate, timestamp=None, now=None):
         self.count += int(1 / sample_rate)
-        self.samples.append(value)
-        self.last_sample_time = time()
+        if self.sketch_accuracy:
+            self.samples.add(value)
+        else:
+            self.samples.append(value)
+        self.last_sample_time = now if now is not None else time()
+
+    def get_state(self):
+        if self.sketch_accuracy:
+            return (self.count, self.samples.get_state(), self.last_sample_time)
+        return (self.count, self.samples, self.last_sample_time)
+
+    def merge_state(self, state):
+        count, samples, last_sample_time = state
+        if isinstance(samples, array):
+            # Exact samples are added one by one to a sketch
+            if self.sketch_accuracy:
+                for value in samples:
+                    self.samples.add(value)
+            else:
+                self.samples.extend(samples)
+        elif self.sketch_accuracy:
+            self.samples.merge_state(samples)
+        else:
+            raise ValueError("Can't merge a sketched histogram into an exact one: %s" % self.name)
+        self.count += count
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
+    def _select(self, ranks):
+        """
+        Returns the samples reordered so that the ones at `ranks` are where
+        they would be once sorted.
+        """
+        if numpy is not None:
+            return numpy.partition(numpy.frombuffer(self.samples), sorted(set(ranks)))
+        return sorted(self.samples)
 
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
-
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        sum_ = sum(self.samples)
-        avg = sum_ / float(length)
-
-        aggregators = [
-            ('min', min_, MetricTypes.GAUGE),
-            ('max', max_, MetricTypes.GAUGE),
-            ('median', med, MetricTypes.GAUGE),
-            ('avg', avg, MetricTypes.GAUGE),
-            ('sum', sum_, MetricTypes.GAUGE),
-            ('count', self.count/interval, MetricTypes.RATE),
-        ]
+        aggregates = self.aggregates
+        length = self.samples.count if self.sketch_accuracy else len(self.samples)
+        if not length:
+            # Counted without any sample, e.g. merged from an invalid state
+            return []
 
-        metric_aggrs = [
-            (agg_name, agg_func, m_type)
-            for agg_name, agg_func, m_type in aggregators
-            if agg_name in self.aggregates
-        ]
+        # Ranks in the sorted samples, a negative rank counts from the end
+        median_rank = int(round(length/2 - 1)) % length
+        percentile_ranks = [int(round(p * length - 1)) % length for p in self.percentiles]
+
+        if self.sketch_accuracy:
+            value_at_rank = self.samples.value_at_rank
+            min_ = self.samples.min
+            max_ = self.samples.max
+        else:
+            ranks = percentile_ranks + [0, length - 1]
+            if 'median' in aggregates:
+                ranks.append(median_rank)
+            value_at_rank = self._select(ranks).__getitem__
+            min_ = value_at_rank(0)
+            max_ = value_at_rank(length - 1)
+
+        # The sum is only computed if `sum` or `avg` are reported
+        sum_ = None
+        metric_aggrs = []
+        for agg_name, m_type in HISTOGRAM_AGGREGATE_TYPES:
+            if agg_name not in aggregates:
+                continue
+            if agg_name == 'min':
+                agg_value = min_
+            elif agg_name == 'max':
+                agg_value = max_
+            elif agg_name == 'median':
+                agg_value = value_at_rank(median_rank)
+            elif agg_name == 'count':
+                agg_value = self.count/interval
+            else:
+                if sum_ is None:
+                    sum_ = self.samples.sum if self.sketch_accuracy else sum(self.samples)
+                agg_value = sum_ if agg_name == 'sum' else sum_ / float(length)
+            metric_aggrs.append((agg_name, agg_value, m_type))
 
         metrics = [self.formatter(
             hostname=self.hostname,
@@ -270,60 +431,125 @@ class Histogram(Metric):
             interval=interval) for suffix, value, metric_type in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, rank in zip(self.percentiles, percentile_ranks):
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
                 tags=self.tags,
                 metric=name,
-                value=val,
+                value=value_at_rank(rank),
                 timestamp=ts,
                 metric_type=MetricTypes.GAUGE,
                 interval=interval,
             ))
 
         # Reset our state.
-        self.samples = []
+        self.samples = self._empty_samples()
         self.count = 0
 
         return metrics
 
 
+class Distribution(Histogram):
+    """
+    A metric to track the distribution of a set of values across hosts or
+    processes: it is always aggregated in a `QuantileSketch`, so the states
+    of several aggregators merge exactly, and its memory and flush don't
+    depend on the number of samples.
+    """
+    __slots__ = ()
+    DEFAULT_SKETCH_ACCURACY = QuantileSketch.DEFAULT_RELATIVE_ACCURACY
+
+
 class Set(Metric):
-    """ A metric to track the number of unique elements in a set. """
+    """
+    A metric to track the number of unique elements in a set.
+
+    Values are kept in a set, unless the metric name matches one of the
+    `hll_patterns`, or the set grows past `hll_threshold` values: they are
+    then counted in a `HyperLogLog`, in a fixed amount of memory and with a
+    bounded error.
+    """
+    __slots__ = ('values', 'hll', 'hll_threshold', 'config')
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
         self.name = name
         self.tags = tags
         self.hostname = hostname
-        self.values = set()
+        # The aggregator's set config, shared by all its sets
+        self.config = extra_config or {}
+        self.hll_threshold = self.config.get('hll_threshold')
+        self._reset()
         self.last_sample_time = None
 
-    def sample(self, value, sample_rate, timestamp=None):
-        self.values.add(value)
-        self.last_sample_time = time()
+    def _reset(self):
+        self.values = set()
+        hll_patterns = self.config.get('hll_patterns')
+        if hll_patterns and hll_patterns.match(self.name):
+            self.hll = HyperLogLog(self.config.get('hll_precision'))
+        else:
+            self.hll = None
+
+    def _switch_to_hll(self):
+        self.hll = HyperLogLog(self.config.get('hll_precision'))
+        for value in self.values:
+            self.hll.add(value)
+        self.values = set()
+
+    def sample(self, value, sample_rate, timestamp=None, now=None):
+        if self.hll is not None:
+            self.hll.add(value)
+        else:
+            self.values.add(value)
+            if self.hll_threshold and len(self.values) > self.hll_threshold:
+                self._switch_to_hll()
+        self.last_sample_time = now if now is not None else time()
+
+    def get_state(self):
+        registers = self.hll.registers if self.hll is not None else None
+        return (list(self.values), registers, self.last_sample_time)
+
+    def merge_state(self, state):
+        values, registers, last_sample_time = state
+        if registers is not None and self.hll is None:
+            self._switch_to_hll()
+
+        if self.hll is not None:
+            for value in values:
+                self.hll.add(value)
+            if registers is not None:
+                self.hll.merge(registers)
+        else:
+            self.values.update(values)
+            if self.hll_threshold and len(self.values) > self.hll_threshold:
+                self._switch_to_hll()
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
 
     def flush(self, timestamp, interval):
-        if not self.values:
+        if self.hll is not None:
+            value = self.hll.cardinality()
+        else:
+            value = len(self.values)
+        if not value:
             return []
         try:
             return [self.formatter(
                 hostname=self.hostname,
                 tags=self.tags,
                 metric=self.name,
-                value=len(self.values),
+                value=value,
                 timestamp=timestamp,
                 metric_type=MetricTypes.GAUGE,
                 interval=interval,
             )]
         finally:
-            self.values = set()
+            self._reset()
 
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -333,11 +559,21 @@ class Rate(Metric):
         self.samples = []
         self.last_sample_time = None
 
-    def sample(self, value, sample_rate, timestamp=None):
-        ts = time()
+    def sample(self, value, sample_rate, timestamp=None, now=None):
+        ts = now if now is not None else time()
         self.samples.append((int(ts), value))
         self.last_sample_time = ts
 
+    def get_state(self):
+        return (list(self.samples), self.last_sample_time)
+
+    def merge_state(self, state):
+        samples, last_sample_time = state
+        # The rate is computed from the two most recent samples. The sample
+        # kept by the peer from its last flush may have been merged already.
+        self.samples = sorted(set(self.samples).union(samples))
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
     def _rate(self, sample1, sample2):
         interval = sample2[0] - sample1[0]
         if interval == 0:
@@ -379,6 +615,7 @@ class TextualMetricTypes(object):
     GAUGE = 'g'
     HISTOGRAM = 'h'
     HISTOGRAM_TIMING = 'ms'
+    DISTRIBUTION = 'd'
     MONOTONIC_COUNT = 'ct-c',
     RATE = '_dd-r',
     SET = 's'
@@ -392,6 +629,7 @@ class MetricResolver(object):
         'g': Gauge,
         'h': Histogram,
         'ms': Histogram,
+        'd': Distribution,
         'ct-c': MonotonicCount,
         '_dd-r': Rate,
         's': Set,
@@ -413,6 +651,13 @@ class MetricResolver(object):
             return None
         return self.TYPES.get(mtype)
 
+    def get_type_from_class(self, metric_class):
+        """ Returns a textual type resolving to `metric_class`, or None """
+        for mtype, cls in self.TYPES.iteritems():
+            if cls is metric_class:
+                return mtype
+        return None
+
 
 class BucketMetricResolver(MetricResolver):
     TYPES = {
@@ -420,5 +665,6 @@ class BucketMetricResolver(MetricResolver):
         'c': Counter,
         'h': Histogram,
         'ms': Histogram,
+        'd': Distribution,
         's': Set,
     }
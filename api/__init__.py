@@ -4,5 +4,6 @@
 # Copyright 2018 Datadog, Inc.
 
 from server import APIServer
+from gateway import AggregationGateway
 
-__all__ = ["APIServer"]
+__all__ = ["APIServer", "AggregationGateway"]
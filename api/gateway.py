@@ -0,0 +1,88 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import hmac
+import json
+import logging
+import Queue
+import zlib
+
+from aggregator.codec import decode_metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class AggregationGateway(object):
+    """
+    Collects the metric states posted by the agents that report to this one.
+
+    The payloads are decoded as they are received, and merged by context
+    into the aggregator of this agent right before it flushes, from the
+    flushing thread: their series are forwarded upstream in its payloads.
+
+    Exposes the same `merge_into` interface as the dogstatsd `WorkerPool`.
+    """
+    ENDPOINT = r"/gateway/v1/aggregates"
+    DEFAULT_QUEUE_SIZE = 1000
+    # Bound on a decompressed payload
+    MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, api_key, queue_size=None):
+        self.api_key = api_key
+        self.payloads = Queue.Queue(int(queue_size or self.DEFAULT_QUEUE_SIZE))
+
+    def authorized(self, api_key):
+        """ Agents report with the API key of the gateway. """
+        return bool(api_key) and hmac.compare_digest(str(api_key), str(self.api_key))
+
+    def submit(self, body, compressed=False):
+        """
+        Decode a payload posted by an agent and queue it until the next flush.
+
+        Raises a ValueError if the payload is invalid, Queue.Full if too many
+        payloads are already waiting.
+        """
+        if compressed:
+            decompressor = zlib.decompressobj()
+            try:
+                body = decompressor.decompress(body, self.MAX_PAYLOAD_SIZE)
+            except zlib.error as e:
+                raise ValueError("Invalid compressed payload: %s" % e)
+            if decompressor.unconsumed_tail:
+                raise ValueError("Payload larger than %s bytes once decompressed" % self.MAX_PAYLOAD_SIZE)
+
+        payload = json.loads(body)
+        if not isinstance(payload, dict):
+            raise ValueError("Payload must be an object")
+        metrics = decode_metrics(payload.get('metrics', []))
+        count = payload.get('count', 0)
+        if not isinstance(count, (int, long)):
+            raise ValueError("Invalid packet count: %r" % (count,))
+        events = payload.get('events', [])
+        service_checks = payload.get('service_checks', [])
+        for items in (events, service_checks):
+            if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+                raise ValueError("Events and service checks must be lists of objects")
+
+        self.payloads.put_nowait((metrics, count, events, service_checks))
+
+    def merge_into(self, aggregator):
+        """ Merge the payloads received since the last call into `aggregator`. """
+        while True:
+            try:
+                metrics, count, events, service_checks = self.payloads.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                # The metrics that can't be merged are skipped one by one
+                aggregator.merge_metrics({'metrics': metrics, 'count': count})
+            except Exception:
+                log.exception("Could not merge the metrics of an agent")
+            aggregator.events.extend(events)
+            aggregator.event_count += len(events)
+            aggregator.service_checks.extend(service_checks)
+            aggregator.service_check_count += len(service_checks)
@@ -4,6 +4,7 @@
 # Copyright 2018 Datadog, Inc.
 
 import logging
+import Queue
 import tornado
 import json
 
@@ -28,3 +29,35 @@ class APIStatusHandler(tornado.web.RequestHandler):
                 stats['checks'][check] = {'metrics': values}
 
         self.write(json.dumps(stats))
+
+
+@tornado.web.stream_request_body
+class GatewayAggregatesHandler(tornado.web.RequestHandler):
+    """
+    Receives the metric states of the agents reporting to an `AggregationGateway`.
+
+    The body is streamed so that the API key is checked before it is read.
+    """
+    def initialize(self, gateway):
+        self._gateway = gateway
+        self._chunks = []
+
+    def prepare(self):
+        if not self._gateway.authorized(self.request.headers.get('DD-Api-Key')):
+            raise tornado.web.HTTPError(403)
+
+    def data_received(self, chunk):
+        self._chunks.append(chunk)
+
+    def post(self):
+        compressed = self.request.headers.get('Content-Encoding') == 'deflate'
+        try:
+            self._gateway.submit(b''.join(self._chunks), compressed)
+        except ValueError as e:
+            # Dropped by the agent
+            raise tornado.web.HTTPError(400, "Invalid payload: %s", e)
+        except Queue.Full:
+            # Retried later by the agent
+            raise tornado.web.HTTPError(503, "Too many payloads waiting for the next flush")
+
+        self.set_status(202)
@@ -8,7 +8,7 @@ import logging
 import tornado.ioloop
 import tornado.web
 
-from .handlers import APIStatusHandler
+from .handlers import APIStatusHandler, GatewayAggregatesHandler
 
 
 log = logging.getLogger(__name__)
@@ -16,12 +16,16 @@ log = logging.getLogger(__name__)
 
 class APIServer(object):
 
-    def __init__(self, port, aggregator_stats):
+    def __init__(self, port, aggregator_stats, gateway=None):
         # start API
         self._port = port
-        self._app = tornado.web.Application([
+        handlers = [
             (r"/status", APIStatusHandler, dict(aggregator_stats=aggregator_stats)),
-        ])
+        ]
+        if gateway is not None:
+            # Aggregation gateway mode: other agents report through this one
+            handlers.append((gateway.ENDPOINT, GatewayAggregatesHandler, dict(gateway=gateway)))
+        self._app = tornado.web.Application(handlers)
         self._ioloop = tornado.ioloop.IOLoop.current()
 
     def stop(self):
@@ -0,0 +1,144 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+import json
+import socket
+import threading
+import time
+import zlib
+
+# 3p
+import requests
+import tornado.ioloop
+import tornado.web
+
+# project
+from aggregator import MetricsAggregator
+from api import APIServer, AggregationGateway
+from forwarder import Forwarder
+from serialize import Serializer, GatewaySerializer
+
+API_KEY = 'abcdefghijklmnopqrstuvwxyz012345'
+
+
+class StandInIntakeHandler(tornado.web.RequestHandler):
+    """ Records the payloads posted to the Datadog API. """
+    def initialize(self, received):
+        self._received = received
+
+    def post(self):
+        body = self.request.body
+        if self.request.headers.get('Content-Encoding') == 'deflate':
+            body = zlib.decompress(body)
+        self._received.append((self.request.path, json.loads(body)))
+        self.set_status(202)
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.05)
+
+
+class LocalServers(object):
+    """ The API server of a gateway and a stand-in intake, on an IOLoop of their own. """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.gateway_url = 'http://127.0.0.1:%s' % _free_port()
+        self.intake_url = 'http://127.0.0.1:%s' % _free_port()
+        self.received = []
+        self._api = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        tornado.ioloop.IOLoop().make_current()
+        intake = tornado.web.Application([
+            (r"/(?:api/v1/.*|intake/)", StandInIntakeHandler, dict(received=self.received)),
+        ])
+        intake.listen(int(self.intake_url.rsplit(':', 1)[1]), '127.0.0.1')
+        self._api = APIServer(int(self.gateway_url.rsplit(':', 1)[1]), None, gateway=self.gateway)
+        self._api._ioloop.add_callback(self._started.set)
+        self._api.run()
+
+    def __enter__(self):
+        self._thread.start()
+        self._started.wait(10)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._api._ioloop.add_callback(self._api.stop)
+        self._thread.join(10)
+
+
+def test_agents_report_through_gateway():
+    gateway = AggregationGateway(API_KEY)
+    with LocalServers(gateway) as servers:
+        forwarder = Forwarder(API_KEY, servers.gateway_url, nb_worker=1)
+        forwarder.start()
+        for i in xrange(3):
+            agent = MetricsAggregator('agent-%s' % i)
+            agent.increment('fleet.requests', 10, hostname='')
+            agent.gauge('system.load', i)
+            agent.event('Deployed', 'on agent-%s' % i)
+            GatewaySerializer(agent, None, forwarder).serialize_and_push()
+        _wait_for(lambda: gateway.payloads.qsize() == 3)
+        forwarder.stop()
+
+        aggregator = MetricsAggregator('gateway')
+        gateway.merge_into(aggregator)
+        upstream = Forwarder(API_KEY, servers.intake_url, nb_worker=1)
+        upstream.start()
+        Serializer(aggregator, upstream, compress=True).serialize_and_push()
+        _wait_for(lambda: len(servers.received) == 3)
+        upstream.stop()
+
+    payloads = dict(servers.received)
+    values = sorted((s['metric'], s['host'], s['points'][0][1]) for s in payloads['/api/v1/series']['series'])
+    # The host-less counter of every agent is merged into a single series
+    assert values == [
+        ('datadog.agent.running', 'agent-0', 1),
+        ('datadog.agent.running', 'agent-1', 1),
+        ('datadog.agent.running', 'agent-2', 1),
+        ('datadog.agent.running', 'gateway', 1),
+        ('fleet.requests', '', 30),
+        ('system.load', 'agent-0', 0),
+        ('system.load', 'agent-1', 1),
+        ('system.load', 'agent-2', 2),
+    ]
+    assert len(payloads['/intake/']['events']['api']) == 3
+
+
+def test_gateway_rejects_payloads():
+    gateway = AggregationGateway(API_KEY, queue_size=1)
+    with LocalServers(gateway) as servers:
+        url = servers.gateway_url + AggregationGateway.ENDPOINT
+        payload = json.dumps({'metrics': [['my.gauge', [], 'myhost', 'g', [1, None, 1000]]]})
+
+        assert requests.post(url, payload).status_code == 403
+        assert requests.post(url, payload, headers={'DD-Api-Key': 'wrong'}).status_code == 403
+
+        headers = {'DD-Api-Key': API_KEY}
+        assert requests.post(url, '{"metrics": [["my.gauge"]]}', headers=headers).status_code == 400
+        # a histogram counted without samples
+        histogram = json.dumps({'metrics': [['my.histogram', [], 'myhost', 'h', [5, [], time.time()]]]})
+        assert requests.post(url, histogram, headers=headers).status_code == 400
+        assert requests.post(url, payload, headers=dict(headers, **{'Content-Encoding': 'deflate'})).status_code == 400
+
+        assert requests.post(url, payload, headers=headers).status_code == 202
+        # Retried by the agent once the gateway has flushed
+        assert requests.post(url, payload, headers=headers).status_code == 503
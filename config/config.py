@@ -151,6 +151,9 @@ class Config(object):
     def validate(self):
         self.validate_histogram_aggregates()
         self.validate_histogram_percentiles()
+        self.validate_histogram_sketch_accuracy()
+        self.validate_set_hll_threshold()
+        self.validate_set_hll_precision()
 
     def validate_histogram_aggregates(self):
         aggregates_config = self.data.get('histogram_aggregates')
@@ -213,6 +216,58 @@ class Config(object):
 
         self.data['histogram_percentiles'] = result
 
+    def validate_histogram_sketch_accuracy(self):
+        accuracy_config = self.data.get('histogram_sketch_accuracy')
+
+        if not accuracy_config:
+            return
+        try:
+            accuracy = float(accuracy_config)
+            if accuracy <= 0 or accuracy >= 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            log.warning("Bad histogram sketch accuracy {0}, must be float in ]0;1[ - ignoring"
+                        .format(accuracy_config))
+            self.data.pop('histogram_sketch_accuracy')
+            return
+
+        self.data['histogram_sketch_accuracy'] = accuracy
+
+    def validate_set_hll_threshold(self):
+        threshold_config = self.data.get('set_hll_threshold')
+
+        if not threshold_config:
+            return
+        try:
+            threshold = int(threshold_config)
+            if threshold <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            log.warning("Bad set HLL threshold {0}, must be a positive integer - ignoring"
+                        .format(threshold_config))
+            self.data.pop('set_hll_threshold')
+            return
+
+        self.data['set_hll_threshold'] = threshold
+
+    def validate_set_hll_precision(self):
+        precision_config = self.data.get('set_hll_precision')
+
+        if not precision_config:
+            return
+        try:
+            precision = int(precision_config)
+            # The precisions supported by aggregator.hyperloglog
+            if precision < 4 or precision > 16:
+                raise ValueError
+        except (TypeError, ValueError):
+            log.warning("Bad set HLL precision {0}, must be integer in [4;16] - ignoring"
+                        .format(precision_config))
+            self.data.pop('set_hll_precision')
+            return
+
+        self.data['set_hll_precision'] = precision
+
     def add_provider(self, source, provider):
         """ Adds ConfigProvider for check configurations """
         if not isinstance(provider, ConfigProvider):
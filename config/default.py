@@ -61,18 +61,41 @@ def init(config):
         'aggregator_expiry_seconds': DEFAULT_AGGREGATOR_EXPIRY_SECS,
         'recent_point_threshold': DEFAULT_RECENT_POINT_THRESHOLD,
         'bind_host': DEFAULT_BIND_HOST,
+        # Sets switch to a HyperLogLog sketch past this many values, or when
+        # their name matches one of these patterns
+        'set_hll_threshold': None,
+        'set_hll_patterns': None,
+        'set_hll_precision': None,
         'proxy': {
             'http': None,
             'https': None,
         },
+        'gateway': {
+            # Report to the aggregation gateway at this URL rather than to `dd_url`
+            'url': None,
+            # Act as an aggregation gateway for other agents, on the API port
+            'enabled': False,
+            'queue_size': None,
+        },
         'dogstatsd': {
             'port': DEFAULT_DOGSTATSD_PORT,
             'non_local_traffic': False,
             'forward_host': None,
             'forward_port': None,
+            'forward_hosts': None,
+            'forward_queue_size': None,
+            'forward_mtu': None,
             'so_rcvbuf': None,
             'metric_namespace': None,
             'utf8_decoding': False,
+            'context_cache_size': None,
+            'batch_size': None,
+            'workers': 1,
+            'socket': None,
+            'tcp_port': None,
+            'packet_workers': 0,
+            'packet_queue_size': None,
+            'capture_path': None,
         },
     }
 
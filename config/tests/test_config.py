@@ -223,6 +223,64 @@ class TestConfig():
         os.close(fd)
         os.remove(tmpfile)
 
+    def test_validate_sketch_accuracy(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, "---\ntest: 123\nhistogram_sketch_accuracy: '0.02'")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+
+        conf.load()
+
+        assert conf.get("histogram_sketch_accuracy") == 0.02
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_sketch_accuracy_badval(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, "---\ntest: 123\nhistogram_sketch_accuracy: 1.5")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+
+        conf.load()
+
+        assert conf.get("histogram_sketch_accuracy") is None
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_set_hll(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, "---\ntest: 123\nset_hll_threshold: '1000'\nset_hll_precision: '14'")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+
+        conf.load()
+
+        assert conf.get("set_hll_threshold") == 1000
+        assert conf.get("set_hll_precision") == 14
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_set_hll_badval(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, "---\ntest: 123\nset_hll_threshold: -1\nset_hll_precision: 20")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+
+        conf.load()
+
+        assert conf.get("set_hll_threshold") is None
+        assert conf.get("set_hll_precision") is None
+
+        os.close(fd)
+        os.remove(tmpfile)
+
     def test_config_providers(self, conf):
         provider = DummyConfigProvider()
         file_provider = FileConfigProvider()
@@ -22,7 +22,9 @@ from utils.network import get_proxy
 from dogstatsd import (
     Server,
     Reporter,
+    WorkerPool,
 )
+from dogstatsd.relay import parse_destinations
 from dogstatsd.constants import (
     DOGSTATSD_FLUSH_INTERVAL,
     DOGSTATSD_AGGREGATOR_BUCKET_SIZE,
@@ -48,9 +50,19 @@ def init_dogstatsd(config):
     port = config['dogstatsd']['port']
     forward_to_host = config['dogstatsd'].get('forward_host')
     forward_to_port = config['dogstatsd'].get('forward_port')
+    forward_to_hosts = parse_destinations(config['dogstatsd'].get('forward_hosts'))
+    forward_queue_size = config['dogstatsd'].get('forward_queue_size')
+    forward_mtu = config['dogstatsd'].get('forward_mtu')
     non_local_traffic = config['dogstatsd'].get('non_local_traffic')
     so_rcvbuf = config['dogstatsd'].get('so_rcvbuf')
     utf8_decoding = config['dogstatsd'].get('utf8_decoding')
+    batch_size = config['dogstatsd'].get('batch_size')
+    socket_path = config['dogstatsd'].get('socket')
+    tcp_port = config['dogstatsd'].get('tcp_port')
+    packet_workers = config['dogstatsd'].get('packet_workers')
+    packet_queue_size = config['dogstatsd'].get('packet_queue_size')
+    capture_path = config['dogstatsd'].get('capture_path')
+    workers = int(config['dogstatsd'].get('workers') or 1)
 
     interval = DOGSTATSD_FLUSH_INTERVAL
     aggregator_interval = DOGSTATSD_AGGREGATOR_BUCKET_SIZE
@@ -65,26 +77,28 @@ def init_dogstatsd(config):
         dd_url,
         proxies=proxies,
     )
-    forwarder.start()
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
+    aggregator_kwargs = dict(
+        hostname=hostname,
+        interval=aggregator_interval,
         recent_point_threshold=recent_point_threshold,
         formatter=get_formatter(config),
         histogram_aggregates=config.get('histogram_aggregates'),
         histogram_percentiles=config.get('histogram_percentiles'),
-        utf8_decoding=utf8_decoding
+        histogram_sketch_accuracy=config.get('histogram_sketch_accuracy'),
+        set_hll_threshold=config.get('set_hll_threshold'),
+        set_hll_patterns=config.get('set_hll_patterns'),
+        set_hll_precision=config.get('set_hll_precision'),
+        utf8_decoding=utf8_decoding,
+        context_cache_size=config['dogstatsd'].get('context_cache_size'),
     )
+    aggregator = MetricsBucketAggregator(**aggregator_kwargs)
     # serializer
     serializer = Serializer(
         aggregator,
         forwarder,
     )
 
-    reporter = Reporter(interval, aggregator, serializer, api_key,
-                        use_watchdog=False, hostname=hostname)
-
     # NOTICE: when `non_local_traffic` is passed we need to bind to any interface on the box. The forwarder uses
     # Tornado which takes care of sockets creation (more than one socket can be used at once depending on the
     # network settings), so it's enough to just pass an empty string '' to the library.
@@ -94,8 +108,39 @@ def init_dogstatsd(config):
     if non_local_traffic:
         server_host = '0.0.0.0'
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host,
-                    forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf)
+    server_kwargs = dict(
+        host=server_host,
+        port=port,
+        forward_to_host=forward_to_host,
+        forward_to_port=forward_to_port,
+        forward_to_hosts=forward_to_hosts,
+        relay_queue_size=forward_queue_size,
+        relay_mtu=forward_mtu,
+        so_rcvbuf=so_rcvbuf,
+        batch_size=batch_size,
+        socket_path=socket_path,
+        tcp_port=tcp_port,
+        packet_workers=packet_workers,
+        packet_queue_size=packet_queue_size,
+        capture_path=capture_path,
+    )
+
+    # With several workers, each process binds the port with SO_REUSEPORT and
+    # aggregates on its own; the reporter merges their buckets before flushing.
+    worker_pool = None
+    if workers > 1:
+        worker_pool = WorkerPool(workers, aggregator_kwargs, server_kwargs)
+        # Forked before any thread is started
+        worker_pool.start_workers()
+        server = worker_pool
+    else:
+        server = Server(aggregator, **server_kwargs)
+
+    forwarder.start()
+
+    reporter = Reporter(interval, aggregator, serializer, api_key,
+                        use_watchdog=False, hostname=hostname, worker_pool=worker_pool,
+                        server=server)
 
     return reporter, server, forwarder
 
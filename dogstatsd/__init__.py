@@ -5,8 +5,10 @@
 
 from .server import Server
 from .reporter import Reporter
+from .workers import WorkerPool
 
 __all__ = [
     "Server",
     "Reporter",
+    "WorkerPool",
 ]
@@ -0,0 +1,25 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+
+class BufferPool(object):
+    """
+    A pool of preallocated bytearrays for `socket.recv_into`, so receiving
+    doesn't allocate a new string for every datagram.
+    """
+
+    def __init__(self, buffer_size, size=1):
+        self.buffer_size = buffer_size
+        self._buffers = [bytearray(buffer_size) for _ in xrange(size)]
+
+    def acquire(self):
+        try:
+            return self._buffers.pop()
+        except IndexError:
+            # Every buffer is in use, grow the pool
+            return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        self._buffers.append(buf)
@@ -0,0 +1,79 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+"""
+Binary capture files of the traffic received by dogstatsd.
+
+A capture starts with the `MAGIC` header, followed by one record per packet:
+its receive timestamp (little-endian double), its length (little-endian
+unsigned int), then the packet itself.
+
+Every record is replayed as a single datagram: the payloads read from a
+stream are recorded as several records of whole lines, each no larger than
+a datagram the server reads in full.
+"""
+import struct
+import time
+
+MAGIC = 'DSDCAP01'
+RECORD_HEADER = struct.Struct('<dI')
+
+
+class CaptureWriter(object):
+    """ Appends the received packets, with their timestamp, to a capture file. """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self.count = 0
+
+    def record(self, packet, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._file.write(RECORD_HEADER.pack(timestamp, len(packet)))
+        self._file.write(packet)
+        self.count += 1
+
+    def record_stream(self, payload, max_size, timestamp=None):
+        """ Records the newline delimited lines of `payload` in records of at most `max_size` bytes. """
+        if timestamp is None:
+            timestamp = time.time()
+        lines = []
+        size = 0
+        for line in payload.splitlines():
+            if not line:
+                continue
+            if lines and size + 1 + len(line) > max_size:
+                self.record('\n'.join(lines), timestamp)
+                lines = []
+                size = 0
+            # A line longer than `max_size` is still recorded, on its own
+            size += len(line) + (1 if lines else 0)
+            lines.append(line)
+        if lines:
+            self.record('\n'.join(lines), timestamp)
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """ Yields the `(timestamp, packet)` records of a capture file. """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a dogstatsd capture file' % path)
+
+        header_size = RECORD_HEADER.size
+        while True:
+            header = f.read(header_size)
+            if len(header) < header_size:
+                # End of the file, or a record cut short when the capture stopped
+                return
+            timestamp, length = RECORD_HEADER.unpack(header)
+            packet = f.read(length)
+            if len(packet) < length:
+                return
+            yield timestamp, packet
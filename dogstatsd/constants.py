@@ -5,3 +5,9 @@
 
 DOGSTATSD_FLUSH_INTERVAL = 10
 DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
+
+# Maximum number of datagrams drained from a socket on a single wake-up.
+DOGSTATSD_RECV_BATCH_SIZE = 32
+
+# Maximum number of datagram batches waiting for the packet workers.
+DOGSTATSD_PACKET_QUEUE_SIZE = 1024
@@ -0,0 +1,247 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+"""
+Load generator for a running dogstatsd server.
+
+    python -m dogstatsd.loadgen [--transport udp|uds|tcp] [--profile high] [--rate N]
+
+Sends a configurable mix of metrics, events and service checks, with a
+configurable tag cardinality, optionally several packets per datagram, and
+reports the send rate next to the packets received and dropped by the
+kernel on the listening socket (UDP only, read from procfs).
+"""
+import bisect
+import logging
+import optparse
+import random
+import socket
+import sys
+import time
+
+from utils.network import get_udp_port_stats
+
+log = logging.getLogger(__name__)
+
+PACKET_TYPES = ('c', 'g', 'h', 'ms', 's', 'e', 'sc')
+
+# Cardinality profiles: number of metric names, tags per packet, values per
+# tag, and how contexts are picked ('uniform' or 'zipf': a few hot contexts
+# and a long tail, as seen in production).
+PROFILES = {
+    'low': dict(metrics=10, tags=2, tag_values=5, distribution='uniform'),
+    'default': dict(metrics=100, tags=3, tag_values=20, distribution='zipf'),
+    'high': dict(metrics=1000, tags=4, tag_values=1000, distribution='zipf'),
+}
+DEFAULT_MIX = 'c=40,g=20,h=20,ms=5,s=10,e=2,sc=3'
+MAX_DATAGRAM_SIZE = 1432
+
+
+def parse_mix(mix):
+    """ Parses `type=weight,...` into a list of (packet type, weight). """
+    weights = []
+    for item in mix.split(','):
+        packet_type, weight = item.split('=')
+        packet_type = packet_type.strip()
+        if packet_type not in PACKET_TYPES:
+            raise ValueError('Unknown packet type: %s' % packet_type)
+        weights.append((packet_type, float(weight)))
+    return weights
+
+
+class WeightedChoice(object):
+    """ Picks indexes in [0, n) with the given weights. """
+
+    def __init__(self, weights, rng):
+        self.cumulative = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+        self.total = total
+        self.rng = rng
+
+    def __call__(self):
+        return bisect.bisect(self.cumulative, self.rng.random() * self.total)
+
+
+class PacketGenerator(object):
+    """ Builds random dogstatsd packets following a packet mix and a cardinality profile. """
+
+    def __init__(self, mix=DEFAULT_MIX, metrics=100, tags=3, tag_values=20,
+                 distribution='zipf', seed=None):
+        self.rng = random.Random(seed)
+        mix = parse_mix(mix)
+        self.packet_types = [packet_type for packet_type, _ in mix]
+        self.pick_type = WeightedChoice([weight for _, weight in mix], self.rng)
+
+        if distribution == 'zipf':
+            self.pick_metric = WeightedChoice([1.0 / (i + 1) for i in xrange(metrics)], self.rng)
+            self.pick_value = WeightedChoice([1.0 / (i + 1) for i in xrange(tag_values)], self.rng)
+        elif distribution == 'uniform':
+            self.pick_metric = WeightedChoice([1] * metrics, self.rng)
+            self.pick_value = WeightedChoice([1] * tag_values, self.rng)
+        else:
+            raise ValueError('Unknown distribution: %s' % distribution)
+        self.nb_tags = tags
+
+        # Contexts are drawn for every packet, only their strings are formatted once
+        self._tag_strings = [['tag%s:value%s' % (i, value) for value in xrange(tag_values)]
+                             for i in xrange(tags)]
+        self._names = dict((packet_type, ['loadgen.%s.metric%s' % (packet_type, i) for i in xrange(metrics)])
+                           for packet_type in self.packet_types if packet_type not in ('e', 'sc'))
+
+    def _tags(self):
+        pick_value = self.pick_value
+        return ','.join([values[pick_value()] for values in self._tag_strings])
+
+    def packet(self):
+        packet_type = self.packet_types[self.pick_type()]
+        tags = self._tags()
+
+        if packet_type == 'e':
+            title, text = 'loadgen event', 'event %s' % self.pick_metric()
+            return '_e{%s,%s}:%s|%s|#%s' % (len(title), len(text), title, text, tags)
+        if packet_type == 'sc':
+            return '_sc|loadgen.check.%s|%s|#%s' % (self.pick_metric(), self.rng.randint(0, 3), tags)
+
+        name = self._names[packet_type][self.pick_metric()]
+        if packet_type == 's':
+            value = 'user%s' % self.rng.randint(0, 1000)
+        elif packet_type in ('c', 'g'):
+            value = self.rng.randint(0, 100)
+        else:
+            value = round(self.rng.uniform(0, 1000), 2)
+        return '%s:%s|%s|#%s' % (name, value, packet_type, tags)
+
+    def datagram(self, packets_per_datagram=1):
+        """
+        Returns a newline separated datagram of up to `packets_per_datagram`
+        packets, and the number of packets in it.
+        """
+        packets = [self.packet()]
+        size = len(packets[0])
+        while len(packets) < packets_per_datagram:
+            packet = self.packet()
+            size += len(packet) + 1
+            if size > MAX_DATAGRAM_SIZE:
+                break
+            packets.append(packet)
+        return '\n'.join(packets), len(packets)
+
+
+def make_socket(transport, host='127.0.0.1', port=8125, socket_path=None):
+    """ Returns a socket connected to dogstatsd over `transport`. """
+    if transport == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+    elif transport == 'uds':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.connect(socket_path)
+    elif transport == 'tcp':
+        sock = socket.create_connection((host, port))
+    else:
+        raise ValueError('Unknown transport: %s' % transport)
+    return sock
+
+
+def run(generator, sock, transport='udp', duration=10, rate=0, packets_per_datagram=1,
+        max_packets=0):
+    """
+    Sends datagrams for `duration` seconds, at most `rate` packets/s (no
+    limit if 0), and returns the send statistics. Stops early once
+    `max_packets` packets were sent, if set.
+
+    Every datagram is generated as it is sent, so that the number of
+    contexts keeps growing with a high cardinality profile.
+    """
+    send = sock.sendall if transport == 'tcp' else sock.send
+    terminator = '\n' if transport == 'tcp' else ''
+    packets = datagrams = send_errors = 0
+    start = time.time()
+    deadline = start + duration
+    now = start
+    while now < deadline and not (max_packets and packets >= max_packets):
+        # Send in small bursts, checking the clock and the rate in between
+        for _ in xrange(100):
+            datagram, nb_packets = generator.datagram(packets_per_datagram)
+            try:
+                send(datagram + terminator)
+                packets += nb_packets
+                datagrams += 1
+            except socket.error:
+                send_errors += 1
+            if max_packets and packets >= max_packets:
+                break
+        now = time.time()
+        if rate > 0:
+            ahead = float(packets) / rate - (now - start)
+            if ahead > 0:
+                time.sleep(ahead)
+                now = time.time()
+
+    elapsed = time.time() - start
+    return {
+        'packets': packets,
+        'datagrams': datagrams,
+        'send_errors': send_errors,
+        'elapsed': elapsed,
+        'rate': packets / elapsed if elapsed > 0 else 0,
+    }
+
+
+def main():
+    parser = optparse.OptionParser("%prog [options]")
+    parser.add_option('--transport', default='udp', choices=['udp', 'uds', 'tcp'])
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('-p', '--port', type='int', default=8125)
+    parser.add_option('--socket', dest='socket_path', help="unix socket path, for the uds transport")
+    parser.add_option('-d', '--duration', type='float', default=10)
+    parser.add_option('-n', '--packets', type='int', default=0,
+                      help="stop once that many packets were sent, 0 for no limit")
+    parser.add_option('-r', '--rate', type='float', default=0,
+                      help="packets/s to send, 0 for as fast as possible")
+    parser.add_option('--mix', default=DEFAULT_MIX, help="packet type weights, e.g. %s" % DEFAULT_MIX)
+    parser.add_option('--profile', default='default', choices=sorted(PROFILES),
+                      help="cardinality profile: %s" % ', '.join(sorted(PROFILES)))
+    parser.add_option('--metrics', type='int', help="number of metric names, overrides the profile")
+    parser.add_option('--tags', type='int', help="tags per packet, overrides the profile")
+    parser.add_option('--tag-values', type='int', help="values per tag, overrides the profile")
+    parser.add_option('--distribution', choices=['uniform', 'zipf'], help="overrides the profile")
+    parser.add_option('--packets-per-datagram', type='int', default=1)
+    parser.add_option('--seed', type='int')
+    options, _ = parser.parse_args()
+
+    profile = dict(PROFILES[options.profile])
+    for key in ('metrics', 'tags', 'tag_values', 'distribution'):
+        if getattr(options, key) is not None:
+            profile[key] = getattr(options, key)
+    generator = PacketGenerator(options.mix, seed=options.seed, **profile)
+
+    sock = make_socket(options.transport, options.host, options.port, options.socket_path)
+    kernel_stats = get_udp_port_stats(options.port) if options.transport == 'udp' else None
+
+    stats = run(generator, sock, options.transport, options.duration, options.rate,
+                options.packets_per_datagram, options.packets)
+    sock.close()
+
+    print "sent:          %d packets in %d datagrams, %.2fs" % (
+        stats['packets'], stats['datagrams'], stats['elapsed'])
+    print "send rate:     %.0f packets/s" % stats['rate']
+    print "send errors:   %d" % stats['send_errors']
+
+    end_stats = get_udp_port_stats(options.port) if kernel_stats is not None else None
+    if end_stats is None:
+        print "agent socket:  n/a (kernel statistics are only read for a local UDP port)"
+    else:
+        drops = end_stats['drops'] - kernel_stats['drops']
+        print "agent socket:  %d datagrams received, %d dropped by the kernel, %d bytes queued" % (
+            stats['datagrams'] - stats['send_errors'] - drops, drops, end_stats['rx_queue'])
+    print "See datadog.dogstatsd.packet.count and datadog.dogstatsd.*.drops for the agent side counters"
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from threading import Thread, Event
+import Queue
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PacketWorker(Thread):
+    """
+    Parses and aggregates the datagram batches queued by the receive loop,
+    so that a slow packet or aggregator stall doesn't delay the next recv.
+    """
+    GET_TIMEOUT = 1  # seconds
+
+    def __init__(self, input_queue, aggregator):
+        super(PacketWorker, self).__init__()
+        self.daemon = True
+        self.input_queue = input_queue
+        self.aggregator = aggregator
+        self.exit = Event()
+
+    def stop(self):
+        self.exit.set()
+
+    def _process_packets(self):
+        try:
+            # blocking for 1 seconds so we can check the exit condition
+            packets = self.input_queue.get(True, self.GET_TIMEOUT)
+        except Queue.Empty:
+            return
+
+        # The aggregator serializes the submissions of every worker
+        self.aggregator.submit_packet_batch(packets)
+
+    def run(self):
+        while not self.exit.is_set():
+            self._process_packets()
@@ -0,0 +1,70 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import errno
+import select
+
+
+class EpollPoller(object):
+    """
+    Waits for any registered file descriptor to be readable. The cost of a
+    wait doesn't depend on the number of descriptors watched.
+    """
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._flags = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+
+    def register(self, fd):
+        self._epoll.register(fd, self._flags)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """ Returns the readable file descriptors, waiting at most `timeout` seconds. """
+        try:
+            return [fd for fd, _ in self._epoll.poll(timeout)]
+        except IOError as e:
+            # Interrupted system call, e.g. on sigterm
+            if e.errno != errno.EINTR:
+                raise
+            return []
+
+    def close(self):
+        self._epoll.close()
+
+
+class PollPoller(object):
+    """ `poll` based fallback for platforms without epoll. """
+
+    def __init__(self):
+        self._poll = select.poll()
+        self._flags = select.POLLIN | select.POLLERR | select.POLLHUP
+
+    def register(self, fd):
+        self._poll.register(fd, self._flags)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            # poll takes a timeout in milliseconds
+            return [fd for fd, _ in self._poll.poll(timeout * 1000)]
+        except select.error as e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+
+    def close(self):
+        pass
+
+
+def make_poller():
+    """ Returns the most efficient poller available on the platform. """
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return PollPoller()
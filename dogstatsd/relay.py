@@ -0,0 +1,214 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from threading import Thread, Event
+import Queue
+import bisect
+import hashlib
+import logging
+import socket
+import struct
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STATSD_PORT = 8125
+
+
+def parse_destinations(hosts):
+    """
+    Parses a list, or a comma separated string, of `host[:port]` relay
+    destinations into `(host, port)` tuples.
+    """
+    if not hosts:
+        return []
+    if isinstance(hosts, basestring):
+        hosts = hosts.split(',')
+
+    destinations = []
+    for host in hosts:
+        host = host.strip()
+        if not host:
+            continue
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+            destinations.append((host, int(port)))
+        else:
+            destinations.append((host, DEFAULT_STATSD_PORT))
+    return destinations
+
+
+class RelaySender(Thread):
+    """
+    Relays packets to an external statsd server from its own thread, so a
+    slow or unreachable target never holds up the receive loop. Queued lines
+    are coalesced into datagrams of at most `mtu` bytes.
+    """
+    # 1500 bytes ethernet MTU minus the IPv6 and UDP headers, with some slack
+    DEFAULT_MTU = 1432
+    DEFAULT_QUEUE_SIZE = 1024
+    GET_TIMEOUT = 1  # seconds
+    # Maximum number of queued payloads coalesced in one go
+    MAX_COALESCED_PAYLOADS = 64
+
+    def __init__(self, host, port, queue_size=None, mtu=None):
+        super(RelaySender, self).__init__()
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.mtu = int(mtu or self.DEFAULT_MTU)
+        self.input_queue = Queue.Queue(int(queue_size or self.DEFAULT_QUEUE_SIZE))
+        self.exit = Event()
+
+        self.drops = 0
+        self.sent = 0
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect((host, port))
+
+    def stop(self):
+        self.exit.set()
+
+    def send(self, payload):
+        """ Queue newline separated packets for relaying, never blocks. """
+        try:
+            self.input_queue.put_nowait(payload)
+        except Queue.Full:
+            self.drops += payload.count('\n') or 1
+
+    @property
+    def queue_depth(self):
+        return self.input_queue.qsize()
+
+    def pop_stats(self):
+        """ Returns and resets the number of relayed datagrams and dropped packets. """
+        sent, self.sent = self.sent, 0
+        drops, self.drops = self.drops, 0
+        return sent, drops
+
+    def _coalesce(self, payloads):
+        mtu = self.mtu
+        datagram = []
+        size = 0
+        for payload in payloads:
+            for line in payload.splitlines():
+                if not line:
+                    continue
+                if datagram and size + 1 + len(line) > mtu:
+                    yield '\n'.join(datagram)
+                    datagram = []
+                    size = 0
+                size += len(line) + (1 if datagram else 0)
+                datagram.append(line)
+        if datagram:
+            yield '\n'.join(datagram)
+
+    def _process_packets(self):
+        try:
+            # blocking for 1 seconds so we can check the exit condition
+            payloads = [self.input_queue.get(True, self.GET_TIMEOUT)]
+        except Queue.Empty:
+            return
+
+        try:
+            while len(payloads) < self.MAX_COALESCED_PAYLOADS:
+                payloads.append(self.input_queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+        for datagram in self._coalesce(payloads):
+            try:
+                self.socket.send(datagram)
+                self.sent += 1
+            except socket.error as e:
+                self.drops += datagram.count('\n') + 1
+                log.debug("Could not relay packets to %s:%s: %s", self.host, self.port, e)
+
+    def run(self):
+        while not self.exit.is_set():
+            self._process_packets()
+
+
+class ShardedRelay(object):
+    """
+    Relays each metric to one of several downstream dogstatsd nodes, picked
+    on a consistent hash ring by the metric context (name and sorted tags).
+    Every point of a context lands on the same node, so the downstream
+    aggregation stays correct while the load is spread, and adding or
+    removing a node only moves the contexts of its neighbours on the ring.
+
+    Exposes the same interface as `RelaySender`.
+    """
+    # Points per node on the ring, to even out the share of each node
+    REPLICAS = 100
+
+    def __init__(self, destinations, parse_metric_packet, queue_size=None, mtu=None):
+        self.senders = [RelaySender(host, port, queue_size=queue_size, mtu=mtu)
+                        for host, port in destinations]
+        self.parse_metric_packet = parse_metric_packet
+
+        ring = []
+        for sender in self.senders:
+            for i in xrange(self.REPLICAS):
+                ring.append((self._hash('%s:%s-%s' % (sender.host, sender.port, i)), sender))
+        ring.sort(key=lambda point: point[0])
+        self._ring_hashes = [h for h, _ in ring]
+        self._ring_senders = [s for _, s in ring]
+
+    @staticmethod
+    def _hash(key):
+        return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+    def context_key(self, line):
+        """
+        Returns the string a packet is sharded on: its name and sorted tags
+        for metrics, the whole packet for events, service checks and
+        unparseable packets.
+        """
+        if line.startswith('_e') or line.startswith('_sc'):
+            return line
+        try:
+            name, _, _, tags, _ = self.parse_metric_packet(line)[0]
+        except Exception:
+            return line
+        if tags:
+            return '%s|%s' % (name, ','.join(tags))
+        return name
+
+    def get_sender(self, line):
+        idx = bisect.bisect(self._ring_hashes, self._hash(self.context_key(line)))
+        return self._ring_senders[idx % len(self._ring_senders)]
+
+    @property
+    def queue_depth(self):
+        return sum(sender.input_queue.qsize() for sender in self.senders)
+
+    def start(self):
+        for sender in self.senders:
+            sender.start()
+
+    def stop(self):
+        for sender in self.senders:
+            sender.stop()
+
+    def join(self):
+        for sender in self.senders:
+            sender.join()
+
+    def send(self, payload):
+        shards = {}
+        for line in payload.splitlines():
+            if line:
+                shards.setdefault(self.get_sender(line), []).append(line)
+
+        for sender, lines in shards.iteritems():
+            sender.send('\n'.join(lines) + '\n')
+
+    def pop_stats(self):
+        sent, drops = 0, 0
+        for sender in self.senders:
+            sender_sent, sender_drops = sender.pop_stats()
+            sent += sender_sent
+            drops += sender_drops
+        return sent, drops
@@ -0,0 +1,99 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+"""
+Replays a dogstatsd capture file into a local dogstatsd server.
+
+    python -m dogstatsd.replay [--port 8125] [--speed N] capture.bin
+
+`--speed` replays N times faster than the traffic was captured, 0 as fast as
+possible. Reports the packets/s achieved and the packets dropped, on send
+and by the kernel of the receiving socket.
+"""
+import logging
+import optparse
+import socket
+import sys
+import time
+
+from dogstatsd.capture import read_capture
+from utils.network import get_udp_port_stats
+
+log = logging.getLogger(__name__)
+
+# Don't bother sleeping for less than this, in seconds
+MIN_SLEEP = 0.001
+
+
+def replay(path, host='127.0.0.1', port=8125, speed=1.0):
+    """
+    Sends every packet of the capture at `path` to `host:port`, keeping the
+    original spacing between packets divided by `speed` (as fast as possible
+    if `speed` is 0). Returns the replay statistics.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((host, port))
+
+    kernel_stats = get_udp_port_stats(port)
+    packets = 0
+    send_errors = 0
+    first_timestamp = None
+    start = time.time()
+
+    for timestamp, packet in read_capture(path):
+        if speed > 0:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = start + (timestamp - first_timestamp) / speed - time.time()
+            if delay > MIN_SLEEP:
+                time.sleep(delay)
+        try:
+            sock.send(packet)
+        except socket.error:
+            send_errors += 1
+        packets += 1
+
+    elapsed = time.time() - start
+    sock.close()
+
+    kernel_drops = None
+    if kernel_stats is not None:
+        end_stats = get_udp_port_stats(port)
+        if end_stats is not None:
+            kernel_drops = end_stats['drops'] - kernel_stats['drops']
+
+    return {
+        'packets': packets,
+        'elapsed': elapsed,
+        'rate': packets / elapsed if elapsed > 0 else 0,
+        'send_errors': send_errors,
+        'kernel_drops': kernel_drops,
+    }
+
+
+def main():
+    parser = optparse.OptionParser("%prog [options] capture_file")
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('-p', '--port', type='int', default=8125)
+    parser.add_option('-s', '--speed', type='float', default=1.0,
+                      help="replay N times faster than captured, 0 for as fast as possible")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("a capture file is required")
+
+    stats = replay(args[0], options.host, options.port, options.speed)
+
+    print "packets sent:  %d in %.2fs" % (stats['packets'], stats['elapsed'])
+    print "rate:          %.0f packets/s" % stats['rate']
+    print "send errors:   %d" % stats['send_errors']
+    if stats['kernel_drops'] is None:
+        print "kernel drops:  n/a (no local socket statistics for port %s)" % options.port
+    else:
+        print "kernel drops:  %d" % stats['kernel_drops']
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,7 +17,8 @@ class Reporter(threading.Thread):
     EVENT_CHUNK_SIZE = 50
 
     def __init__(self, interval, aggregator, serializer,
-                 api_key=None, use_watchdog=False, hostname=None):
+                 api_key=None, use_watchdog=False, hostname=None, worker_pool=None,
+                 server=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
@@ -27,6 +28,8 @@ class Reporter(threading.Thread):
         self.log_count = 0
         self.hostname = hostname or get_hostname()
         self.api_key = api_key
+        self.worker_pool = worker_pool
+        self.server = server
 
     def stop(self):
         logging.info("Stopping reporter")
@@ -38,6 +41,14 @@ class Reporter(threading.Thread):
 
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            if self.server is not None:
+                self.server.send_internal_metrics()
+            if self.worker_pool is not None:
+                try:
+                    self.worker_pool.merge_into(self.aggregator)
+                except Exception:
+                    # Still flush what the aggregator holds
+                    logging.exception("Error collecting the state of the workers")
             self.aggregator.send_packet_count('datadog.dogstatsd.packet.count')
             self.flush()
 
@@ -3,115 +3,465 @@
 # This product includes software developed at Datadog (https://www.datadoghq.com/).
 # Copyright 2018 Datadog, Inc.
 
+import errno
 import logging
-import select
+import os
 import socket
+import time
+import Queue
 
 from utils.network import (
     IPPROTO_IPV6,
     IPV6_V6ONLY,
+    SO_REUSEPORT,
     ipv6_support,
     get_socket_address,
+    get_udp_socket_stats,
 )
 
+from .constants import (
+    DOGSTATSD_RECV_BATCH_SIZE,
+    DOGSTATSD_PACKET_QUEUE_SIZE,
+)
+from .buffer_pool import BufferPool
+from .capture import CaptureWriter
+from .packet_worker import PacketWorker
+from .poller import make_poller
+from .relay import RelaySender, ShardedRelay
+
+NEWLINE = ord('\n')
+
 
 class Server(object):
     """
-    A statsd udp server.
+    A statsd udp server, optionally listening on a unix datagram socket and
+    on a TCP port for newline delimited packets too.
     """
     UDP_SOCKET_TIMEOUT = 5
+    UDS_SOCKET_MODE = 0o722
+    TCP_BACKLOG = 128
+    TCP_READ_SIZE = 1024 * 64
+    TCP_MAX_LINE_SIZE = 1024 * 64
+    # Connections past this number wait in the backlog until another one closes
+    TCP_MAX_CONNECTIONS = 1024
+    # Delay before accepting again once out of file descriptors, if no connection closes meanwhile
+    TCP_ACCEPT_RETRY_DELAY = 1
 
-    def __init__(self, aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None):
+    def __init__(self, aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None,
+                 batch_size=None, reuse_port=False, socket_path=None, packet_workers=0,
+                 packet_queue_size=None, telemetry_tags=None, tcp_port=None,
+                 relay_queue_size=None, relay_mtu=None, forward_to_hosts=None,
+                 capture_path=None):
         self.sockaddr = None
         self.socket = None
+        self.socket_path = socket_path
+        self.uds_socket = None
+        self.tcp_port = tcp_port
+        self.tcp_socket = None
+        # Time to accept connections again at, while the TCP socket isn't watched
+        self._accept_retry_time = None
+        # fileno -> (socket, handler) of every socket the loop watches
+        self._listeners = {}
+        self._poller = None
+        # fileno -> trailing partial line of every TCP connection
+        self._partial_lines = {}
+        self._submit = None
         self.aggregator = aggregator
         self.host = host
         self.port = port
         self.buffer_size = 1024 * 8
         self.so_rcvbuf = so_rcvbuf
+        self.batch_size = int(batch_size or DOGSTATSD_RECV_BATCH_SIZE)
+        # Room for a whole batch of datagrams, each followed by a newline
+        self.buffer_pool = BufferPool(self.batch_size * (self.buffer_size + 1))
+        self.reuse_port = reuse_port
+        self.telemetry_tags = telemetry_tags
+
+        # With packet workers, the receive loop only queues the datagrams and
+        # the workers parse and aggregate them.
+        self.nb_packet_workers = int(packet_workers or 0)
+        self.packet_queue = None
+        self.packet_workers = []
+        self.queue_drops = 0
+        self.kernel_drops = 0
+        if self.nb_packet_workers > 0:
+            self.packet_queue = Queue.Queue(int(packet_queue_size or DOGSTATSD_PACKET_QUEUE_SIZE))
+
+        # Record every packet received, to replay the traffic offline
+        self.capture_path = capture_path
+        self.capture = None
 
         self.running = False
 
-        self.should_forward = forward_to_host is not None
+        self.should_forward = forward_to_host is not None or bool(forward_to_hosts)
 
-        self.forward_udp_sock = None
+        self.relay = None
+        # Shard the packets received across several downstream statsd servers
+        if forward_to_hosts:
+            logging.info("Sharded statsd relay enabled. Packets received will be sharded "
+                         "by context across %s", ', '.join('%s:%s' % d for d in forward_to_hosts))
+            try:
+                self.relay = ShardedRelay(forward_to_hosts, self.aggregator.parse_metric_packet,
+                                          queue_size=relay_queue_size, mtu=relay_mtu)
+            except Exception:
+                logging.exception("Error while setting up connections to the downstream statsd servers")
+                self.should_forward = False
         # In case we want to forward every packet received to another statsd server
-        if self.should_forward:
+        elif self.should_forward:
             if forward_to_port is None:
                 forward_to_port = 8125
 
             logging.info("External statsd forwarding enabled. All packets received \
                          will be forwarded to %s:%s" % (forward_to_host, forward_to_port))
             try:
-                self.forward_udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.forward_udp_sock.connect((forward_to_host, forward_to_port))
+                self.relay = RelaySender(forward_to_host, forward_to_port,
+                                         queue_size=relay_queue_size, mtu=relay_mtu)
             except Exception:
                 logging.exception("Error while setting up connection to external statsd server")
+                self.should_forward = False
 
     def start(self):
         """
         Run the server.
         """
+        if self.capture_path:
+            logging.info("Capturing the dogstatsd traffic to %s", self.capture_path)
+            self.capture = CaptureWriter(self.capture_path)
+
+        self._poller = make_poller()
+        self.socket = self._bind_udp_socket()
+        self._add_listener(self.socket, self._handle_datagrams)
+        if self.socket_path:
+            self.uds_socket = self._bind_uds_socket()
+            self._add_listener(self.uds_socket, self._handle_datagrams)
+        if self.tcp_port:
+            self.tcp_socket = self._bind_tcp_socket()
+            self._add_listener(self.tcp_socket, self._accept_connection)
+
+        if self.packet_queue is not None:
+            for _ in xrange(self.nb_packet_workers):
+                worker = PacketWorker(self.packet_queue, self.aggregator)
+                worker.start()
+                self.packet_workers.append(worker)
+            self._submit = self._enqueue_packets
+        else:
+            self._submit = self._submit_packets
+
+        if self.relay is not None:
+            self.relay.start()
+
+        # Inline variables for quick look-up.
+        listeners = self._listeners
+        poll = self._poller.poll
+        timeout = self.UDP_SOCKET_TIMEOUT
+
+        # Run our event loop.
+        self.running = True
+        while self.running:
+            try:
+                for fd in poll(timeout):
+                    # A connection handled earlier in this round may be gone
+                    listener = listeners.get(fd)
+                    if listener is not None:
+                        sock, handler = listener
+                        handler(sock)
+                if self._accept_retry_time is not None and time.time() >= self._accept_retry_time:
+                    self._resume_accepting()
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except Exception:
+                logging.exception('Error receiving packets')
+
+        for worker in self.packet_workers:
+            worker.stop()
+        for worker in self.packet_workers:
+            worker.join()
+        self.packet_workers = []
+
+        if self.relay is not None:
+            self.relay.stop()
+            self.relay.join()
+
+        for sock, handler in self._listeners.values():
+            if handler == self._handle_stream:
+                self._close_connection(sock)
+        if self.tcp_socket is not None:
+            self.tcp_socket.close()
+        if self.uds_socket is not None:
+            self.uds_socket.close()
+            self._unlink_socket_path()
+        self._listeners = {}
+        self._poller.close()
+
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def _add_listener(self, sock, handler):
+        self._listeners[sock.fileno()] = (sock, handler)
+        self._poller.register(sock.fileno())
+
+    def _remove_listener(self, sock):
+        if self._listeners.pop(sock.fileno(), None) is not None:
+            self._poller.unregister(sock.fileno())
+
+    def _handle_datagrams(self, sock):
+        payload, nb_datagrams = self._drain_socket(sock)
+        if not nb_datagrams:
+            return
+        self._submit(payload, nb_datagrams)
+
+        if self.should_forward:
+            self.relay.send(payload)
+
+    def _accept_connection(self, sock):
+        try:
+            conn, _ = sock.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # The pending connection stays in the backlog: watching the
+                # socket meanwhile would only spin on the same error
+                logging.warning('Not accepting dogstatsd TCP connections for now: %s', e)
+                self._pause_accepting()
+                return
+            raise
+        conn.setblocking(0)
+        self._partial_lines[conn.fileno()] = ''
+        self._add_listener(conn, self._handle_stream)
+
+        if len(self._partial_lines) >= self.TCP_MAX_CONNECTIONS:
+            logging.warning('%s dogstatsd TCP connections open, not accepting more until one closes',
+                            len(self._partial_lines))
+            self._pause_accepting(retry=False)
+
+    def _pause_accepting(self, retry=True):
+        """ Stop watching the TCP socket until a connection closes, or the retry delay passed. """
+        self._remove_listener(self.tcp_socket)
+        if retry:
+            self._accept_retry_time = time.time() + self.TCP_ACCEPT_RETRY_DELAY
+
+    def _resume_accepting(self):
+        self._accept_retry_time = None
+        if self.tcp_socket is not None and self.tcp_socket.fileno() not in self._listeners:
+            self._add_listener(self.tcp_socket, self._accept_connection)
+
+    def _handle_stream(self, conn):
+        """
+        Read newline delimited packets from a TCP connection, keeping any
+        trailing partial line until the rest of it arrives.
+        """
+        fd = conn.fileno()
+        try:
+            data = conn.recv(self.TCP_READ_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logging.warning('Error reading from dogstatsd TCP connection: %s', e)
+            data = ''
+
+        if not data:
+            # The connection is closed, what's left is a complete line
+            self._submit_stream_payload(self._partial_lines[fd])
+            self._close_connection(conn)
+            return
+
+        pending = self._partial_lines[fd] + data
+        end = pending.rfind('\n')
+        if end == -1:
+            if len(pending) > self.TCP_MAX_LINE_SIZE:
+                logging.warning('Dropping a dogstatsd TCP line longer than %s bytes', self.TCP_MAX_LINE_SIZE)
+                pending = ''
+            self._partial_lines[fd] = pending
+            return
+
+        self._partial_lines[fd] = pending[end + 1:]
+        self._submit_stream_payload(pending[:end + 1])
+
+    def _submit_stream_payload(self, payload):
+        if not payload:
+            return
+        if self.capture is not None:
+            # Replayed as datagrams, that are read `buffer_size` bytes at a time
+            self.capture.record_stream(payload, self.buffer_size)
+        self._submit(payload, payload.count('\n') or 1)
+
+        if self.should_forward:
+            self.relay.send(payload)
+
+    def _close_connection(self, conn):
+        self._remove_listener(conn)
+        self._partial_lines.pop(conn.fileno(), None)
+        conn.close()
+        if self.running:
+            self._resume_accepting()
+
+    def _bind_udp_socket(self):
+        return self._bind_inet_socket(socket.SOCK_DGRAM, int(self.port))
+
+    def _bind_tcp_socket(self):
+        sock = self._bind_inet_socket(socket.SOCK_STREAM, int(self.tcp_port))
+        sock.listen(self.TCP_BACKLOG)
+        return sock
+
+    def _bind_inet_socket(self, sock_type, port):
         ipv4_only = not ipv6_support()
         addr_family = socket.AF_INET if ipv4_only else socket.AF_INET6
 
-        self.socket = socket.socket(addr_family, socket.SOCK_DGRAM)
+        sock = socket.socket(addr_family, sock_type)
         if not ipv4_only:
             # Configure the socket so that it accepts connections from both
             # IPv4 and IPv6 networks in a portable manner.
-            self.socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
+            sock.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
 
         # Set SO_RCVBUF on the socket if a specific value has been
         # configured.
         if self.so_rcvbuf is not None:
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
+
+        # Let several worker processes bind the same port, the kernel then
+        # load-balances the datagrams between their sockets.
+        if self.reuse_port:
+            if SO_REUSEPORT is None:
+                raise Exception('SO_REUSEPORT is not supported on this platform')
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if sock_type == socket.SOCK_STREAM:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        self.socket.setblocking(0)
+        sock.setblocking(0)
+        sockaddr = None
         try:
             # let's get the sockaddr
-            self.sockaddr = get_socket_address(self.host, int(self.port), ipv4_only=ipv4_only)
-            self.socket.bind(self.sockaddr)
+            sockaddr = get_socket_address(self.host, port, ipv4_only=ipv4_only)
+            sock.bind(sockaddr)
         except TypeError:
             logging.error('Unable to start Dogstatsd server loop, exiting...')
             raise
         except socket.error as e:
-            logging.warn('unable to bind to socket (%s): %s', str(self.sockaddr), e)
+            logging.warn('unable to bind to socket (%s): %s', str(sockaddr), e)
             raise
 
-        logging.info('Listening on socket address: %s', str(self.sockaddr))
+        if sock_type == socket.SOCK_DGRAM:
+            self.sockaddr = sockaddr
+        logging.info('Listening on socket address: %s', str(sockaddr))
+        return sock
 
-        # Inline variables for quick look-up.
-        buffer_size = self.buffer_size
-        aggregator_submit = self.aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
-        select_select = select.select
-        select_error = select.error
-        timeout = self.UDP_SOCKET_TIMEOUT
-        should_forward = self.should_forward
-        forward_udp_sock = self.forward_udp_sock
+    def _bind_uds_socket(self):
+        """
+        Unix datagram sockets skip the UDP/IP stack and, unlike UDP, make
+        local clients block (or get EAGAIN) when the receive queue is full
+        instead of silently dropping packets.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if self.so_rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
+        sock.setblocking(0)
 
-        # Run our select loop.
-        self.running = True
-        message = None
-        while self.running:
-            try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
-
-                    if should_forward:
-                        forward_udp_sock.send(message)
-            except select_error as se:
-                # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+        # A previous run may have left its socket file behind
+        self._unlink_socket_path()
+        try:
+            sock.bind(self.socket_path)
+            # Any local user may submit metrics
+            os.chmod(self.socket_path, self.UDS_SOCKET_MODE)
+        except (socket.error, OSError) as e:
+            logging.warn('unable to bind to unix socket (%s): %s', self.socket_path, e)
+            raise
+
+        logging.info('Listening on unix socket: %s', self.socket_path)
+        return sock
+
+    def _unlink_socket_path(self):
+        try:
+            os.unlink(self.socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _enqueue_packets(self, payload, nb_datagrams):
+        try:
+            self.packet_queue.put_nowait(payload)
+        except Queue.Full:
+            self.queue_drops += nb_datagrams
+
+    def _submit_packets(self, payload, nb_datagrams):
+        self.aggregator.submit_packet_batch(payload)
+
+    def _drain_socket(self, sock):
+        """
+        Read every datagram already queued on the (non-blocking) socket, up
+        to `batch_size`, so a single wake-up of the event loop amortizes its
+        cost over the whole batch.
+
+        The datagrams are received back to back, newline separated, into a
+        pooled buffer, which is turned into a single string for the whole
+        batch. Returns that payload and the number of datagrams it holds.
+        """
+        buf = self.buffer_pool.acquire()
+        try:
+            view = memoryview(buf)
+            recv_into = sock.recv_into
+            buffer_size = self.buffer_size
+            capture = self.capture
+            nb_datagrams = 0
+            offset = 0
+            for _ in xrange(self.batch_size):
+                try:
+                    received = recv_into(view[offset:], buffer_size)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
                     raise
-            except (KeyboardInterrupt, SystemExit):
-                break
-            except Exception:
-                logging.exception('Error receiving datagram `%s`', message)
+                if capture is not None:
+                    capture.record(buf[offset:offset + received])
+                offset += received
+                nb_datagrams += 1
+                buf[offset] = NEWLINE
+                offset += 1
+            return view[:offset].tobytes(), nb_datagrams
+        finally:
+            self.buffer_pool.release(buf)
+
+    def _internal_metrics(self):
+        """ Returns the server telemetry as (name, value) gauges. """
+        metrics = []
+        if self.packet_queue is not None:
+            drops, self.queue_drops = self.queue_drops, 0
+            metrics.append(('datadog.dogstatsd.queue.depth', self.packet_queue.qsize()))
+            metrics.append(('datadog.dogstatsd.queue.drops', drops))
+        if self.relay is not None:
+            sent, drops = self.relay.pop_stats()
+            metrics.append(('datadog.dogstatsd.relay.queue.depth', self.relay.queue_depth))
+            metrics.append(('datadog.dogstatsd.relay.sent', sent))
+            metrics.append(('datadog.dogstatsd.relay.drops', drops))
+        if self.socket is not None:
+            metrics.extend(self._socket_metrics())
+        metrics.extend(self.aggregator.context_cache_metrics())
+        return metrics
+
+    def _socket_metrics(self):
+        """
+        Kernel side telemetry of the UDP socket: datagrams dropped before we
+        could read them, and how full its receive buffer is.
+        """
+        stats = get_udp_socket_stats(self.socket)
+        if stats is None:
+            return []
+
+        # The kernel counter is cumulative, report the drops since the last read
+        drops = stats['drops'] - self.kernel_drops
+        self.kernel_drops = stats['drops']
+        return [
+            ('datadog.dogstatsd.socket.drops', drops),
+            ('datadog.dogstatsd.socket.rx_queue', stats['rx_queue']),
+            ('datadog.dogstatsd.socket.rcvbuf',
+             self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)),
+        ]
+
+    def send_internal_metrics(self):
+        metrics = self._internal_metrics()
+        for name, value in metrics:
+            self.aggregator.submit_metric(name, value, 'g', tags=self.telemetry_tags)
 
     def stop(self):
         self.running = False
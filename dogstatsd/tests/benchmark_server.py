@@ -0,0 +1,155 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+"""
+Performance tests for the dogstatsd receive loop.
+
+A separate process floods the server with datagrams for a fixed duration
+while the server runs in a thread; the number of metric packets that made
+it into the aggregator gives the packets/s ceiling of the loop.
+"""
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Server
+
+
+PAYLOAD = 'benchmark.counter:1|c|#env:bench,role:sender'
+
+
+def _flood_udp(port, socket_path, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for _ in xrange(100):
+            try:
+                sock.sendto(PAYLOAD, ('127.0.0.1', port))
+            except socket.error:
+                pass
+
+
+def _flood_uds(port, socket_path, duration):
+    # Blocking sends: the kernel pushes back instead of dropping
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.connect(socket_path)
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for _ in xrange(100):
+            sock.send(PAYLOAD)
+
+
+def _free_port(sock_type=socket.SOCK_DGRAM):
+    sock = socket.socket(socket.AF_INET, sock_type)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestServerPerf(object):
+
+    DURATION = 5
+
+    def run_server(self, flood, idle_connections=0, **server_kwargs):
+        port = _free_port()
+        socket_path = os.path.join(tempfile.mkdtemp(), 'dsd.socket')
+        aggregator = MetricsBucketAggregator('my.host')
+        server = Server(aggregator, '127.0.0.1', port, socket_path=socket_path, **server_kwargs)
+        server.UDP_SOCKET_TIMEOUT = 0.1
+
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        while not server.running:
+            time.sleep(0.01)
+
+        # Idle TCP connections the event loop has to watch on every wake-up
+        connections = [socket.create_connection(('127.0.0.1', server.tcp_port))
+                       for _ in xrange(idle_connections)]
+
+        sender = multiprocessing.Process(target=flood, args=(port, socket_path, self.DURATION))
+        start = time.time()
+        sender.start()
+        sender.join()
+        elapsed = time.time() - start
+
+        server.stop()
+        thread.join()
+        for conn in connections:
+            conn.close()
+
+        return aggregator.count / elapsed
+
+    def test_udp_receive_loop_perf(self):
+        single = self.run_server(_flood_udp, batch_size=1)
+        batched = self.run_server(_flood_udp)
+
+        print "single datagram per wake-up: %.0f packets/s" % single
+        print "batched drain:               %.0f packets/s" % batched
+
+    def test_recv_path_perf(self):
+        """
+        Pre-fills a socket and times draining it: one `recv` string per
+        datagram submitted individually, against the pooled `recv_into`
+        buffer submitted as a single batch.
+        """
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.setblocking(0)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.connect(receiver.getsockname())
+        server = Server(None, '127.0.0.1', 0)
+        batch_size = server.batch_size
+        rounds, batches = 50, 100
+
+        def timed(drain_and_submit):
+            elapsed = 0
+            for _ in xrange(rounds):
+                for _ in xrange(batches * batch_size):
+                    sender.send(PAYLOAD)
+                start = time.time()
+                for _ in xrange(batches):
+                    drain_and_submit()
+                elapsed += time.time() - start
+            return rounds * batches * batch_size / elapsed
+
+        aggregator = MetricsBucketAggregator('my.host')
+
+        def recv_strings():
+            for _ in xrange(batch_size):
+                aggregator.submit_packets(receiver.recv(server.buffer_size))
+
+        def recv_into_pool():
+            aggregator.submit_packet_batch(server._drain_socket(receiver)[0])
+
+        print "recv + per-datagram submit:      %.0f packets/s" % timed(recv_strings)
+        print "pooled recv_into + batch submit: %.0f packets/s" % timed(recv_into_pool)
+
+    def test_event_loop_listeners_perf(self):
+        for idle_connections in (0, 100, 500):
+            rate = self.run_server(_flood_udp, idle_connections=idle_connections,
+                                   tcp_port=_free_port(socket.SOCK_STREAM))
+            print "%3d idle tcp connections: %.0f packets/s" % (idle_connections, rate)
+
+    def test_uds_vs_udp_perf(self):
+        udp = self.run_server(_flood_udp)
+        uds = self.run_server(_flood_uds)
+
+        print "udp: %.0f packets/s" % udp
+        print "uds: %.0f packets/s" % uds
+
+
+if __name__ == '__main__':
+    t = TestServerPerf()
+    t.test_udp_receive_loop_perf()
+    t.test_recv_path_perf()
+    t.test_uds_vs_udp_perf()
+    t.test_event_loop_listeners_perf()
@@ -0,0 +1,126 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import socket
+import time
+
+import pytest
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Server
+from dogstatsd.capture import CaptureWriter, read_capture
+from dogstatsd.replay import replay
+from dogstatsd.tests.test_server import free_tcp_port, run_server_in_thread, wait_for_count
+
+
+def test_capture_round_trip(tmpdir):
+    path = str(tmpdir.join('capture.bin'))
+    writer = CaptureWriter(path)
+    writer.record('a:1|c', timestamp=10.0)
+    writer.record(bytearray('b:2|g\nc:3|h'), timestamp=10.5)
+    writer.close()
+
+    assert list(read_capture(path)) == [(10.0, 'a:1|c'), (10.5, 'b:2|g\nc:3|h')]
+
+
+def test_record_stream_splits_lines(tmpdir):
+    path = str(tmpdir.join('capture.bin'))
+    writer = CaptureWriter(path)
+    writer.record_stream('a:1|c\nb:2|c\n\nc:3|c\n%s\nd:4|c\n' % ('x' * 20), 12, timestamp=10.0)
+    writer.close()
+
+    assert [packet for _, packet in read_capture(path)] == ['a:1|c\nb:2|c', 'c:3|c', 'x' * 20, 'd:4|c']
+
+
+def test_read_capture_rejects_other_files(tmpdir):
+    path = tmpdir.join('not_a_capture')
+    path.write('hello')
+    with pytest.raises(ValueError):
+        list(read_capture(str(path)))
+
+
+def test_server_capture_and_replay(tmpdir):
+    path = str(tmpdir.join('capture.bin'))
+    aggregator = MetricsBucketAggregator('my.host')
+    server = Server(aggregator, '127.0.0.1', 0, capture_path=path)
+    thread = run_server_in_thread(server)
+    try:
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(5):
+            sender.sendto('metric.%s:1|c' % i, ('127.0.0.1', server.socket.getsockname()[1]))
+        wait_for_count(aggregator, 5)
+    finally:
+        server.stop()
+        thread.join()
+
+    records = list(read_capture(path))
+    assert [packet for _, packet in records] == ['metric.%s:1|c' % i for i in xrange(5)]
+    assert records == sorted(records)
+
+    # Replay the capture into a new server
+    replayed = MetricsBucketAggregator('my.host')
+    server = Server(replayed, '127.0.0.1', 0)
+    thread = run_server_in_thread(server)
+    try:
+        start = time.time()
+        stats = replay(path, port=server.socket.getsockname()[1], speed=0)
+        wait_for_count(replayed, 5)
+    finally:
+        server.stop()
+        thread.join()
+
+    assert stats['packets'] == 5
+    assert stats['send_errors'] == 0
+    assert stats['kernel_drops'] in (0, None)
+    assert time.time() - start < 2
+    assert replayed.count == 5
+
+
+def test_replay_keeps_the_packet_spacing(tmpdir):
+    path = str(tmpdir.join('capture.bin'))
+    writer = CaptureWriter(path)
+    writer.record('a:1|c', timestamp=100.0)
+    writer.record('b:1|c', timestamp=100.4)
+    writer.close()
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+
+    stats = replay(path, port=receiver.getsockname()[1], speed=2)
+    assert stats['packets'] == 2
+    assert 0.2 <= stats['elapsed'] < 0.4
+    assert receiver.recv(1024) == 'a:1|c'
+    assert receiver.recv(1024) == 'b:1|c'
+
+
+def test_tcp_capture_replays_in_full(tmpdir):
+    path = str(tmpdir.join('capture.bin'))
+    aggregator = MetricsBucketAggregator('my.host')
+    server = Server(aggregator, '127.0.0.1', 0, tcp_port=free_tcp_port(), capture_path=path)
+    thread = run_server_in_thread(server)
+    try:
+        sender = socket.create_connection(('127.0.0.1', server.tcp_port))
+        # Read in payloads far larger than a datagram
+        sender.sendall(''.join('tcp.metric.%s:1|c\n' % i for i in xrange(3000)))
+        sender.close()
+        wait_for_count(aggregator, 3000)
+    finally:
+        server.stop()
+        thread.join()
+
+    assert all(len(packet) <= server.buffer_size for _, packet in read_capture(path))
+
+    replayed = MetricsBucketAggregator('my.host')
+    server = Server(replayed, '127.0.0.1', 0)
+    thread = run_server_in_thread(server)
+    try:
+        stats = replay(path, port=server.socket.getsockname()[1], speed=0)
+        wait_for_count(replayed, 3000)
+    finally:
+        server.stop()
+        thread.join()
+
+    assert stats['send_errors'] == 0
+    assert replayed.count == 3000
@@ -0,0 +1,87 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import pytest
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Server
+from dogstatsd.loadgen import MAX_DATAGRAM_SIZE, PacketGenerator, make_socket, parse_mix, run
+from dogstatsd.tests.test_server import free_tcp_port, run_server_in_thread, wait_for_count
+
+
+def test_parse_mix():
+    assert parse_mix('c=1,sc=2.5') == [('c', 1.0), ('sc', 2.5)]
+    with pytest.raises(ValueError):
+        parse_mix('x=1')
+
+
+def test_generator_follows_mix_and_cardinality():
+    generator = PacketGenerator('g=1', metrics=3, tags=2, tag_values=4, distribution='uniform', seed=1)
+    aggregator = MetricsBucketAggregator('my.host')
+
+    names, tags = set(), set()
+    for _ in xrange(500):
+        name, _, metric_type, packet_tags, _ = aggregator.parse_metric_packet(generator.packet())[0]
+        assert metric_type == 'g'
+        names.add(name)
+        tags.update(packet_tags)
+    assert len(names) == 3
+    assert len(tags) == 2 * 4
+
+
+def test_generator_builds_parseable_packets():
+    generator = PacketGenerator(seed=1)
+    aggregator = MetricsBucketAggregator('my.host')
+    for _ in xrange(200):
+        datagram, nb_packets = generator.datagram(10)
+        assert len(datagram) <= MAX_DATAGRAM_SIZE
+        assert datagram.count('\n') + 1 == nb_packets
+        aggregator.submit_packets(datagram)
+    assert aggregator.count + aggregator.event_count + aggregator.service_check_count > 0
+
+
+@pytest.mark.parametrize('transport', ['udp', 'tcp'])
+def test_run_against_server(transport):
+    aggregator = MetricsBucketAggregator('my.host')
+    server = Server(aggregator, '127.0.0.1', 0, tcp_port=free_tcp_port())
+    thread = run_server_in_thread(server)
+    try:
+        port = server.socket.getsockname()[1] if transport == 'udp' else server.tcp_port
+        sock = make_socket(transport, port=port)
+        generator = PacketGenerator('c=1', seed=1)
+        stats = run(generator, sock, transport, duration=0.2, rate=1000, packets_per_datagram=5)
+        sock.close()
+        wait_for_count(aggregator, stats['packets'])
+    finally:
+        server.stop()
+        thread.join()
+
+    # the rate is honored
+    assert 0 < stats['packets'] <= 1000 * stats['elapsed'] + 500
+    assert aggregator.count == stats['packets']
+
+
+class RecordingSocket(object):
+    def __init__(self):
+        self.datagrams = []
+
+    def send(self, datagram):
+        self.datagrams.append(datagram)
+
+
+def test_run_keeps_drawing_contexts():
+    sock = RecordingSocket()
+    generator = PacketGenerator('g=1', metrics=1000, tags=4, tag_values=1000, seed=1)
+    stats = run(generator, sock, duration=60, max_packets=40000)
+    assert stats['packets'] == len(sock.datagrams) == 40000
+
+    aggregator = MetricsBucketAggregator('my.host')
+    contexts = []
+    for datagram in sock.datagrams:
+        name, _, _, tags, _ = aggregator.parse_metric_packet(datagram)[0]
+        contexts.append((name, tuple(tags)))
+    # the number of contexts grows with the number of packets sent
+    assert len(set(contexts[:20000])) > 15000
+    assert len(set(contexts)) > 1.8 * len(set(contexts[:20000]))
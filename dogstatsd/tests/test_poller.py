@@ -0,0 +1,49 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import select
+import socket
+
+import pytest
+
+from dogstatsd.poller import EpollPoller, PollPoller, make_poller
+
+
+POLLERS = [PollPoller]
+if hasattr(select, 'epoll'):
+    POLLERS.append(EpollPoller)
+
+
+def make_socket_pair():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(receiver.getsockname())
+    return receiver, sender
+
+
+@pytest.mark.parametrize('poller_class', POLLERS)
+def test_poller_returns_readable_fds(poller_class):
+    poller = poller_class()
+    pairs = [make_socket_pair() for _ in xrange(3)]
+    for receiver, _ in pairs:
+        poller.register(receiver.fileno())
+
+    assert poller.poll(0) == []
+
+    pairs[1][1].send('a:1|c')
+    pairs[2][1].send('b:1|c')
+    assert sorted(poller.poll(1)) == sorted([pairs[1][0].fileno(), pairs[2][0].fileno()])
+
+    poller.unregister(pairs[2][0].fileno())
+    assert poller.poll(1) == [pairs[1][0].fileno()]
+    poller.close()
+
+
+def test_make_poller():
+    poller = make_poller()
+    expected = EpollPoller if hasattr(select, 'epoll') else PollPoller
+    assert isinstance(poller, expected)
+    poller.close()
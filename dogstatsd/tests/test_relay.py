@@ -0,0 +1,136 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import select
+import socket
+
+from mock import MagicMock
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Server
+from dogstatsd.relay import RelaySender, ShardedRelay, parse_destinations
+
+
+def make_target():
+    target = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target.bind(('127.0.0.1', 0))
+    target.setblocking(0)
+    return target
+
+
+def read_datagrams(sock, timeout=1):
+    datagrams = []
+    while select.select([sock], [], [], timeout)[0]:
+        datagrams.append(sock.recv(65535))
+        timeout = 0.1
+    return datagrams
+
+
+def test_relay_coalesces_up_to_mtu():
+    target = make_target()
+    relay = RelaySender('127.0.0.1', target.getsockname()[1], mtu=40)
+
+    lines = ['metric.%s:1|c' % i for i in xrange(10)]
+    relay.send('\n'.join(lines[:5]) + '\n')
+    relay.send('\n'.join(lines[5:]) + '\n')
+    relay._process_packets()
+
+    datagrams = read_datagrams(target)
+    assert all(len(d) <= 40 for d in datagrams)
+    assert len(datagrams) < len(lines)
+    assert '\n'.join(datagrams).split('\n') == lines
+    assert relay.pop_stats() == (len(datagrams), 0)
+    assert relay.pop_stats() == (0, 0)
+
+
+def test_relay_drops_when_queue_is_full():
+    target = make_target()
+    relay = RelaySender('127.0.0.1', target.getsockname()[1], queue_size=1)
+
+    relay.send('first:1|c\n')
+    relay.send('second:1|c\nthird:1|c\n')
+
+    assert relay.pop_stats() == (0, 2)
+    relay._process_packets()
+    assert read_datagrams(target) == ['first:1|c']
+
+
+def test_server_relays_received_payload():
+    target = make_target()
+    server = Server(MagicMock(), '127.0.0.1', 0,
+                    forward_to_host='127.0.0.1', forward_to_port=target.getsockname()[1])
+    server.relay.start()
+    try:
+        server._submit = MagicMock()
+        server._submit_stream_payload('a:1|c\nb:2|c\n')
+        assert read_datagrams(target) == ['a:1|c\nb:2|c']
+
+        metrics = dict(server._internal_metrics())
+        assert metrics['datadog.dogstatsd.relay.sent'] == 1
+        assert metrics['datadog.dogstatsd.relay.drops'] == 0
+        assert metrics['datadog.dogstatsd.relay.queue.depth'] == 0
+    finally:
+        server.relay.stop()
+        server.relay.join()
+
+
+def make_sharded_relay(nb_targets):
+    targets = [make_target() for _ in xrange(nb_targets)]
+    destinations = [('127.0.0.1', t.getsockname()[1]) for t in targets]
+    aggregator = MetricsBucketAggregator('my.host')
+    return targets, ShardedRelay(destinations, aggregator.parse_metric_packet)
+
+
+def test_parse_destinations():
+    assert parse_destinations(None) == []
+    assert parse_destinations('a:8126, b') == [('a', 8126), ('b', 8125)]
+    assert parse_destinations(['a:1', 'b:2']) == [('a', 1), ('b', 2)]
+
+
+def test_sharded_relay_context_key():
+    _, relay = make_sharded_relay(1)
+
+    # tag order, values and sample rates don't change the context
+    assert relay.context_key('my.metric:1|c|#b:2,a:1') == 'my.metric|a:1,b:2'
+    assert relay.context_key('my.metric:5|c|@0.5|#a:1,b:2') == 'my.metric|a:1,b:2'
+    assert relay.context_key('my.metric:5|g') == 'my.metric'
+    # non metric packets are sharded as a whole
+    assert relay.context_key('_sc|check|0') == '_sc|check|0'
+    assert relay.context_key('not a metric') == 'not a metric'
+
+
+def test_sharded_relay_keeps_contexts_on_one_node():
+    targets, relay = make_sharded_relay(3)
+
+    payload = ''.join('metric.%s:%s|c|#env:%s\n' % (i % 20, i, i % 2) for i in xrange(200))
+    relay.send(payload)
+    for sender in relay.senders:
+        sender._process_packets()
+
+    contexts_by_target = []
+    for target in targets:
+        lines = '\n'.join(read_datagrams(target)).split('\n')
+        contexts_by_target.append(set(relay.context_key(line) for line in lines if line))
+
+    # the load is spread, and each context was relayed to a single node
+    assert all(contexts_by_target)
+    assert sum(len(c) for c in contexts_by_target) == 20
+    assert sum(relay.pop_stats()) > 0
+
+
+def test_sharded_relay_is_consistent():
+    _, relay = make_sharded_relay(3)
+
+    lines = ['metric.%s:1|c' % i for i in xrange(500)]
+    before = dict((line, relay.get_sender(line)) for line in lines)
+    assert before == dict((line, relay.get_sender(line)) for line in lines)
+
+    # removing a node only moves the contexts it owned
+    removed = relay.senders[-1]
+    relay_without = ShardedRelay([(s.host, s.port) for s in relay.senders[:-1]],
+                                 relay.parse_metric_packet)
+    for line in lines:
+        if before[line] is not removed:
+            assert relay_without.get_sender(line).port == before[line].port
@@ -0,0 +1,313 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+import pytest
+from mock import MagicMock
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Server
+from utils.network import get_udp_socket_stats
+
+
+def make_socket_pair():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(0)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(receiver.getsockname())
+    return receiver, sender
+
+
+def free_tcp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_datagrams(sock, timeout=1):
+    select.select([sock], [], [], timeout)
+
+
+def test_drain_socket_reads_all_queued_datagrams():
+    receiver, sender = make_socket_pair()
+    server = Server(MagicMock(), '127.0.0.1', 0)
+
+    for i in xrange(5):
+        sender.send('metric.%s:1|c' % i)
+    wait_for_datagrams(receiver)
+
+    payload, nb_datagrams = server._drain_socket(receiver)
+    assert payload == ''.join('metric.%s:1|c\n' % i for i in xrange(5))
+    assert nb_datagrams == 5
+
+    # nothing is left on the socket
+    assert server._drain_socket(receiver) == ('', 0)
+
+
+def test_drain_socket_honors_batch_size():
+    receiver, sender = make_socket_pair()
+    server = Server(MagicMock(), '127.0.0.1', 0, batch_size=2)
+
+    for i in xrange(5):
+        sender.send('metric.%s:1|c' % i)
+    wait_for_datagrams(receiver)
+
+    assert server._drain_socket(receiver)[1] == 2
+    assert server._drain_socket(receiver)[1] == 2
+    assert server._drain_socket(receiver)[1] == 1
+
+
+def test_drain_socket_reuses_pooled_buffer():
+    receiver, sender = make_socket_pair()
+    server = Server(MagicMock(), '127.0.0.1', 0)
+    buf = server.buffer_pool.acquire()
+    server.buffer_pool.release(buf)
+
+    sender.send('first:1|c')
+    wait_for_datagrams(receiver)
+    assert server._drain_socket(receiver)[0] == 'first:1|c\n'
+
+    sender.send('second:1|c')
+    wait_for_datagrams(receiver)
+    assert server._drain_socket(receiver)[0] == 'second:1|c\n'
+
+    assert server.buffer_pool.acquire() is buf
+
+
+def run_server_in_thread(server):
+    server.UDP_SOCKET_TIMEOUT = 0.1
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    while not server.running and thread.is_alive():
+        time.sleep(0.01)
+    return thread
+
+
+def wait_for_count(aggregator, count, timeout=2):
+    deadline = time.time() + timeout
+    while aggregator.count < count and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_unix_socket_listener(tmpdir):
+    socket_path = str(tmpdir.join('dsd.socket'))
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, socket_path=socket_path)
+    thread = run_server_in_thread(server)
+
+    try:
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.connect(socket_path)
+        sender.send('uds.metric:1|c\nuds.metric:2|c')
+        sender.close()
+
+        wait_for_count(aggregator, 2)
+    finally:
+        server.stop()
+        thread.join()
+
+    assert aggregator.count == 2
+    # the socket file is cleaned up on exit
+    assert not os.path.exists(socket_path)
+
+
+def test_tcp_listener():
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, tcp_port=free_tcp_port())
+    thread = run_server_in_thread(server)
+
+    try:
+        clients = [socket.create_connection(('127.0.0.1', server.tcp_port)) for _ in xrange(3)]
+        for i, client in enumerate(clients):
+            # a line split across two writes is only submitted once complete
+            client.sendall('tcp.metric:1|c\ntcp.metric:2|c\ntcp.me')
+            time.sleep(0.05)
+            client.sendall('tric:3|c\n_e{5,4}:title|text\n')
+        wait_for_count(aggregator, 9)
+        assert aggregator.count == 9
+        assert aggregator.event_count == 3
+
+        # a trailing line without newline is submitted when the client disconnects
+        clients[0].sendall('tcp.metric:4|c')
+        clients[0].close()
+        wait_for_count(aggregator, 10)
+        assert aggregator.count == 10
+        assert len(server._partial_lines) == 2
+    finally:
+        server.stop()
+        thread.join()
+
+    assert server._partial_lines == {}
+
+
+def test_tcp_connection_limit():
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, tcp_port=free_tcp_port())
+    server.TCP_MAX_CONNECTIONS = 2
+    thread = run_server_in_thread(server)
+
+    try:
+        clients = []
+        for _ in xrange(3):
+            clients.append(socket.create_connection(('127.0.0.1', server.tcp_port)))
+            clients[-1].sendall('tcp.metric:1|c\n')
+            time.sleep(0.1)
+        # the third connection waits in the backlog
+        wait_for_count(aggregator, 3, timeout=0.5)
+        assert aggregator.count == 2
+        assert server.tcp_socket.fileno() not in server._listeners
+
+        clients[0].close()
+        wait_for_count(aggregator, 3)
+        assert aggregator.count == 3
+    finally:
+        for client in clients:
+            client.close()
+        server.stop()
+        thread.join()
+
+
+class OutOfFilesListener(object):
+    """ A listening socket whose `accept` fails as if the process had no file descriptor left. """
+    def __init__(self, sock):
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def accept(self):
+        raise socket.error(errno.EMFILE, os.strerror(errno.EMFILE))
+
+
+def test_tcp_accept_out_of_files():
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, tcp_port=free_tcp_port())
+    server.TCP_ACCEPT_RETRY_DELAY = 0.5
+    thread = run_server_in_thread(server)
+
+    try:
+        fd = server.tcp_socket.fileno()
+        server._listeners[fd] = (OutOfFilesListener(server.tcp_socket), server._accept_connection)
+        client = socket.create_connection(('127.0.0.1', server.tcp_port))
+        client.sendall('tcp.metric:1|c\n')
+        time.sleep(0.2)
+        # the socket isn't watched rather than failing over and over again
+        assert fd not in server._listeners
+        assert aggregator.count == 0
+
+        # the pending connection is accepted after the retry delay
+        wait_for_count(aggregator, 1)
+        assert aggregator.count == 1
+        client.close()
+    finally:
+        server.stop()
+        thread.join()
+
+
+def test_packet_workers():
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, packet_workers=2)
+    thread = run_server_in_thread(server)
+
+    try:
+        assert len(server.packet_workers) == 2
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(10):
+            sender.sendto('queued.metric:%s|c' % i, ('127.0.0.1', server.socket.getsockname()[1]))
+
+        wait_for_count(aggregator, 10)
+    finally:
+        server.stop()
+        thread.join()
+
+    assert aggregator.count == 10
+    assert server.packet_workers == []
+
+
+def test_packet_queue_drops_and_telemetry():
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, packet_workers=1, packet_queue_size=1,
+                    telemetry_tags=['worker:0'])
+
+    # no worker is draining the queue: the second batch overflows it
+    server._enqueue_packets('a:1|c\nb:1|c\n', 2)
+    server._enqueue_packets('c:1|c\nd:1|c\ne:1|c\n', 3)
+    assert server.queue_drops == 3
+
+    server.send_internal_metrics()
+    assert server.queue_drops == 0
+
+    time.sleep(aggregator.interval)
+    metrics = dict((m['metric'], m) for m in aggregator.flush())
+    assert metrics['datadog.dogstatsd.queue.depth']['points'][0][1] == 1
+    assert metrics['datadog.dogstatsd.queue.drops']['points'][0][1] == 3
+    assert metrics['datadog.dogstatsd.queue.drops']['tags'] == ('worker:0',)
+
+
+def test_submit_packet_batch_isolates_bad_lines():
+    aggregator = MetricsBucketAggregator('myhost')
+    aggregator.submit_packet_batch(
+        'good.metric:1|c\n'
+        'bad.metric:notanumber|c\nkept.metric:1|c\n'
+        '_e{100,1}:bad_event\n'
+        'other.metric:1|c\nanother.metric:2|g\n'
+    )
+
+    # bad lines only drop themselves
+    assert aggregator.count == 4
+
+
+def test_socket_telemetry():
+    server = Server(MagicMock(), '127.0.0.1', 0)
+    server.socket = server._bind_udp_socket()
+    if get_udp_socket_stats(server.socket) is None:
+        pytest.skip('socket statistics are not available on this platform')
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.sendto('queued:1|c', ('127.0.0.1', server.socket.getsockname()[1]))
+    wait_for_datagrams(server.socket)
+
+    metrics = dict(server._internal_metrics())
+    assert metrics['datadog.dogstatsd.socket.drops'] == 0
+    assert metrics['datadog.dogstatsd.socket.rx_queue'] > 0
+    assert metrics['datadog.dogstatsd.socket.rcvbuf'] > 0
+    server.socket.close()
+
+
+def test_event_loop_serves_every_listener(tmpdir):
+    aggregator = MetricsBucketAggregator('my.host')
+    socket_path = str(tmpdir.join('dsd.socket'))
+    server = Server(aggregator, '127.0.0.1', 0, socket_path=socket_path, tcp_port=free_tcp_port())
+    thread = run_server_in_thread(server)
+    try:
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.sendto('udp:1|c', ('127.0.0.1', server.socket.getsockname()[1]))
+        uds = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        uds.sendto('uds:1|c', socket_path)
+        tcp = socket.create_connection(('127.0.0.1', server.tcp_port))
+        tcp.sendall('tcp:1|c\n')
+        wait_for_count(aggregator, 3)
+
+        # closed connections are unregistered from the loop
+        tcp.close()
+        deadline = time.time() + 2
+        while len(server._listeners) > 3 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(server._listeners) == 3
+    finally:
+        server.stop()
+        thread.join()
+
+    assert aggregator.count == 3
@@ -0,0 +1,131 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import os
+import signal
+import socket
+import threading
+import time
+
+import pytest
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import WorkerPool
+from utils.network import SO_REUSEPORT
+
+
+def free_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.mark.skipif(SO_REUSEPORT is None, reason="SO_REUSEPORT is not available")
+def test_worker_pool_merges_worker_states():
+    port = free_udp_port()
+    aggregator_kwargs = {'hostname': 'myhost', 'interval': 1}
+    server_kwargs = {'host': '127.0.0.1', 'port': port}
+    pool = WorkerPool(2, aggregator_kwargs, server_kwargs)
+
+    thread = threading.Thread(target=pool.start)
+    thread.daemon = True
+    thread.start()
+    while len(pool.workers) < 2:
+        time.sleep(0.01)
+    # leave the workers some time to bind their sockets
+    time.sleep(0.5)
+
+    try:
+        # the kernel balances on the source address, so use several senders
+        for i in xrange(20):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto('my.counter:1|c\nmy.set:%s|s' % i, ('127.0.0.1', port))
+            sender.sendto('_e{5,4}:title|text', ('127.0.0.1', port))
+            sender.close()
+        time.sleep(0.5)
+
+        aggregator = MetricsBucketAggregator(**aggregator_kwargs)
+        pool.merge_into(aggregator)
+    finally:
+        pool.stop()
+        thread.join()
+
+    assert aggregator.count == 40
+    assert len(aggregator.flush_events()) == 20
+
+    time.sleep(1)
+    metrics = aggregator.flush()
+    # the packets may straddle two buckets
+    assert sum(m['points'][0][1] for m in metrics if m['metric'] == 'my.counter') == 20
+    assert sum(m['points'][0][1] for m in metrics if m['metric'] == 'my.set') == 20
+
+
+def send_counters(port, count):
+    # the kernel balances on the source address, so use several senders
+    for i in xrange(count):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.sendto('my.counter:1|c', ('127.0.0.1', port))
+        sender.close()
+    time.sleep(0.5)
+
+
+@pytest.mark.skipif(SO_REUSEPORT is None, reason="SO_REUSEPORT is not available")
+def test_worker_pool_drops_dead_workers():
+    port = free_udp_port()
+    aggregator_kwargs = {'hostname': 'myhost', 'interval': 1}
+    pool = WorkerPool(2, aggregator_kwargs, {'host': '127.0.0.1', 'port': port})
+    pool.start_workers()
+    time.sleep(0.5)
+
+    try:
+        dead, alive = pool.workers
+        os.kill(dead.pid, signal.SIGKILL)
+        dead.join(5)
+        send_counters(port, 20)
+
+        aggregator = MetricsBucketAggregator(**aggregator_kwargs)
+        start = time.time()
+        pool.merge_into(aggregator)
+        # the dead worker isn't waited for
+        assert time.time() - start < pool.COLLECT_TIMEOUT
+        assert pool.workers == [alive]
+        assert aggregator.count == 20
+    finally:
+        pool.stop()
+
+
+@pytest.mark.skipif(SO_REUSEPORT is None, reason="SO_REUSEPORT is not available")
+def test_worker_pool_merges_late_states():
+    port = free_udp_port()
+    aggregator_kwargs = {'hostname': 'myhost', 'interval': 1}
+    pool = WorkerPool(1, aggregator_kwargs, {'host': '127.0.0.1', 'port': port})
+    pool.COLLECT_TIMEOUT = 0.5
+    pool.start_workers()
+    time.sleep(0.5)
+    worker = pool.workers[0]
+
+    try:
+        send_counters(port, 3)
+        os.kill(worker.pid, signal.SIGSTOP)
+        os.waitpid(worker.pid, os.WUNTRACED)
+        aggregator = MetricsBucketAggregator(**aggregator_kwargs)
+        pool.merge_into(aggregator)
+        assert aggregator.count == 0
+        # its state is handed over once it resumes, and merged on the next collection
+        os.kill(worker.pid, signal.SIGCONT)
+        time.sleep(0.5)
+
+        send_counters(port, 5)
+        pool.merge_into(aggregator)
+        assert aggregator.count == 8
+    finally:
+        os.kill(worker.pid, signal.SIGCONT)
+        pool.stop()
+
+    time.sleep(1)
+    metrics = aggregator.flush()
+    assert sum(m['points'][0][1] for m in metrics if m['metric'] == 'my.counter') == 8
@@ -0,0 +1,221 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from aggregator import MetricsBucketAggregator
+
+from .server import Server
+
+
+log = logging.getLogger(__name__)
+
+
+class WorkerAggregator(MetricsBucketAggregator):
+    """
+    Bucket aggregator of a dogstatsd worker process. Its state is exported
+    from a control thread while the server thread keeps submitting.
+    """
+
+    def export_state(self):
+        state = self.export_buckets()
+        state['events'] = self.flush_events()
+        state['service_checks'] = self.flush_service_checks()
+        return state
+
+
+class ServerWorker(multiprocessing.Process):
+    """
+    A dogstatsd server running in its own process, on a socket bound with
+    SO_REUSEPORT. Its aggregated state is handed to the parent on demand.
+
+    Every request sent over `conn` is a `(command, request_id)` tuple, and
+    the state is handed over as a `(request_id, state)` tuple.
+    """
+    COLLECT = 'collect'
+    STOP = 'stop'
+
+    def __init__(self, worker_id, aggregator_kwargs, server_kwargs):
+        multiprocessing.Process.__init__(self, name='dogstatsd-worker-%s' % worker_id)
+        self.daemon = True
+        self.aggregator_kwargs = aggregator_kwargs
+        self.server_kwargs = server_kwargs
+        self.conn, self._child_conn = multiprocessing.Pipe()
+        # ID of the collect request the worker has yet to answer
+        self.pending_request = None
+
+    def start(self):
+        multiprocessing.Process.start(self)
+        # Only the worker holds its end: the parent reads EOF once it dies
+        self._child_conn.close()
+
+    def run(self):
+        # The parent process handles signals and stops its workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.conn.close()
+
+        aggregator = WorkerAggregator(**self.aggregator_kwargs)
+        server = Server(aggregator, reuse_port=True, **self.server_kwargs)
+
+        control = threading.Thread(target=self._serve, args=(aggregator, server))
+        control.daemon = True
+        control.start()
+
+        server.start()
+
+    def _serve(self, aggregator, server):
+        while True:
+            try:
+                command, request_id = self._child_conn.recv()
+            except EOFError:
+                command, request_id = self.STOP, None
+
+            if command == self.COLLECT:
+                server.send_internal_metrics()
+                self._child_conn.send((request_id, aggregator.export_state()))
+            else:
+                server.stop()
+                return
+
+
+class WorkerPool(object):
+    """
+    Runs `nb_workers` dogstatsd servers listening on the same port, each in
+    its own process with its own bucket aggregator, and merges their states
+    into a single aggregator before it is flushed.
+
+    A worker that died is dropped from the pool: the kernel balances the
+    packets over the sockets of the workers left.
+
+    Exposes the same `start`/`stop` interface as `Server`.
+    """
+    COLLECT_TIMEOUT = 5
+    JOIN_TIMEOUT = 2
+
+    def __init__(self, nb_workers, aggregator_kwargs, server_kwargs):
+        self.nb_workers = nb_workers
+        self.aggregator_kwargs = aggregator_kwargs
+        self.server_kwargs = server_kwargs
+        self.workers = []
+        self._conn_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._last_request = 0
+
+    def start_workers(self):
+        """
+        Fork the worker processes. Called before the parent starts any
+        thread, whose locks would be copied in whatever state they are.
+        """
+        if self.workers:
+            return
+
+        for i in xrange(self.nb_workers):
+            server_kwargs = self.server_kwargs
+            if i > 0 and server_kwargs.get('socket_path'):
+                # A unix socket path can only be bound once, the first worker owns it
+                server_kwargs = dict(server_kwargs, socket_path=None)
+            if server_kwargs.get('capture_path'):
+                # One capture file per worker
+                server_kwargs = dict(server_kwargs, capture_path='%s.%s' % (server_kwargs['capture_path'], i))
+            server_kwargs = dict(server_kwargs, telemetry_tags=['worker:%s' % i])
+            worker = ServerWorker(i, self.aggregator_kwargs, server_kwargs)
+            worker.start()
+            self.workers.append(worker)
+
+        log.info("Started %s dogstatsd worker processes", self.nb_workers)
+
+    def start(self):
+        self.start_workers()
+
+        while not self._stopped.is_set():
+            self._stopped.wait(1)
+
+    def stop(self):
+        self._stopped.set()
+
+        with self._conn_lock:
+            for worker in self.workers:
+                try:
+                    worker.conn.send((ServerWorker.STOP, None))
+                except Exception:
+                    pass
+
+        for worker in self.workers:
+            worker.join(self.JOIN_TIMEOUT)
+            if worker.is_alive():
+                log.warning("Worker '%s' did not stop, terminating it", worker.name)
+                worker.terminate()
+        self.workers = []
+
+    def send_internal_metrics(self):
+        # Every worker submits its own telemetry before handing its state over
+        pass
+
+    def merge_into(self, aggregator):
+        """ Collect the state of every worker and merge it into `aggregator`. """
+        with self._conn_lock:
+            self._drop_dead_workers()
+
+            self._last_request += 1
+            request_id = self._last_request
+            for worker in self.workers:
+                # A worker that didn't answer the previous request yet isn't sent
+                # another one, its requests would fill the pipe up
+                if worker.pending_request is None:
+                    self._request_state(worker, request_id)
+
+            deadline = time.time() + self.COLLECT_TIMEOUT
+            for worker in self.workers:
+                for state in self._receive_states(worker, request_id, deadline):
+                    aggregator.merge_buckets(state)
+                    aggregator.events.extend(state['events'])
+                    aggregator.event_count += len(state['events'])
+                    aggregator.service_checks.extend(state['service_checks'])
+                    aggregator.service_check_count += len(state['service_checks'])
+
+    def _drop_dead_workers(self):
+        for worker in [w for w in self.workers if not w.is_alive()]:
+            log.error("Worker '%s' died with exit code %s, the other workers receive its packets",
+                      worker.name, worker.exitcode)
+            worker.conn.close()
+            self.workers.remove(worker)
+
+    def _request_state(self, worker, request_id):
+        try:
+            worker.conn.send((ServerWorker.COLLECT, request_id))
+        except (IOError, OSError) as e:
+            # Dropped on the next collection, once dead
+            log.warning("Could not request the state of worker '%s': %s", worker.name, e)
+        else:
+            worker.pending_request = request_id
+
+    def _receive_states(self, worker, request_id, deadline):
+        """
+        Returns the states handed over by `worker` before `deadline`: the one
+        for `request_id`, after the one for an earlier request if it came late.
+        """
+        states = []
+        while worker.pending_request is not None:
+            try:
+                if not worker.conn.poll(max(0, deadline - time.time())):
+                    log.warning("Worker '%s' did not hand its state over in time", worker.name)
+                    break
+                reply_id, state = worker.conn.recv()
+            except (EOFError, IOError, OSError) as e:
+                log.warning("Could not receive the state of worker '%s': %s", worker.name, e)
+                break
+
+            # The worker handed its buckets over, this is their only copy: a
+            # late state is still merged, its points go to their own buckets
+            worker.pending_request = None
+            states.append(state)
+            if reply_id != request_id:
+                log.warning("Worker '%s' handed its state over late", worker.name)
+                self._request_state(worker, request_id)
+        return states
@@ -17,6 +17,8 @@ class Forwarder(object):
     V1_ENDPOINT = "/intake/"
     V1_SERIES_ENDPOINT = "/api/v1/series"
     V1_SERVICE_CHECKS_ENDPOINT = "/api/v1/check_run"
+    # Served by an agent running in gateway mode
+    GATEWAY_AGGREGATES_ENDPOINT = "/gateway/v1/aggregates"
 
     DD_API_HEADER = "DD-Api-Key"
 
@@ -82,3 +84,6 @@ class Forwarder(object):
 
     def submit_v1_service_checks(self, payload, extra_header):
         self._submit_payload(self.V1_SERVICE_CHECKS_ENDPOINT, payload, extra_header)
+
+    def submit_gateway_aggregates(self, payload, extra_header):
+        self._submit_payload(self.GATEWAY_AGGREGATES_ENDPOINT, payload, extra_header)
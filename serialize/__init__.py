@@ -3,7 +3,7 @@
 # This product includes software developed at Datadog (https://www.datadoghq.com/).
 # Copyright 2018 Datadog, Inc.
 
-from .serialize import Serializer
+from .serialize import Serializer, GatewaySerializer
 
 
-__all__ = ["Serializer"]
+__all__ = ["Serializer", "GatewaySerializer"]
@@ -4,19 +4,24 @@
 # Copyright 2018 Datadog, Inc.
 
 import json
+import zlib
 from collections import defaultdict
 
+from aggregator.codec import encode_metrics
 from utils.hostname import get_hostname
 from utils.unicode import unicode_metrics
 
 
 class Serializer(object):
     JSON_HEADERS = {'Content-Type': 'application/json'}
+    DEFLATE_HEADERS = {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'}
 
-    def __init__(self, aggregator, forwarder):
+    def __init__(self, aggregator, forwarder, compress=False):
         self._aggregator = aggregator
         self._forwarder = forwarder
         self._internal_hostname = get_hostname()
+        # zlib-compress the payloads, worth it for the large ones of a gateway
+        self._compress = compress
 
     @classmethod
     def split_payload(cls, payload):
@@ -95,6 +100,10 @@ class Serializer(object):
         events, e_count = self.serialize_events(add_meta)
 
         extra_headers = self.JSON_HEADERS
+        if self._compress:
+            metrics, service_checks, events = [zlib.compress(payload) if payload else payload
+                                               for payload in (metrics, service_checks, events)]
+            extra_headers = self.DEFLATE_HEADERS
         if metrics:
             self._forwarder.submit_v1_series(
                 metrics, extra_headers)
@@ -110,3 +119,42 @@ class Serializer(object):
     def submit_metadata(self, metadata):
         extra_headers = self.JSON_HEADERS
         self._forwarder.submit_v1_intake(metadata, extra_headers)
+
+
+class GatewaySerializer(Serializer):
+    """
+    Serializer of an agent reporting to an aggregation gateway: rather than
+    series, the state of the metrics is handed over to the gateway, through
+    `gateway_forwarder`, which merges the states of many agents before
+    forwarding them upstream. The metadata is still sent through `forwarder`.
+    """
+    # Reported upstream by the gateway for every agent
+    RUNNING_METRIC = 'datadog.agent.running'
+
+    def __init__(self, aggregator, forwarder, gateway_forwarder):
+        super(GatewaySerializer, self).__init__(aggregator, forwarder)
+        self._gateway_forwarder = gateway_forwarder
+
+    def serialize_aggregates(self):
+        self._aggregator.gauge(self.RUNNING_METRIC, 1)
+        exported = self._aggregator.export_metrics()
+        service_checks = self._aggregator.flush_service_checks()
+        events = self._aggregator.flush_events()
+
+        payload = {
+            'metrics': encode_metrics(exported['metrics']),
+            'count': exported['count'],
+            'service_checks': service_checks,
+            'events': events,
+        }
+        try:
+            payload = json.dumps(payload)
+        except UnicodeDecodeError:
+            # Some name, tag or value isn't valid UTF-8: its bytes are sent as latin-1 characters
+            payload = json.dumps(payload, encoding='latin-1')
+        return zlib.compress(payload), len(exported['metrics']), len(service_checks), len(events)
+
+    def serialize_and_push(self, add_meta=False):
+        payload, m_count, sc_count, e_count = self.serialize_aggregates()
+        self._gateway_forwarder.submit_gateway_aggregates(payload, dict(self.DEFLATE_HEADERS))
+        return m_count, sc_count, e_count
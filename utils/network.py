@@ -15,6 +15,8 @@ from config import config
 
 IPPROTO_IPV6 = socket.IPPROTO_IPV6
 IPV6_V6ONLY = socket.IPV6_V6ONLY
+# Not exposed by the python 2 socket module on every platform
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
 IPV6_DISABLED_ERR = "IPv6 is disabled"
 LOCAL_PROXY_SKIP = ["127.0.0.1", "localhost", "169.254.169.254"]
 
@@ -81,6 +83,66 @@ def get_socket_address(host, port, ipv4_only=False):
     return sockaddr
 
 
+def _iter_proc_net_udp(proc_net_path):
+    """ Yields the fields of every UDP socket listed in procfs. """
+    for name in ('udp', 'udp6'):
+        try:
+            with open(os.path.join(proc_net_path, name)) as f:
+                f.readline()  # header
+                for line in f:
+                    # sl local rem st tx_queue:rx_queue tr:when retrnsmt uid timeout inode ref pointer drops
+                    fields = line.split()
+                    if len(fields) >= 13:
+                        yield fields
+        except IOError:
+            continue
+
+
+def _udp_stats(fields):
+    return {
+        'rx_queue': int(fields[4].split(':')[1], 16),
+        'drops': int(fields[12]),
+    }
+
+
+def get_udp_socket_stats(sock, proc_net_path='/proc/net'):
+    """
+    Reads the kernel statistics of a UDP socket from procfs (linux only).
+
+    Returns a dict with the bytes waiting in the socket receive queue
+    (`rx_queue`) and the number of datagrams the kernel dropped on it since
+    it was created (`drops`), or None if they are not available.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, socket.error):
+        return None
+
+    for fields in _iter_proc_net_udp(proc_net_path):
+        if fields[9] == inode:
+            return _udp_stats(fields)
+    return None
+
+
+def get_udp_port_stats(port, proc_net_path='/proc/net'):
+    """
+    Same as `get_udp_socket_stats`, summed over every local UDP socket bound
+    to `port`, e.g. all the processes of a SO_REUSEPORT group.
+    """
+    local_port = ':%04X' % port
+    stats = None
+    for fields in _iter_proc_net_udp(proc_net_path):
+        if not fields[1].endswith(local_port):
+            continue
+        socket_stats = _udp_stats(fields)
+        if stats is None:
+            stats = socket_stats
+        else:
+            stats['rx_queue'] += socket_stats['rx_queue']
+            stats['drops'] += socket_stats['drops']
+    return stats
+
+
 def set_no_proxy_settings(proxy_settings):
 
     no_proxy = os.environ.get('no_proxy', os.environ.get('NO_PROXY', None))
@@ -4,11 +4,14 @@
 # Copyright 2018 Datadog, Inc.
 
 import os
+import socket
 
 from utils.network import (
     mapto_v6,
     get_socket_address,
     get_proxy,
+    get_udp_port_stats,
+    get_udp_socket_stats,
     LOCAL_PROXY_SKIP,
 )
 
@@ -115,3 +118,29 @@ def test_get_proxy_from_env():
     no_proxy = proxy_settings['no_proxy'].split(',')
     for host in LOCAL_PROXY_SKIP + [proxy_skip_address]:
         assert host in no_proxy
+
+
+def test_get_udp_socket_stats(tmpdir):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    inode = os.fstat(sock.fileno()).st_ino
+
+    header = ('   sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+              'retrnsmt   uid  timeout inode ref pointer drops\n')
+    tmpdir.join('udp').write(
+        header +
+        '  1: 0100007F:1F90 00000000:0000 07 00000000:00000000 00:00000000 00000000 '
+        '0 0 1 2 0000000000000000 0\n'
+    )
+    tmpdir.join('udp6').write(
+        header +
+        '  2: 00000000000000000000000000000000:1F90 00000000000000000000000000000000:0000 07 '
+        '00000000:00000A00 00:00000000 00000000 0 0 %s 2 0000000000000000 42\n' % inode
+    )
+
+    assert get_udp_socket_stats(sock, str(tmpdir)) == {'rx_queue': 2560, 'drops': 42}
+    assert get_udp_socket_stats(sock, str(tmpdir.join('missing'))) is None
+
+    # 0x1F90 = 8080, bound by both sockets
+    assert get_udp_port_stats(8080, str(tmpdir)) == {'rx_queue': 2560, 'drops': 42}
+    assert get_udp_port_stats(8125, str(tmpdir)) is None
+    sock.close()